@@ -1,7 +1,14 @@
 # app.py - Updated per request:
 # - Business Permit Validity field auto-fills "31-Dec-<same year>" and never shows "[unclear]"
 # - Removed "Refresh All" and "Reset Cache" buttons
-# - Exported Excel: UI-aligned headers (spaces -> underscores) and exact order requested
+# - Documents are processed by worker.py through the shared job queue (job_queue.py); the
+#   app only enqueues and polls, so reruns never block and refreshes do not lose progress.
+#   When no worker is heartbeating (plain `streamlit run app.py`), the app starts one itself
+# - Results are read from that shared store (one document at a time) rather than held in
+#   st.session_state, so sessions and replicas share work and reviewer edits
+# - "Export All Data" builds the export on click, memoised until a record changes; xlsx, csv,
+#   jsonl or parquet, optionally without the raw/cleaned text columns (see exporters.py)
+# - Exports (exporters.export_frame): UI-aligned headers (spaces -> underscores) and exact order requested
 #   Column set/order:
 #     Document_Type
 #     Page_Count
@@ -26,13 +33,14 @@
 
 import streamlit as st
 import os
-import io
+import hashlib
 import json
-import pandas as pd
+import subprocess
+import sys
+import threading
 import traceback
 import time
-import concurrent.futures
-from datetime import datetime   # NEW: for validity computation
+from exporters import EXPORT_MIME, export_bytes, validity_31_dec
 
 st.set_page_config(page_title="Business Permit Data Intelligence Engine", layout="wide", initial_sidebar_state="expanded")
 st.title("🏢 Business Permit Data Intelligence Engine")
@@ -221,13 +229,14 @@ button[data-testid*="clear"]:hover {
 </style>
 """, unsafe_allow_html=True)
 
-# ---------- Import processing helpers ----------
-MAIN_AVAILABLE = True
+# ---------- Import the job queue ----------
+JOB_QUEUE_AVAILABLE = True
 _import_error = None
 try:
-    from main import process_pdf, process_image, flatten_json
+    # Processing runs in worker.py; the app only enqueues documents and reads results back
+    from job_queue import active_workers, enqueue, job_result, job_results, job_statuses, retry_jobs, save_result
 except Exception:
-    MAIN_AVAILABLE = False
+    JOB_QUEUE_AVAILABLE = False
     _import_error = traceback.format_exc()
 
 # ---------- Folders ----------
@@ -252,21 +261,6 @@ def save_uploaded_files(uploaded_files):
         paths.append(save_path)
     return paths
 
-def process_permit(file_path):
-    ext = os.path.splitext(file_path)[1].lower()
-    if ext == ".pdf":
-        pdf_folder = os.path.dirname(file_path)
-        image_output_folder = OUTPUT_PDF_IMAGES
-        os.makedirs(image_output_folder, exist_ok=True)
-        return process_pdf(os.path.basename(file_path), pdf_folder, image_output_folder)
-    elif ext in [".png", ".jpg", ".jpeg"]:
-        image_folder = os.path.dirname(file_path)
-        image_output_folder = OUTPUT_PROCESSED_IMAGES
-        os.makedirs(image_output_folder, exist_ok=True)
-        return process_image(os.path.basename(file_path), image_folder, image_output_folder)
-    else:
-        raise ValueError(f"Unsupported file type: {ext}")
-
 def _file_sig(path):
     try:
         if not os.path.exists(path):
@@ -279,191 +273,13 @@ def _file_sig(path):
     except (FileNotFoundError, OSError):
         return None
 
-# --- Validity helpers: guarantee "31-Dec-<year>" (no [unclear]) ---
-def _extract_year(s: str) -> int | None:
-    if not s:
-        return None
-    import re
-    m = re.search(r"(19|20)\d{2}", s)
-    return int(m.group(0)) if m else None
-
-def _validity_31_dec(issue_date: str, validity_raw: str) -> str:
-    # Prefer any explicit year from validity, else fall back to Issue_Date year, else current year
-    y = _extract_year(validity_raw) or _extract_year(issue_date) or datetime.now().year
-    return f"31-Dec-{y}"
-
-# --- Titles helper (with legacy fallback) ---
-def _collect_official_titles(data: dict) -> str:
-    """Return semicolon-separated titles. Prefer parsed list, else parse legacy string."""
-    titles = []
-
-    # 1) From parsed list
-    other_off = data.get("Other_Officials")
-    if isinstance(other_off, list):
-        for o in other_off:
-            t = (o.get("title") or "").strip()
-            if t:
-                titles.append(t)
-
-    # 2) Fallback: parse legacy "Other_Official_Names"
-    if not titles:
-        legacy = (data.get("Other_Official_Names") or "").strip()
-        if legacy:
-            parts = [p.strip() for p in legacy.split(";") if p.strip()]
-            for p in parts:
-                # Pattern A: "Name (Title)"
-                if "(" in p and ")" in p and p.find("(") < p.find(")"):
-                    t = p[p.find("(")+1:p.find(")")].strip()
-                    if t:
-                        titles.append(t)
-                # Pattern B: "Name - Title"
-                elif " - " in p:
-                    _, title = p.split(" - ", 1)
-                    t = title.strip()
-                    if t:
-                        titles.append(t)
-
-    # De-dup while preserving order
-    seen, deduped = set(), []
-    for t in titles:
-        if t not in seen:
-            seen.add(t)
-            deduped.append(t)
-    return "; ".join(deduped)
-
 def excel_bytes_for_single_doc(data: dict) -> bytes:
-    # UI field names with spaces -> underscores, in the requested order
-    cols = [
-        "Document_Type",
-        "Page_Count",
-        "Name_of_file",
-        "Business_Name_Establishment",
-        "Business_Owner",
-        "Business_Address",
-        "Mayor_Name",
-        "Other_Official_Names",
-        "Other_Official_Titles",
-        "Municipality_City_Template",
-        "Permit_Number",
-        "Issue_Date",
-        "Validity_Date",
-        "Nature_of_Business",
-        "raw_text",
-        "cleaned_text",
-    ]
-
-    row = {c: "" for c in cols}
-    row["Document_Type"] = data.get("Document_Type", "")
-    row["Page_Count"] = data.get("Page_Count", "")
-    row["Name_of_file"] = data.get("Name_of_file", "")
-
-    # UI label: "Business Name/Establishment"
-    row["Business_Name_Establishment"] = data.get("Business_Name", "")
-    # UI label: "Business Owner"
-    row["Business_Owner"] = data.get("Business_Owner_Name", "")
-    # UI label: "Business Address"
-    row["Business_Address"] = data.get("Business_Address", "")
-    # UI label: "Mayor Name"
-    row["Mayor_Name"] = data.get("Mayor_Name", "")
-    # UI label: "Other Official Names"
-    row["Other_Official_Names"] = data.get("Other_Official_Names", "")
-
-    # Titles with literal 'None' rule
-    names_str = str(row["Other_Official_Names"]).strip().lower()
-    if names_str in ["none", "null", ""]:
-        row["Other_Official_Titles"] = "None"
-    else:
-        row["Other_Official_Titles"] = _collect_official_titles(data) or "None"
-
-    # UI label: "Municipality/City Template"
-    row["Municipality_City_Template"] = data.get("Municipality_Template", data.get("Municipality_City", ""))
-    # UI label: "Permit Number"
-    row["Permit_Number"] = data.get("Permit_Number", "")
-    # UI label: "Issue Date"
-    row["Issue_Date"] = data.get("Issue_Date", "")
-    # UI label: "Validity Date" (always 31-Dec-<year>)
-    row["Validity_Date"] = _validity_31_dec(row["Issue_Date"], data.get("Business_Permit_Validity", ""))
-    # UI label: "Nature of Business"
-    row["Nature_of_Business"] = data.get("Business_Type", "")
-
-    row["raw_text"] = data.get("raw_text", "")
-    row["cleaned_text"] = data.get("cleaned_text", "")
-
-    df = pd.DataFrame([row], columns=cols)
-    buf = io.BytesIO()
-    with pd.ExcelWriter(buf, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name="extracted")
-    buf.seek(0)
-    return buf.read()
-
-
-def excel_bytes_for_all_docs(cache: dict) -> bytes:
-    cols = [
-        "Document_Type",
-        "Page_Count",
-        "Name_of_file",
-        "Business_Name_Establishment",
-        "Business_Owner",
-        "Business_Address",
-        "Mayor_Name",
-        "Other_Official_Names",
-        "Other_Official_Titles",
-        "Municipality_City_Template",
-        "Permit_Number",
-        "Issue_Date",
-        "Validity_Date",
-        "Nature_of_Business",
-        "raw_text",
-        "cleaned_text",
-    ]
-    rows = []
-    for entry in cache.values():
-        data = (entry or {}).get("result")
-        if not data:
-            continue
-
-        row = {c: "" for c in cols}
-        row["Document_Type"] = data.get("Document_Type", "")
-        row["Page_Count"] = data.get("Page_Count", "")
-        row["Name_of_file"] = data.get("Name_of_file", "")
-
-        row["Business_Name_Establishment"] = data.get("Business_Name", "")
-        row["Business_Owner"] = data.get("Business_Owner_Name", "")
-        row["Business_Address"] = data.get("Business_Address", "")
-        row["Mayor_Name"] = data.get("Mayor_Name", "")
-
-        # Names & Titles (with literal 'None' rule)
-        row["Other_Official_Names"] = data.get("Other_Official_Names", "")
-        names_str = str(row["Other_Official_Names"]).strip().lower()
-        if names_str in ["none", "null", ""]:
-            row["Other_Official_Titles"] = "None"
-        else:
-            row["Other_Official_Titles"] = _collect_official_titles(data) or "None"
-
-        row["Municipality_City_Template"] = data.get("Municipality_Template", data.get("Municipality_City", ""))
-        row["Permit_Number"] = data.get("Permit_Number", "")
-        row["Issue_Date"] = data.get("Issue_Date", "")
-        row["Validity_Date"] = _validity_31_dec(row["Issue_Date"], data.get("Business_Permit_Validity", ""))
-        row["Nature_of_Business"] = data.get("Business_Type", "")
-
-        row["raw_text"] = data.get("raw_text", "")
-        row["cleaned_text"] = data.get("cleaned_text", "")
-
-        rows.append(row)
-
-    df = pd.DataFrame(rows, columns=cols)
-    buf = io.BytesIO()
-    with pd.ExcelWriter(buf, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name="extracted")
-    buf.seek(0)
-    return buf.read()
+    # Same row mapping as every other export (exporters.export_frame)
+    return export_bytes([data], "xlsx")
 
 # ---------- Upload and Cache Management ----------
 uploaded_files = st.file_uploader("", type=["pdf", "png", "jpg", "jpeg"], accept_multiple_files=True)
 
-if "cache" not in st.session_state:
-    st.session_state["cache"] = {}
-
 if "selected_file_path" not in st.session_state:
     st.session_state["selected_file_path"] = None
 
@@ -479,13 +295,9 @@ if uploaded_files:
         newly_uploaded = saved_paths.copy()
         st.session_state["uploaded_file_names"] = current_upload_names
         st.success(f"Saved {len(saved_paths)} uploaded file(s) to `{INPUT_FOLDER}`")
-        
-        for path in newly_uploaded:
-            if path in st.session_state["cache"]:
-                del st.session_state["cache"][path]
 
-if not MAIN_AVAILABLE:
-    st.error("Error importing processing functions from main.py – processing disabled.")
+if not JOB_QUEUE_AVAILABLE:
+    st.error("Error importing the job queue – processing disabled.")
     st.code(_import_error)
     st.stop()
 
@@ -494,60 +306,78 @@ if not all_files:
     st.info("No files available. Upload a PDF or image above to get started.")
     st.stop()
 
-def needs_processing(file_path):
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "2"))
+APP_START_WORKER = os.getenv("APP_START_WORKER", "1") != "0"
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
+JOB_STATUS_LABELS = {"done": "Processed", "queued": "Queued", "running": "Processing…", "failed": "Failed"}
+
+def needs_processing(file_path, job):
+    # Checked against the shared store, so documents another session already queued are skipped
     current_sig = _file_sig(file_path)
     if current_sig is None:
         return False
     
-    cache_entry = st.session_state["cache"].get(file_path)
-    if cache_entry is None:
+    if job is None:
         return True
     
-    cached_sig = cache_entry.get("sig")
-    if cached_sig != current_sig:
-        return True
-    
-    if cache_entry.get("result") is None:
+    if job.get("sig") != current_sig:
         return True
     
     return False
 
 def batch_process(paths, force_process=False):
-    if not paths:
-        return
-    
-    progress_holder = st.empty()
-    with st.spinner(f"Processing {len(paths)} document(s)…"):
-        progress = progress_holder.progress(0, text="Starting…")
-        completed, total = 0, len(paths)
-        
-        def process_single_file(p):
-            try:
-                return process_permit(p)
-            except Exception as e:
-                st.warning(f"Failed to process {os.path.basename(p)}: {e}")
-                st.code(traceback.format_exc())
-                return None
-        
-        with concurrent.futures.ThreadPoolExecutor(max_workers=min(4, total)) as ex:
-            futures = {ex.submit(process_single_file, p): p for p in paths}
-            
-            for fut in concurrent.futures.as_completed(futures):
-                p = futures[fut]
-                res = fut.result()
-                
-                current_sig = _file_sig(p)
-                st.session_state["cache"][p] = {
-                    "sig": current_sig, 
-                    "result": res,
-                    "processed_at": time.time()
-                }
-                
-                completed += 1
-                progress.progress(int(completed/total*100), text=f"Processed {completed}/{total}")
-                time.sleep(0.02)
-        
-        progress_holder.empty()
+    # Enqueue only: worker.py does the processing, so a rerun never waits on it
+    for p in paths:
+        enqueue(p, _file_sig(p), force=force_process)
+
+def export_version(paths, statuses):
+    """Changes only when a finished record is added, removed, reprocessed or edited."""
+    h = hashlib.sha256()
+    for p in paths:
+        job = statuses.get(p)
+        if job and job["status"] == "done":
+            h.update(f"{p}\0{job['finished_at']}\0".encode("utf-8"))
+    return h.hexdigest()
+
+@st.cache_data(max_entries=4, show_spinner="Building export…")
+def export_all_bytes(version, paths, fmt="xlsx", include_text=True):
+    # version is only part of the cache key; the records are read from the shared store
+    return export_bytes((result for _, result in job_results(paths)), fmt, include_text)
+
+@st.cache_resource
+def _local_worker():
+    # One worker process per app process, shared by every session
+    return {"process": None, "lock": threading.Lock()}
+
+def start_worker():
+    """Start worker.py unless the one this app started is still running; returns its last exit code."""
+    local = _local_worker()
+    with local["lock"]:
+        process = local["process"]
+        if process is not None and process.poll() is None:
+            return None
+        local["process"] = subprocess.Popen([sys.executable, WORKER_SCRIPT])
+        return process.returncode if process is not None else None
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def job_progress(paths, outstanding):
+    # Polls the queue on its own timer; the full page reruns only when documents finish
+    statuses = job_statuses(paths)
+    queued = sum(1 for p in paths if statuses.get(p, {}).get("status") == "queued")
+    running = sum(1 for p in paths if statuses.get(p, {}).get("status") == "running")
+    if queued + running < outstanding:
+        st.rerun()
+    done = len(paths) - queued - running
+    st.progress(int(done / len(paths) * 100), text=f"Processed {done}/{len(paths)} • {running} processing • {queued} queued")
+    if not active_workers():
+        if APP_START_WORKER:
+            exit_code = start_worker()
+            if exit_code:
+                st.warning(f"The background worker exited with code {exit_code}; restarting it.")
+            else:
+                st.info("Starting a background worker…")
+        else:
+            st.warning("No worker is running. Start one with `python worker.py` to process queued documents.")
 
 if newly_uploaded:
     time.sleep(0.3)
@@ -560,18 +390,26 @@ if newly_uploaded:
             st.warning(f"File {os.path.basename(p)} may not have been saved correctly")
     newly_uploaded = verified_uploads
 
+job_statuses_by_path = job_statuses(all_files)
+
 pending = []
 for p in all_files:
     if p in newly_uploaded:
         pending.append(p)
-    elif needs_processing(p):
+    elif needs_processing(p, job_statuses_by_path.get(p)):
         pending.append(p)
 
 if pending:
     batch_process(pending)
+    job_statuses_by_path = job_statuses(all_files)
+
+outstanding = [p for p in all_files if job_statuses_by_path.get(p, {}).get("status") in ("queued", "running")]
+if outstanding:
+    job_progress(all_files, len(outstanding))
 
 total = len(all_files)
-processed = sum(1 for p in all_files if st.session_state["cache"].get(p, {}).get("result") is not None)
+processed = sum(1 for p in all_files if job_statuses_by_path.get(p, {}).get("status") == "done")
+failed = [p for p in all_files if job_statuses_by_path.get(p, {}).get("status") == "failed"]
 
 with st.sidebar:
     st.title("📁 Document Library")
@@ -621,8 +459,8 @@ with st.sidebar:
         st.markdown('</div>', unsafe_allow_html=True)
 
         if selected_path:
-            entry = st.session_state["cache"].get(selected_path)
-            status_icon = "Processed" if (entry and entry.get("result")) else ("Not yet processed" if (entry and "result" in entry and entry.get("result") is None) else "Processing…")
+            job_status = job_statuses_by_path.get(selected_path, {}).get("status")
+            status_icon = JOB_STATUS_LABELS.get(job_status, "Not yet processed")
             
             if os.path.exists(selected_path):
                 stat = os.stat(selected_path)
@@ -636,15 +474,27 @@ with st.sidebar:
 
         st.divider()
 
-    all_excel = excel_bytes_for_all_docs(st.session_state["cache"])
-
-    st.download_button(
-        "Export All Data",
-        data=all_excel,
-        file_name="business_permits_extracted.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        key="sb_download_all",
-    )
+    if failed and st.button(f"Retry Failed ({len(failed)})", key="sb_retry_failed"):
+        retry_jobs(failed)
+        st.rerun()
+
+    # Built only on request and memoised on the export version, so ordinary reruns skip it
+    export_fmt = st.selectbox("Export format", list(EXPORT_MIME), key="sb_export_format")
+    include_text = st.checkbox("Include raw/cleaned text", value=True, key="sb_export_text")
+    version = f"{export_version(all_files, job_statuses_by_path)}:{export_fmt}:{include_text}"
+    prepared = st.session_state.get("export_all_version") == version
+    if not prepared and st.button("Export All Data", key="sb_prepare_all"):
+        st.session_state["export_all_version"] = version
+        st.rerun()
+
+    if prepared:
+        st.download_button(
+            "Download All Data",
+            data=export_all_bytes(version, tuple(all_files), export_fmt, include_text),
+            file_name=f"business_permits_extracted.{export_fmt}",
+            mime=EXPORT_MIME[export_fmt],
+            key="sb_download_all",
+        )
 
     # REMOVED per request:
     # if st.button("Refresh All", key="sb_reprocess"):
@@ -656,7 +506,8 @@ with st.sidebar:
     #     st.rerun()
 
 selected_path = st.session_state.get("selected_file_path")
-result = st.session_state["cache"].get(selected_path, {}).get("result") if selected_path else None
+# Only the selected document's record (with its raw/cleaned text) is loaded from the shared store
+result = job_result(selected_path) if selected_path else None
 
 st.divider()
 col1, col2, col3 = st.columns([30, 1, 40])
@@ -710,7 +561,15 @@ with col2:
 with col3:
     st.subheader("Extracted Data")
     if not result:
-        st.info("No extracted data yet. If you just uploaded, processing should complete shortly.")
+        job = job_statuses_by_path.get(selected_path, {}) if selected_path else {}
+        if job.get("status") == "failed":
+            st.error(f"Processing failed after {job.get('attempts')} attempt(s).")
+            st.code(job.get("error") or "")
+            if st.button("Retry", key="retry_selected"):
+                retry_jobs([selected_path])
+                st.rerun()
+        else:
+            st.info("No extracted data yet. If you just uploaded, processing should complete shortly.")
     elif not selected_path:
         st.info("Please select a document from the sidebar.")
     else:
@@ -718,6 +577,9 @@ with col3:
         file_key = os.path.basename(selected_path)
 
         with tabs[0]:
+            if result.get("Cleaning_Fallback"):
+                st.warning("OCR cleaning failed for this document, so fields were read from the raw OCR text. "
+                           "Please check them against the preview.")
             business_name = st.text_input(
                 "**Business Name/Establishment**", result.get("Business_Name", ""), key=f"{file_key}_business_name"
             )
@@ -777,7 +639,7 @@ with col3:
             )
 
             # UPDATED: validity always shows "31-Dec-<same year>" (never "[unclear]")
-            validity_default = _validity_31_dec(result.get("Issue_Date", ""), result.get("Business_Permit_Validity", ""))
+            validity_default = validity_31_dec(result.get("Issue_Date", ""), result.get("Business_Permit_Validity", ""))
             validity_date = st.text_input(
                 "**Validity Date**",
                 validity_default,
@@ -821,13 +683,12 @@ with col3:
                         "Business_Type": official_positions,
                         "Name_of_file": os.path.basename(selected_path),
                     })
-                    st.session_state["cache"][selected_path] = {"sig": _file_sig(selected_path), "result": updated}
+                    save_result(selected_path, updated)
                     result = updated
                     st.success("Changes saved.")
 
             with bcol2:
-                current = st.session_state["cache"].get(selected_path, {"result": result})["result"]
-                excel_bytes = excel_bytes_for_single_doc(current)
+                excel_bytes = excel_bytes_for_single_doc(result)
                 st.download_button(
                     "Export to Excel",
                     data=excel_bytes,
@@ -0,0 +1,484 @@
+# async_pipeline.py - asyncio variant of the permit pipeline for large, I/O-bound backfills
+# - Same stages, prompts, stage cache and result cache as main.py; only the transport differs
+# - Azure Document Intelligence is called through its REST API with httpx (the SDK's async
+#   client needs aiohttp, which is not part of requirements.txt)
+# - Rasterization/OpenCV preprocessing runs in a process pool so the event loop never blocks on CPU
+#
+# Usage: python async_pipeline.py <input_folder> <excel_output> [concurrency]
+
+import asyncio
+import os
+import sys
+import traceback
+
+import httpx
+
+from main import (
+    ADI_MAX_CONCURRENCY,
+    ADI_MODEL_ID,
+    BATCH_STATS,
+    EXTRACTION_STATS,
+    FAST_PATH_STATS,
+    IMAGE_EXTENSIONS,
+    MAX_RETRIES,
+    RETRYABLE_STATUS,
+    STRUCTURING_BATCH,
+    STRUCTURING_MAX_TOKENS,
+    TOKEN_STATS,
+    OCR_NATIVE_PDF,
+    OCR_PDF_PAGES,
+    PDF_IMAGE_OUTPUT_FOLDER,
+    PROCESSED_IMAGE_OUTPUT_FOLDER,
+    RATE_LIMIT_STATS,
+    record_stat,
+    adi_api_key,
+    adi_endpoint,
+    adi_wait_seconds,
+    attach_document_fields,
+    batchable,
+    bounding_box,
+    build_cleaning_request,
+    build_partial_structuring_request,
+    build_structuring_request,
+    cache_get,
+    cache_put,
+    cleaning_cache_key,
+    cleaning_jobs,
+    choose_cleaning_path,
+    count_cleaning_failure,
+    disable_structured_output,
+    fast_path_text,
+    get_cpu_pool,
+    get_structured_data_batched,
+    endpoint,
+    extract_with_templates,
+    headers,
+    is_page_image,
+    is_truncated,
+    join_cleaned,
+    key_value_record,
+    merge_page_records,
+    merge_prefilled,
+    ocr_cache_key,
+    page_record,
+    openai_wait_seconds,
+    overlay_prefilled,
+    parse_structured_response,
+    partial_structuring_cache_key,
+    pdf_page_count,
+    prompt_cache_report,
+    pdf_ocr_cache_key,
+    prefill_from_key_values,
+    read_ocr_input,
+    record_prompt_cache,
+    rejects_response_format,
+    render_image_pages,
+    render_pdf_page,
+    response_content,
+    result_cache_key,
+    retry_delay,
+    save_cleaned_text,
+    save_export,
+    settle_openai_tokens,
+    structuring_cache_key,
+    structured_output_enabled,
+    token_usage,
+    unresolved_fields,
+    vision_images,
+)
+
+ADI_API_VERSION = "2023-07-31"
+ASYNC_CONCURRENCY = int(os.getenv("ASYNC_CONCURRENCY", "64"))
+ADI_POLL_INTERVAL = float(os.getenv("ADI_POLL_INTERVAL", "1.0"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "120"))
+ADI_POLL_TIMEOUT = float(os.getenv("ADI_POLL_TIMEOUT", "600"))
+
+class AsyncResources:
+    """HTTP client and limits shared by every document in one event loop."""
+
+    def __init__(self, concurrency=ASYNC_CONCURRENCY):
+        pool_size = max(concurrency, ADI_MAX_CONCURRENCY) * 2
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.client = httpx.AsyncClient(timeout=HTTP_TIMEOUT, limits=limits)
+        self.adi_semaphore = asyncio.Semaphore(ADI_MAX_CONCURRENCY)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+async def _send_with_retries(res, name, send, wait_for_budget):
+    """Await budget, send, and retry throttling/transient failures like main.post_chat_completion."""
+    for attempt in range(MAX_RETRIES + 1):
+        await asyncio.sleep(wait_for_budget())
+        try:
+            response = await send()
+        except httpx.TransportError as e:
+            if attempt == MAX_RETRIES:
+                record_stat("gave_up")
+                raise
+            print(f"{name} request failed ({e}); retrying")
+            record_stat("retries")
+            await asyncio.sleep(retry_delay(None, attempt))
+            continue
+        if response.status_code == 429:
+            record_stat("rate_limited")
+        if response.status_code in RETRYABLE_STATUS and attempt < MAX_RETRIES:
+            record_stat("retries")
+            delay = retry_delay(response.headers, attempt)
+            print(f"{name} returned {response.status_code}; retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+        if response.status_code in RETRYABLE_STATUS:
+            record_stat("gave_up")
+        response.raise_for_status()
+        return response
+
+# --------------------- Stage cache ---------------------
+# The cache is SQLite with a busy timeout, so a lock held by another process (the worker, a
+# second backfill) must not stall every document on the event loop
+async def cache_get_async(namespace, key):
+    return await asyncio.to_thread(cache_get, namespace, key)
+
+async def cache_put_async(namespace, key, value):
+    await asyncio.to_thread(cache_put, namespace, key, value)
+
+# --------------------- Azure Document Intelligence (REST) ---------------------
+async def _analyze_document(res, data, pages=None):
+    url = f"{adi_endpoint.rstrip('/')}/formrecognizer/documentModels/{ADI_MODEL_ID}:analyze"
+    params = {"api-version": ADI_API_VERSION}
+    if pages:
+        params["pages"] = pages
+    auth = {"Ocp-Apim-Subscription-Key": adi_api_key}
+    async with res.adi_semaphore:
+        response = await _send_with_retries(
+            res, "Document Intelligence",
+            lambda: res.client.post(url, params=params, content=data,
+                                    headers={**auth, "Content-Type": "application/octet-stream"}),
+            adi_wait_seconds,
+        )
+        operation_url = response.headers["operation-location"]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + ADI_POLL_TIMEOUT
+        while True:
+            if loop.time() > deadline:
+                raise TimeoutError(f"Document analysis did not finish within {ADI_POLL_TIMEOUT:.0f}s")
+            await asyncio.sleep(float(response.headers.get("retry-after", ADI_POLL_INTERVAL)))
+            response = await _send_with_retries(
+                res, "Document Intelligence", lambda: res.client.get(operation_url, headers=auth), lambda: 0
+            )
+            body = response.json()
+            status = body.get("status")
+            if status == "succeeded":
+                return body.get("analyzeResult") or {}
+            if status == "failed":
+                raise RuntimeError(f"Document analysis failed: {body.get('error')}")
+
+def _rest_region(element):
+    region = ((element or {}).get("boundingRegions") or [None])[0]
+    return (region.get("pageNumber"), bounding_box(region.get("polygon"))) if region else (None, None)
+
+def _page_records(analyze_result):
+    pairs = {}
+    for kv in analyze_result.get("keyValuePairs") or []:
+        key, value = kv.get("key") or {}, kv.get("value")
+        page_number, key_box = _rest_region(key)
+        _, value_box = _rest_region(value)
+        pairs.setdefault(page_number or 1, []).append(key_value_record(
+            key.get("content"), (value or {}).get("content"), kv.get("confidence"), page_number, key_box, value_box
+        ))
+    pages = sorted(analyze_result.get("pages") or [], key=lambda p: p.get("pageNumber", 0))
+    return [
+        page_record(
+            page.get("pageNumber", 1),
+            [line.get("content", "") for line in page.get("lines") or []],
+            [word.get("confidence") for word in page.get("words") or []],
+            [bounding_box(line.get("polygon")) for line in page.get("lines") or []],
+            pairs.get(page.get("pageNumber", 1)),
+        )
+        for page in pages
+    ]
+
+async def analyze_page_async(res, image_source):
+    try:
+        image_bytes = read_ocr_input(image_source)
+    except Exception as e:
+        print(f"Error reading document for OCR: {e}")
+        return None
+
+    key = ocr_cache_key(image_bytes)
+    cached = await cache_get_async("ocr_page", key)
+    if cached is not None:
+        return cached
+
+    try:
+        analyze_result = await _analyze_document(res, image_bytes)
+        content = None if is_page_image(image_source) else analyze_result.get("content")
+        record = merge_page_records(_page_records(analyze_result), content)
+        if record["text"]:
+            await cache_put_async("ocr_page", key, record)
+        return record
+    except Exception as e:
+        print(f"Error analyzing document: {e}")
+        traceback.print_exc()
+        return None
+
+async def analyze_pdf_pages_async(res, pdf_bytes, pages=None):
+    key = pdf_ocr_cache_key(pdf_bytes, pages)
+    cached = await cache_get_async("ocr_pdf_pages", key)
+    if cached is not None:
+        return cached
+    try:
+        records = _page_records(await _analyze_document(res, pdf_bytes, pages))
+        if any(r["text"] for r in records):
+            await cache_put_async("ocr_pdf_pages", key, records)
+        return records
+    except Exception as e:
+        print(f"Error analyzing PDF: {e}")
+        traceback.print_exc()
+        return []
+
+# --------------------- Azure OpenAI ---------------------
+async def _chat_completion(res, data):
+    reserved = []
+
+    def wait_for_budget():
+        # Reaching the next attempt means the previous one produced no completion
+        if reserved:
+            settle_openai_tokens(reserved.pop(), None)
+        wait, tokens = openai_wait_seconds(data)
+        reserved.append(tokens)
+        return wait
+
+    response_json = None
+    try:
+        response = await _send_with_retries(
+            res, "OpenAI", lambda: res.client.post(endpoint, headers=headers, json=data), wait_for_budget,
+        )
+        response_json = response.json()
+    finally:
+        if reserved:
+            settle_openai_tokens(reserved.pop(), response_json)
+    record_prompt_cache(response_json)
+    return response_json
+
+async def _post_structuring_request(res, build):
+    """Async counterpart of main.post_structuring_request."""
+    data = build(structured_output_enabled())
+    try:
+        responses = [await _chat_completion(res, data)]
+    except httpx.HTTPStatusError as e:
+        if "response_format" not in data or not rejects_response_format(e.response.status_code, e.response.text):
+            raise
+        disable_structured_output(e.response.text)
+        data = build(False)
+        responses = [await _chat_completion(res, data)]
+    parsed = parse_structured_response(response_content(responses[-1]))
+    if is_truncated(responses[-1]):
+        responses.append(await _chat_completion(res, dict(data, max_tokens=STRUCTURING_MAX_TOKENS)))
+        parsed = parse_structured_response(response_content(responses[-1])) or parsed
+    return parsed, responses, data
+
+async def clean_ocr_text_async(res, raw_text, pages=None, max_side=None):
+    key = cleaning_cache_key(raw_text, pages, max_side)
+    cached = await cache_get_async("cleaned", key)
+    if cached is not None:
+        return cached, False
+    try:
+        # Thumbnail/budget fitting is PIL work, so it runs off the event loop (and only on a miss)
+        images = await asyncio.to_thread(vision_images, pages, max_side)
+        cleaned_text = response_content(await _chat_completion(res, build_cleaning_request(raw_text, images)))
+        await cache_put_async("cleaned", key, cleaned_text)
+        return cleaned_text, False
+    except Exception as e:
+        print(f"Error in OCR text cleaning: {str(e)} - falling back to raw OCR text")
+        return raw_text, True
+
+async def clean_document_text_async(res, page_texts, page_images=None):
+    jobs = cleaning_jobs(page_texts, page_images)
+    if not jobs:
+        return await clean_ocr_text_async(res, "")
+    cleaned = await asyncio.gather(*(clean_ocr_text_async(res, *job) for job in jobs))
+    return join_cleaned(cleaned)
+
+async def clean_document_async(res, page_records, page_images=None):
+    page_texts = [r["text"] if r else None for r in page_records]
+    path = choose_cleaning_path(page_records)
+    if path == "skipped":
+        return fast_path_text(page_records), False
+    return count_cleaning_failure(
+        await clean_document_text_async(res, page_texts, page_images if path == "full" else None)
+    )
+
+async def get_structured_data_from_text_async(res, raw_text):
+    key = structuring_cache_key(raw_text)
+    cached = await cache_get_async("structured", key)
+    if cached is not None:
+        return cached
+    try:
+        structured_data, responses, data = await _post_structuring_request(
+            res, lambda json_mode: build_structuring_request(raw_text, json_mode)
+        )
+        if structured_data:
+            structured_data["Token_Usage"] = token_usage(data, responses, raw_text)
+            await cache_put_async("structured", key, structured_data)
+        return structured_data
+    except httpx.HTTPError as e:
+        print(f"API request error: {e}")
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+    return None
+
+async def get_remaining_fields_from_text_async(res, raw_text, prefilled):
+    if not unresolved_fields(prefilled):
+        return merge_prefilled(prefilled, {})
+    key = partial_structuring_cache_key(raw_text, prefilled)
+    cached = await cache_get_async("structured_partial", key)
+    if cached is not None:
+        return cached
+    try:
+        extracted, responses, data = await _post_structuring_request(
+            res, lambda json_mode: build_partial_structuring_request(raw_text, prefilled, json_mode)
+        )
+        if not extracted:
+            return None
+        structured_data = merge_prefilled(prefilled, extracted)
+        structured_data["Token_Usage"] = token_usage(data, responses, raw_text)
+        await cache_put_async("structured_partial", key, structured_data)
+        return structured_data
+    except httpx.HTTPError as e:
+        print(f"API request error: {e}")
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+    return None
+
+async def extract_structured_data_async(res, cleaned_text, page_records=None):
+    structured_data = extract_with_templates(cleaned_text)
+    if structured_data:
+        return structured_data
+    prefilled = prefill_from_key_values(page_records)
+    if prefilled:
+        record_stat("kv_prefilled", stats=EXTRACTION_STATS)
+        record_stat("kv_fields", len(prefilled), stats=EXTRACTION_STATS)
+    if batchable(cleaned_text) and unresolved_fields(prefilled):
+        # The shared batcher sends from worker/timer threads, so wait for it off the event loop
+        return overlay_prefilled(await asyncio.to_thread(get_structured_data_batched, cleaned_text), prefilled)
+    if prefilled:
+        return await get_remaining_fields_from_text_async(res, cleaned_text, prefilled)
+    return await get_structured_data_from_text_async(res, cleaned_text)
+
+# --------------------- Pipeline ---------------------
+def _read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+async def _process_permit_uncached_async(res, file_path):
+    file_name = os.path.basename(file_path)
+    ext = os.path.splitext(file_path)[1].lower()
+    loop = asyncio.get_running_loop()
+
+    if ext == ".pdf" and OCR_NATIVE_PDF:
+        print(f"Processing PDF: {file_name}...")
+        page_records = await analyze_pdf_pages_async(res, await asyncio.to_thread(_read_bytes, file_path), OCR_PDF_PAGES)
+        page_count = len(page_records)
+        page_images = []
+    else:
+        pool = get_cpu_pool()
+        if ext == ".pdf":
+            print(f"Processing PDF: {file_name}...")
+            os.makedirs(PDF_IMAGE_OUTPUT_FOLDER, exist_ok=True)
+            page_count = await asyncio.to_thread(pdf_page_count, file_path)
+
+            async def render_and_ocr(page_number):
+                # Each page is OCR'd as soon as its render finishes in the CPU pool
+                page = await loop.run_in_executor(pool, render_pdf_page, file_path, PDF_IMAGE_OUTPUT_FOLDER, page_number)
+                return page, await analyze_page_async(res, page)
+
+            pages = await asyncio.gather(*(render_and_ocr(n) for n in range(1, page_count + 1)))
+            page_images = [page for page, _ in pages]
+            page_records = [record for _, record in pages]
+        elif ext in IMAGE_EXTENSIONS:
+            print(f"Processing Image: {file_name}...")
+            os.makedirs(PROCESSED_IMAGE_OUTPUT_FOLDER, exist_ok=True)
+            page_images, page_count = await loop.run_in_executor(
+                pool, render_image_pages, file_path, PROCESSED_IMAGE_OUTPUT_FOLDER
+            )
+            page_records = await asyncio.gather(*(analyze_page_async(res, p) for p in page_images))
+        else:
+            raise ValueError(f"Unsupported file type: {ext}")
+
+    raw_text = "\n".join(r["text"] for r in page_records if r and r["text"])
+    cleaned_text, degraded = await clean_document_async(res, page_records, page_images)
+    await asyncio.to_thread(save_cleaned_text, file_name, cleaned_text)
+
+    structured_data = await extract_structured_data_async(res, cleaned_text, page_records) or {}
+    return attach_document_fields(structured_data, file_name, page_count, raw_text, cleaned_text, degraded)
+
+async def process_permit_async(file_path, res=None):
+    """Async counterpart of main.process_permit, backed by the same result cache."""
+    own_resources = res is None
+    if own_resources:
+        res = AsyncResources()
+    try:
+        key = await asyncio.to_thread(result_cache_key, file_path)
+        cached = await cache_get_async("result", key)
+        if cached:
+            print(f"Result cache hit: {os.path.basename(file_path)}")
+            cached["Name_of_file"] = os.path.basename(file_path)
+            return cached
+        result = await _process_permit_uncached_async(res, file_path)
+        if result and result.get("Cleaning_Fallback"):
+            print(f"OCR cleaning failed for {os.path.basename(file_path)}; result not cached")
+        elif result:
+            await cache_put_async("result", key, result)
+        return result
+    finally:
+        if own_resources:
+            await res.aclose()
+
+async def process_many(paths, concurrency=ASYNC_CONCURRENCY):
+    """Process many permits with at most `concurrency` documents in flight; results keep input order."""
+    res = AsyncResources(concurrency)
+    limit = asyncio.Semaphore(concurrency)
+
+    async def run_one(path):
+        async with limit:
+            try:
+                return await process_permit_async(path, res)
+            except Exception as exc:
+                print(f"{os.path.basename(path)} generated an exception: {exc}")
+                return None
+
+    try:
+        return await asyncio.gather(*(run_one(p) for p in paths))
+    finally:
+        await res.aclose()
+
+def main():
+    if len(sys.argv) < 3:
+        print("Usage: python async_pipeline.py <input_folder> <excel_output> [concurrency]")
+        return
+    input_folder, excel_output = sys.argv[1], sys.argv[2]
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else ASYNC_CONCURRENCY
+    paths = [
+        os.path.join(input_folder, f) for f in sorted(os.listdir(input_folder))
+        if os.path.splitext(f)[1].lower() in [".pdf"] + IMAGE_EXTENSIONS
+    ]
+    results = asyncio.run(process_many(paths, concurrency))
+    structured_data_list = [r for r in results if r]
+    if structured_data_list:
+        os.makedirs(os.path.dirname(excel_output) or ".", exist_ok=True)
+        save_export(structured_data_list, excel_output)
+    else:
+        print("No structured data extracted.")
+    print(f"OCR fast path: {FAST_PATH_STATS}")
+    print(f"Extraction: {EXTRACTION_STATS}")
+    print(f"Structuring tokens: {TOKEN_STATS}")
+    print(f"Prompt cache: {prompt_cache_report()}")
+    print(f"Rate limiting: {RATE_LIMIT_STATS}")
+    if STRUCTURING_BATCH:
+        print(f"Batched extraction: {BATCH_STATS}")
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as exc:
+        print(f"Script generated an exception: {exc}")
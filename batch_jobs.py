@@ -0,0 +1,305 @@
+# batch_jobs.py - offline batch-job mode for nightly backfills
+# - OCR and cleaning run as usual (cached per stage); every extraction request that templates
+#   and key-value pre-fill could not resolve locally is written to JSONL job files in the Azure
+#   OpenAI batch format instead of being sent interactively
+# - Job files are uploaded, batches created and polled, and the output is ingested back into
+#   the same structured records save_export consumes (and into the stage/result caches)
+# - Everything is kept in the job directory, so re-running with the same directory resumes
+#   where the previous run stopped (prepared documents, submitted batches, downloaded output)
+# - Lines that failed in the batch are extracted interactively during ingest
+#
+# Usage: python batch_jobs.py <input_folder> <job_dir> <excel_output>
+# BATCH_API_BASE_URL=http://localhost:8765 points the job at batch_standin_server.py for tests.
+
+import concurrent.futures
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+from main import (
+    IMAGE_EXTENSIONS,
+    PIPELINE_WORKERS,
+    RATE_LIMIT_STATS,
+    attach_document_fields,
+    build_partial_structuring_request,
+    build_structuring_request,
+    cache_get,
+    cache_put,
+    endpoint,
+    extract_with_templates,
+    get_http_session,
+    get_remaining_fields_from_text,
+    get_structured_data_from_text,
+    merge_prefilled,
+    ocr_and_clean_file,
+    parse_structured_response,
+    partial_structuring_cache_key,
+    prefill_from_key_values,
+    response_content,
+    result_cache_key,
+    save_export,
+    structured_output_enabled,
+    structuring_cache_key,
+    token_usage,
+    unresolved_fields,
+)
+
+BATCH_API_VERSION = os.getenv("AZURE_OPENAI_BATCH_API_VERSION", "2024-10-21")
+BATCH_API_BASE_URL = (os.getenv("BATCH_API_BASE_URL") or endpoint.split("/openai/")[0]).rstrip("/")
+# Batch jobs need a Global-Batch deployment; defaults to the deployment in AZURE_OPENAI_ENDPOINT
+BATCH_DEPLOYMENT = os.getenv("AZURE_OPENAI_BATCH_DEPLOYMENT") or (re.findall(r"/deployments/([^/?]+)", endpoint) or [""])[0]
+BATCH_COMPLETION_WINDOW = os.getenv("BATCH_COMPLETION_WINDOW", "24h")
+BATCH_POLL_SECONDS = float(os.getenv("BATCH_POLL_SECONDS", "60"))
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "50000"))
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+# ---------- Batch API ----------
+def _api(method, path, **kwargs):
+    url = f"{BATCH_API_BASE_URL}/openai/{path}"
+    response = get_http_session().request(method, url, params={"api-version": BATCH_API_VERSION}, timeout=300, **kwargs)
+    response.raise_for_status()
+    return response
+
+def upload_batch_file(path):
+    with open(path, "rb") as f:
+        # Content-Type None drops the session's JSON header so requests sets the multipart boundary
+        response = _api("POST", "files", data={"purpose": "batch"}, headers={"Content-Type": None},
+                        files={"file": (os.path.basename(path), f, "application/jsonl")})
+    return response.json()["id"]
+
+def create_batch(input_file_id):
+    response = _api("POST", "batches", json={
+        "input_file_id": input_file_id,
+        "endpoint": "/chat/completions",
+        "completion_window": BATCH_COMPLETION_WINDOW,
+    })
+    return response.json()
+
+def get_batch(batch_id):
+    return _api("GET", f"batches/{batch_id}").json()
+
+def download_file(file_id, path):
+    response = _api("GET", f"files/{file_id}/content")
+    with open(path, "wb") as f:
+        f.write(response.content)
+
+# ---------- Job directory ----------
+def _documents_path(job_dir):
+    return os.path.join(job_dir, "documents.jsonl")
+
+def _job_path(job_dir):
+    return os.path.join(job_dir, "job.json")
+
+def read_jsonl(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def load_job(job_dir):
+    if not os.path.exists(_job_path(job_dir)):
+        return {"batches": []}
+    with open(_job_path(job_dir), encoding="utf-8") as f:
+        return json.load(f)
+
+def save_job(job_dir, job):
+    tmp_path = _job_path(job_dir) + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(job, f, indent=2)
+    os.replace(tmp_path, _job_path(job_dir))
+
+# ---------- Steps ----------
+def plan_document(file_path):
+    """OCR + cleaning, then either a locally resolved record or the extraction request it needs."""
+    try:
+        cached = cache_get("result", result_cache_key(file_path))
+    except OSError:
+        cached = None
+    if cached:
+        return {"file_path": file_path, "result": cached}
+
+    page_records, page_count, raw_text, cleaned_text, degraded = ocr_and_clean_file(file_path)
+    document = {"file_path": file_path, "page_count": page_count, "raw_text": raw_text, "cleaned_text": cleaned_text}
+    if degraded:
+        document["degraded"] = True
+    structured_data = extract_with_templates(cleaned_text)
+    prefilled = prefill_from_key_values(page_records)
+    json_mode = structured_output_enabled()
+    if structured_data:
+        document["structured"] = structured_data
+    elif prefilled and not unresolved_fields(prefilled):
+        document["structured"] = merge_prefilled(prefilled, {})
+    elif prefilled:
+        document["prefilled"] = prefilled
+        document["request"] = build_partial_structuring_request(cleaned_text, prefilled, json_mode)
+    else:
+        document["request"] = build_structuring_request(cleaned_text, json_mode)
+    return document
+
+def prepare(paths, job_dir):
+    """Append a planned entry per input file to documents.jsonl; files already planned are skipped."""
+    os.makedirs(job_dir, exist_ok=True)
+    done = {d["file_path"] for d in read_jsonl(_documents_path(job_dir))}
+    todo = [p for p in paths if p not in done]
+    print(f"Preparing {len(todo)} documents ({len(done)} already prepared)")
+    write_lock = threading.Lock()
+    with open(_documents_path(job_dir), "a", encoding="utf-8") as out, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=PIPELINE_WORKERS) as executor:
+        futures = {executor.submit(plan_document, p): p for p in todo}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                document = future.result()
+            except Exception as exc:
+                print(f"{futures[future]} generated an exception: {exc}")
+                continue
+            with write_lock:
+                out.write(json.dumps(document, ensure_ascii=False) + "\n")
+                out.flush()
+
+def write_request_files(job_dir):
+    """Split extraction requests that are not in a job file yet into new JSONL job files of at
+    most BATCH_MAX_REQUESTS lines; a resumed run adds files for documents prepared since."""
+    job = load_job(job_dir)
+    batched = {
+        line["custom_id"] for batch in job["batches"]
+        for line in read_jsonl(os.path.join(job_dir, batch["input_file"]))
+    }
+    lines = [
+        {"custom_id": str(i), "method": "POST", "url": "/chat/completions",
+         "body": dict(d["request"], model=BATCH_DEPLOYMENT)}
+        for i, d in enumerate(read_jsonl(_documents_path(job_dir))) if d.get("request") and str(i) not in batched
+    ]
+    if not lines:
+        return job
+    first = len(job["batches"])
+    for start in range(0, len(lines), BATCH_MAX_REQUESTS):
+        input_file = f"requests-{first + start // BATCH_MAX_REQUESTS:03d}.jsonl"
+        with open(os.path.join(job_dir, input_file), "w", encoding="utf-8") as f:
+            for line in lines[start:start + BATCH_MAX_REQUESTS]:
+                f.write(json.dumps(line, ensure_ascii=False) + "\n")
+        job["batches"].append({"input_file": input_file})
+    save_job(job_dir, job)
+    print(f"{len(lines)} new extraction requests in {len(job['batches']) - first} job file(s)")
+    return job
+
+def submit(job_dir, job):
+    for batch in job["batches"]:
+        if "file_id" not in batch:
+            batch["file_id"] = upload_batch_file(os.path.join(job_dir, batch["input_file"]))
+            save_job(job_dir, job)
+        if "batch_id" not in batch:
+            batch["batch_id"] = create_batch(batch["file_id"])["id"]
+            batch["status"] = "validating"
+            save_job(job_dir, job)
+            print(f"Submitted {batch['input_file']} as {batch['batch_id']}")
+
+def poll(job_dir, job):
+    while True:
+        for batch in job["batches"]:
+            if batch.get("status") in TERMINAL_STATUSES:
+                continue
+            info = get_batch(batch["batch_id"])
+            batch["status"] = info.get("status")
+            batch["output_file_id"] = info.get("output_file_id")
+            batch["error_file_id"] = info.get("error_file_id")
+            batch["request_counts"] = info.get("request_counts")
+        save_job(job_dir, job)
+        pending = [b for b in job["batches"] if b.get("status") not in TERMINAL_STATUSES]
+        if not pending:
+            return
+        print(f"{len(pending)} batch(es) still running: " + ", ".join(f"{b['batch_id']}={b['status']}" for b in pending))
+        time.sleep(BATCH_POLL_SECONDS)
+
+def download(job_dir, job):
+    for n, batch in enumerate(job["batches"]):
+        for kind in ("output", "error"):
+            file_id, path = batch.get(f"{kind}_file_id"), os.path.join(job_dir, f"{kind}-{n:03d}.jsonl")
+            if file_id and not os.path.exists(path):
+                download_file(file_id, path)
+
+def _batch_responses(job_dir, job):
+    responses = {}
+    for n in range(len(job["batches"])):
+        for line in read_jsonl(os.path.join(job_dir, f"output-{n:03d}.jsonl")):
+            response = line.get("response") or {}
+            if response.get("status_code") == 200:
+                responses[line["custom_id"]] = response.get("body")
+    return responses
+
+def _extract_from_response(document, response_json):
+    if not response_json:
+        return None
+    parsed = parse_structured_response(response_content(response_json))
+    if not parsed:
+        return None
+    prefilled, cleaned_text = document.get("prefilled"), document["cleaned_text"]
+    if prefilled:
+        structured_data = merge_prefilled(prefilled, parsed)
+        key, namespace = partial_structuring_cache_key(cleaned_text, prefilled), "structured_partial"
+    else:
+        structured_data = parsed
+        key, namespace = structuring_cache_key(cleaned_text), "structured"
+    structured_data["Token_Usage"] = token_usage(document["request"], [response_json], cleaned_text)
+    cache_put(namespace, key, structured_data)
+    return structured_data
+
+def ingest(job_dir, job):
+    """Structured records for every prepared document; failed batch lines are extracted interactively."""
+    responses = _batch_responses(job_dir, job)
+    structured_data_list, fallbacks = [], 0
+    for i, document in enumerate(read_jsonl(_documents_path(job_dir))):
+        file_path = document["file_path"]
+        if document.get("result"):
+            structured_data_list.append(dict(document["result"], Name_of_file=os.path.basename(file_path)))
+            continue
+        structured_data = document.get("structured") or _extract_from_response(document, responses.get(str(i)))
+        if not structured_data and document.get("request"):
+            fallbacks += 1
+            prefilled = document.get("prefilled")
+            structured_data = (get_remaining_fields_from_text(document["cleaned_text"], prefilled) if prefilled
+                               else get_structured_data_from_text(document["cleaned_text"]))
+        result = attach_document_fields(structured_data or {}, os.path.basename(file_path), document["page_count"],
+                                        document["raw_text"], document["cleaned_text"], document.get("degraded", False))
+        if result:
+            if not result.get("Cleaning_Fallback"):
+                try:
+                    cache_put("result", result_cache_key(file_path), result)
+                except OSError:
+                    pass
+            structured_data_list.append(result)
+    print(f"Ingested {len(structured_data_list)} documents ({len(responses)} batch results, {fallbacks} interactive fallbacks)")
+    return structured_data_list
+
+def run_offline(paths, job_dir, excel_output):
+    prepare(paths, job_dir)
+    job = write_request_files(job_dir)
+    submit(job_dir, job)
+    poll(job_dir, job)
+    download(job_dir, job)
+    structured_data_list = ingest(job_dir, job)
+    if structured_data_list:
+        os.makedirs(os.path.dirname(excel_output) or ".", exist_ok=True)
+        save_export(structured_data_list, excel_output)
+    else:
+        print("No structured data extracted.")
+    print(f"Rate limiting: {RATE_LIMIT_STATS}")
+
+def main():
+    if len(sys.argv) < 4:
+        print("Usage: python batch_jobs.py <input_folder> <job_dir> <excel_output>")
+        return
+    input_folder, job_dir, excel_output = sys.argv[1:4]
+    paths = [
+        os.path.join(input_folder, f) for f in sorted(os.listdir(input_folder))
+        if os.path.splitext(f)[1].lower() in [".pdf"] + IMAGE_EXTENSIONS
+    ]
+    run_offline(paths, job_dir, excel_output)
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as exc:
+        print(f"Script generated an exception: {exc}")
@@ -0,0 +1,130 @@
+# batch_standin_server.py - local stand-in for the Azure OpenAI files/batches API
+# - Implements only what batch_jobs.py uses: file upload/content, batch create/get
+# - A batch completes on its first poll; every request gets a canned chat completion whose
+#   JSON sets each requested field to "None" (Business_Name carries the custom_id so ingested
+#   rows can be traced back), in JSON or tagged form depending on response_format
+# - Lines whose body contains "FAIL_REQUEST" come back with status 500, to exercise fallbacks
+#
+# Usage: python batch_standin_server.py [port]
+#        BATCH_API_BASE_URL=http://localhost:8765 python batch_jobs.py <input_folder> <job_dir> <excel_output>
+
+import itertools
+import json
+import re
+import sys
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SCHEMA_FIELDS = [
+    "Municipality_Template", "Document_Type", "Page_Count", "Municipality_City", "Business_Owner_Name",
+    "Mayor_Name", "Business_Name", "Business_Address", "Other_Official_Names", "Permit_Number",
+    "Issue_Date", "Business_Permit_Validity", "Business_Type",
+]
+
+FILES = {}
+BATCHES = {}
+_ids = itertools.count(1)
+
+def canned_completion(custom_id, body):
+    schema = ((body.get("response_format") or {}).get("json_schema") or {}).get("schema") or {}
+    fields = list(schema.get("properties") or SCHEMA_FIELDS)
+    answer = {field: "None" for field in fields}
+    if "Business_Name" in answer:
+        answer["Business_Name"] = f"standin-{custom_id}"
+    content = json.dumps(answer)
+    if not schema:
+        content = f"<initial_attempt>\n```json\n{content}\n```\n</initial_attempt>"
+    prompt_tokens = len(json.dumps(body.get("messages"))) // 4
+    completion_tokens = len(content) // 4
+    return {
+        "id": f"chatcmpl-{custom_id}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+def run_batch(batch):
+    output, errors = [], []
+    for line in FILES[batch["input_file_id"]]["content"].decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        if "FAIL_REQUEST" in json.dumps(request["body"]):
+            response = {"status_code": 500, "body": {"error": {"message": "stand-in failure"}}}
+            errors.append({"custom_id": request["custom_id"], "response": response, "error": None})
+            continue
+        response = {"status_code": 200, "body": canned_completion(request["custom_id"], request["body"])}
+        output.append({"custom_id": request["custom_id"], "response": response, "error": None})
+    batch["output_file_id"] = store_file("\n".join(json.dumps(o) for o in output).encode("utf-8"), "batch_output")
+    batch["error_file_id"] = store_file("\n".join(json.dumps(e) for e in errors).encode("utf-8"), "batch_output") if errors else None
+    batch["request_counts"] = {"total": len(output) + len(errors), "completed": len(output), "failed": len(errors)}
+    batch["status"] = "completed"
+
+def store_file(content, purpose):
+    file_id = f"file-{next(_ids)}"
+    FILES[file_id] = {"id": file_id, "object": "file", "purpose": purpose, "bytes": len(content),
+                      "status": "processed", "content": content}
+    return file_id
+
+class Handler(BaseHTTPRequestHandler):
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        if path == "/openai/files":
+            message = BytesParser(policy=HTTP).parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8") + self._body()
+            )
+            parts = {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+            file_id = store_file(parts["file"].get_payload(decode=True), parts["purpose"].get_content().strip())
+            return self._send_json(200, {k: v for k, v in FILES[file_id].items() if k != "content"})
+        if path == "/openai/batches":
+            request = json.loads(self._body())
+            if request.get("input_file_id") not in FILES:
+                return self._send_json(400, {"error": {"message": "unknown input_file_id"}})
+            batch_id = f"batch-{next(_ids)}"
+            BATCHES[batch_id] = dict(request, id=batch_id, object="batch", status="validating",
+                                     created_at=int(time.time()), output_file_id=None, error_file_id=None)
+            return self._send_json(200, BATCHES[batch_id])
+        self._send_json(404, {"error": {"message": f"no route for POST {path}"}})
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        m = re.fullmatch(r"/openai/batches/([^/]+)", path)
+        if m and m.group(1) in BATCHES:
+            batch = BATCHES[m.group(1)]
+            if batch["status"] not in ("completed", "failed"):
+                run_batch(batch)
+            return self._send_json(200, batch)
+        m = re.fullmatch(r"/openai/files/([^/]+)/content", path)
+        if m and m.group(1) in FILES:
+            content = FILES[m.group(1)]["content"]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+        self._send_json(404, {"error": {"message": f"no route for GET {path}"}})
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    print(f"Batch API stand-in listening on http://localhost:{port}")
+    ThreadingHTTPServer(("localhost", port), Handler).serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# bench_preprocess.py - micro-benchmark for preprocess_image (per-page milliseconds)
+# Compares the previous implementation (full-resolution contour sort + Gaussian adaptive
+# threshold) against each PREPROCESS_PROFILES entry in main.py.
+#
+# Usage: python bench_preprocess.py [image_or_pdf_page.png ...]
+# Without arguments synthetic A4 scans at 200 DPI (pdf2image default) and 300 DPI are used
+# (dark scanner border, text-like noise).
+
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# main.py validates credentials at import time; the benchmark never calls the services
+for var in ("AZURE_OPENAI_ENDPOINT", "AZURE_OPENAI_API_KEY", "ADI_ENDPOINT", "ADI_API_KEY"):
+    os.environ.setdefault(var, "unused")
+
+from main import PREPROCESS_PROFILES, preprocess_image
+
+REPEATS = int(os.getenv("BENCH_REPEATS", "10"))
+
+def preprocess_image_legacy(image):
+    open_cv_image = np.array(image)
+    open_cv_image = cv2.cvtColor(open_cv_image, cv2.COLOR_RGB2BGR)
+    gray = cv2.cvtColor(open_cv_image, cv2.COLOR_BGR2GRAY)
+    contours, _ = cv2.findContours(gray, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if contours:
+        cnts_sorted = sorted(contours, key=lambda x: cv2.contourArea(x), reverse=True)
+        cnt = cnts_sorted[0]
+        x, y, w, h = cv2.boundingRect(cnt)
+        gray = gray[y:y+h, x:x+w]
+    _, thresh = cv2.threshold(gray, 200, 235, cv2.THRESH_BINARY)
+    adaptive_thresh = cv2.adaptiveThreshold(
+        thresh, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 21, 5
+    )
+    return Image.fromarray(adaptive_thresh)
+
+def synthetic_page(width=1654, height=2339, seed=0):
+    rng = np.random.default_rng(seed)
+    page = np.full((height, width), 235, dtype=np.uint8)
+    page[:40, :] = page[-40:, :] = 0
+    page[:, :40] = page[:, -40:] = 0
+    for y in range(150, height - 150, 48):
+        for x in range(120, width - 300, 260):
+            cv2.putText(page, "PERMIT NO. 2024", (x + int(rng.integers(0, 20)), y), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 20, 2)
+    noise = rng.integers(0, 25, size=page.shape, dtype=np.uint8)
+    page = cv2.subtract(page, noise)
+    return Image.fromarray(cv2.cvtColor(page, cv2.COLOR_GRAY2RGB))
+
+def time_ms(fn, image):
+    fn(image)  # warm-up
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        fn(image)
+    return (time.perf_counter() - start) * 1000 / REPEATS
+
+def main():
+    pages = [Image.open(p).convert("RGB") for p in sys.argv[1:]] or [synthetic_page(), synthetic_page(2480, 3508)]
+    for page in pages:
+        print(f"page {page.size[0]}x{page.size[1]}, {REPEATS} repeats")
+        baseline = time_ms(preprocess_image_legacy, page)
+        print(f"  {'legacy':<12} {baseline:8.1f} ms/page")
+        for profile in PREPROCESS_PROFILES:
+            ms = time_ms(lambda img: preprocess_image(img, profile), page)
+            print(f"  {profile:<12} {ms:8.1f} ms/page  ({baseline / ms:.1f}x)")
+
+if __name__ == "__main__":
+    main()
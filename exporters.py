@@ -0,0 +1,321 @@
+# exporters.py - export layer shared by the CLI (main.py, async_pipeline.py, batch_jobs.py) and app.py
+# - One mapping (export_frame) from structured records to the UI-aligned export columns,
+#   computed column-at-a-time with pandas over chunks of EXPORT_CHUNK_ROWS records:
+#     Business_Name -> Business_Name_Establishment, Validity_Date always "31-Dec-<year>",
+#     Other_Official_Titles literal "None" when there are no other officials,
+#     Municipality_City_Template falls back to Municipality_City
+# - Selectable writers: xlsx (pandas, or openpyxl write-only), csv, jsonl, parquet (pyarrow);
+#   csv/jsonl/parquet write chunk by chunk so large runs never hold every row at once
+# - include_text=False drops the heavy raw_text/cleaned_text columns
+#
+# Usage: export_records(records, "output/permits.parquet") or export_bytes(records, "csv")
+
+import io
+import json
+import os
+import re
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+EXPORT_COLUMNS = [
+    "Document_Type",
+    "Page_Count",
+    "Name_of_file",
+    "Business_Name_Establishment",
+    "Business_Owner",
+    "Business_Address",
+    "Mayor_Name",
+    "Other_Official_Names",
+    "Other_Official_Titles",
+    "Municipality_City_Template",
+    "Permit_Number",
+    "Issue_Date",
+    "Validity_Date",
+    "Nature_of_Business",
+    "raw_text",
+    "cleaned_text",
+]
+TEXT_COLUMNS = ["raw_text", "cleaned_text"]
+
+EXCEL_WRITE_ONLY = os.getenv("EXCEL_WRITE_ONLY", "0") == "1"
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "10000"))
+
+EXPORT_MIME = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+# ---------- Row mapping ----------
+# Record keys the export columns are built from
+SOURCE_FIELDS = frozenset([
+    "Document_Type", "Page_Count", "Name_of_file", "Business_Name", "Business_Owner_Name", "Business_Address",
+    "Mayor_Name", "Other_Official_Names", "Other_Officials", "Municipality_Template", "Municipality_City",
+    "Permit_Number", "Issue_Date", "Business_Permit_Validity", "Business_Type", "raw_text", "cleaned_text",
+])
+
+# Column-at-a-time pandas operations over a chunk of records instead of a Python loop per row;
+# the regex work runs as pyarrow compute kernels, which pandas' object-dtype .str methods are not
+_YEAR = r"(?:19|20)\d{2}"
+_OFFICIALS = pa.list_(pa.struct([("title", pa.string())]))
+# "Name (Title)" (text between the first "(" and ")"), else "Name - Title"
+_LEGACY_TITLE = r"^(?:[^()]*\((?P<in_parens>[^)]*)\)|.*? - (?P<after_dash>.*))"
+
+def extract_year(s):
+    if not s:
+        return None
+    m = re.search(_YEAR, str(s))
+    return int(m.group(0)) if m else None
+
+def validity_31_dec(issue_date, validity_raw):
+    # Prefer any explicit year from validity, else fall back to Issue_Date year, else current year
+    y = extract_year(validity_raw) or extract_year(issue_date) or datetime.now().year
+    return f"31-Dec-{y}"
+
+def export_columns(include_text=True):
+    return EXPORT_COLUMNS if include_text else [c for c in EXPORT_COLUMNS if c not in TEXT_COLUMNS]
+
+def _column(df, name):
+    return df[name] if name in df.columns else pd.Series(None, index=df.index, dtype=object)
+
+def _text(series):
+    # The dtype scans run in C: a column of strings without gaps is used as is, and only columns
+    # holding non-strings pay for a per-value str()
+    if pd.api.types.infer_dtype(series, skipna=False) == "string":
+        return series
+    series = series.fillna("")
+    return series if pd.api.types.infer_dtype(series) == "string" else series.astype(str)
+
+def flatten_json(nested_json):
+    flat = {}
+    for key, value in nested_json.items():
+        if isinstance(value, dict):
+            for subkey, subvalue in value.items():
+                flat[subkey] = subvalue
+        else:
+            flat[key] = value
+    return flat
+
+def _flatten_records(records):
+    """Frame of records with nested sections (dict values) spread into columns named by their keys, one level deep."""
+    df = pd.DataFrame.from_records(records)
+    nested = np.zeros(len(df), dtype=bool)
+    for column in df.columns:
+        # infer_dtype scans in C; only columns holding containers ("mixed") are checked value by value
+        if pd.api.types.infer_dtype(df[column], skipna=True) != "mixed":
+            continue
+        is_dict = (df[column].map(type) == dict).to_numpy()
+        if not is_dict.any():
+            continue
+        sections = df[column][is_dict]
+        # Sections holding no field the export reads (Token_Usage on every pipeline record) cannot
+        # change a row, so they are left unflattened
+        if SOURCE_FIELDS.isdisjoint(set().union(*sections)):
+            continue
+        nested[is_dict] |= sections.map(lambda section: not SOURCE_FIELDS.isdisjoint(section)).to_numpy(dtype=bool)
+    if not nested.any():
+        return df
+    # Key precedence depends on each record's own key order (later keys win), so only those records are
+    # flattened one by one
+    rows = np.flatnonzero(nested)
+    flat = pd.DataFrame.from_records([flatten_json(records[i]) for i in rows], index=df.index[rows])
+    return pd.concat([df[~nested], flat]).sort_index()
+
+def _page_count(df):
+    pages = _column(df, "Page_Count")
+    # Missing values turn a column of whole page counts into floats; export them as integers again
+    if pd.api.types.is_float_dtype(pages) and (pages.dropna() % 1 == 0).all():
+        pages = pages.astype("Int64")
+    return pages.astype(object).where(pages.notna(), "")
+
+def _strings(series):
+    return pa.array(_text(series), type=pa.string())
+
+def _captures(strings, pattern):
+    """Named groups of pattern's first match per string as object columns; NaN where a group is empty."""
+    captured = pc.extract_regex(strings, pattern)
+    groups = pd.DataFrame({field.name: captured.field(i).to_numpy(zero_copy_only=False)
+                           for i, field in enumerate(captured.type)})
+    return groups.mask(groups == "")
+
+def _join_titles(titles):
+    """Per-record "; "-joined titles (first occurrence order) from a Series indexed by record."""
+    titles = pd.Series(pc.utf8_trim_whitespace(_strings(titles)).to_numpy(zero_copy_only=False), index=titles.index)
+    titles = titles[titles != ""]
+    if titles.empty:
+        return pd.Series(dtype=object)
+    pairs = titles.rename("title").rename_axis("record").reset_index().drop_duplicates()
+    pairs = pairs.sort_values("record", kind="stable")
+    # One list of titles per record, joined by a pyarrow kernel instead of a per-group "; ".join
+    records, starts = np.unique(pairs["record"].to_numpy(), return_index=True)
+    offsets = pa.array(np.append(starts, len(pairs)), type=pa.int32())
+    lists = pa.ListArray.from_arrays(offsets, pa.array(pairs["title"], type=pa.string()))
+    return pd.Series(pc.binary_join(lists, "; ").to_numpy(zero_copy_only=False), index=records)
+
+def _validity_column(issue_date, validity_raw):
+    year = _captures(_strings(validity_raw), rf"(?P<year>{_YEAR})")["year"]
+    # Issue_Date is only searched for the records whose validity gave no year
+    missing = np.flatnonzero(year.isna().to_numpy())
+    if len(missing):
+        year.iloc[missing] = _captures(_strings(issue_date.iloc[missing]), rf"(?P<year>{_YEAR})")["year"].to_numpy()
+    year = year.fillna(str(datetime.now().year))
+    return ("31-Dec-" + year).set_axis(validity_raw.index)
+
+def _list_titles(officials):
+    """Titles of the parsed Other_Officials entries, indexed by record."""
+    try:
+        lists = pa.array(officials, type=_OFFICIALS, from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Malformed entries (non-list values, non-string titles) take the per-value path
+        officials = officials[officials.map(type) == list].explode()
+        return officials[officials.map(type) == dict].str.get("title")
+    titles = pc.struct_field(pc.list_flatten(lists), [0]).to_numpy(zero_copy_only=False)
+    return pd.Series(titles, index=officials.index[pc.list_parent_indices(lists).to_numpy()], dtype=object)
+
+def _official_titles(df):
+    """Titles from the parsed Other_Officials lists, else from the legacy Other_Official_Names string."""
+    names = _strings(_column(df, "Other_Official_Names"))
+    no_names = pc.is_in(pc.utf8_lower(pc.utf8_trim_whitespace(names)), value_set=pa.array(["none", "null", ""]))
+    no_names = no_names.to_numpy(zero_copy_only=False)
+    titles = _join_titles(_list_titles(_column(df, "Other_Officials"))).reindex(df.index)
+
+    # The legacy string is parsed only for records whose list gave no titles
+    legacy_rows = np.flatnonzero(titles.isna().to_numpy() & ~no_names)
+    if len(legacy_rows):
+        parts = pc.split_pattern(names.take(legacy_rows), ";")
+        groups = _captures(pc.utf8_trim_whitespace(pc.list_flatten(parts)), _LEGACY_TITLE)
+        legacy_titles = groups["in_parens"].mask(groups["in_parens"].isna(), groups["after_dash"])
+        legacy_titles.index = df.index[legacy_rows[pc.list_parent_indices(parts).to_numpy()]]
+        titles = titles.mask(titles.isna(), _join_titles(legacy_titles).reindex(df.index))
+
+    # Literal "None" when there are no other officials or no titles could be found
+    return titles.where(~no_names & titles.notna(), "None")
+
+def export_frame(records, include_text=True):
+    """DataFrame of EXPORT_COLUMNS (without the text columns if include_text=False) for a list of records."""
+    df = _flatten_records([r for r in records if r])
+    template, city = _column(df, "Municipality_Template"), _column(df, "Municipality_City")
+    out = pd.DataFrame({
+        "Document_Type": _text(_column(df, "Document_Type")),
+        "Page_Count": _page_count(df),
+        "Name_of_file": _text(_column(df, "Name_of_file")),
+        "Business_Name_Establishment": _text(_column(df, "Business_Name")),
+        "Business_Owner": _text(_column(df, "Business_Owner_Name")),
+        "Business_Address": _text(_column(df, "Business_Address")),
+        "Mayor_Name": _text(_column(df, "Mayor_Name")),
+        "Other_Official_Names": _text(_column(df, "Other_Official_Names")),
+        "Other_Official_Titles": _official_titles(df),
+        "Municipality_City_Template": _text(template.where(_text(template) != "", city)),
+        "Permit_Number": _text(_column(df, "Permit_Number")),
+        "Issue_Date": _text(_column(df, "Issue_Date")),
+        "Validity_Date": _validity_column(_column(df, "Issue_Date"), _column(df, "Business_Permit_Validity")),
+        "Nature_of_Business": _text(_column(df, "Business_Type")),
+        "raw_text": _text(_column(df, "raw_text")),
+        "cleaned_text": _text(_column(df, "cleaned_text")),
+    }, index=df.index)
+    return out[export_columns(include_text)]
+
+def export_frames(records, include_text=True, chunk_rows=None):
+    """export_frame over consecutive chunks of records, so large exports stay bounded in memory."""
+    chunk_rows = chunk_rows or EXPORT_CHUNK_ROWS
+    chunk = []
+    for record in records:
+        if record:
+            chunk.append(record)
+        if len(chunk) >= chunk_rows:
+            yield export_frame(chunk, include_text)
+            chunk = []
+    if chunk:
+        yield export_frame(chunk, include_text)
+
+# ---------- Writers ----------
+# Each writer takes (frames, columns, f): an iterable of export DataFrames and a binary file object
+def write_xlsx(frames, columns, f, write_only=None):
+    if write_only if write_only is not None else EXCEL_WRITE_ONLY:
+        # openpyxl write-only mode streams rows to the sheet, so memory stays flat for large exports
+        from openpyxl import Workbook
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("extracted")
+        ws.append(columns)
+        for df in frames:
+            for row in df.itertuples(index=False, name=None):
+                ws.append(row)
+        wb.save(f)
+        return
+    frames = list(frames)
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+    with pd.ExcelWriter(f, engine="openpyxl") as writer:
+        df.to_excel(writer, index=False, sheet_name="extracted")
+
+def write_csv(frames, columns, f):
+    text = io.TextIOWrapper(f, encoding="utf-8", newline="", write_through=True)
+    header = True
+    for df in frames:
+        df.to_csv(text, index=False, header=header)
+        header = False
+    if header:
+        pd.DataFrame(columns=columns).to_csv(text, index=False)
+    text.detach()
+
+def write_jsonl(frames, columns, f):
+    # json's C encoder handles the long text columns faster than DataFrame.to_json
+    encode = json.JSONEncoder(ensure_ascii=False, default=str).encode
+    for df in frames:
+        keys = list(df.columns)
+        f.write("".join(encode(dict(zip(keys, row))) + "\n" for row in df.itertuples(index=False, name=None)).encode("utf-8"))
+
+def _parquet_schema(columns, page_count_type):
+    return pa.schema([(c, page_count_type if c == "Page_Count" else pa.string()) for c in columns])
+
+def write_parquet(frames, columns, f):
+    writer = schema = None
+    try:
+        for df in frames:
+            df = df.replace("", None)
+            pages = pd.to_numeric(df["Page_Count"], errors="coerce")
+            whole = pages.isna() | (pages % 1 == 0)
+            if writer is None:
+                # Page counts are integers unless the first chunk already holds a fractional one (a
+                # model-returned 2.5); the schema is fixed once the first row group is written
+                schema = _parquet_schema(columns, pa.int64() if whole.all() else pa.float64())
+                writer = pq.ParquetWriter(f, schema)
+            if schema.field("Page_Count").type == pa.int64():
+                if not whole.all():
+                    print(f"Page_Count {', '.join(map(str, pages[~whole].unique()))} is not a whole number; "
+                          "written as null")
+                pages = pages.where(whole).astype("Int64")
+            df["Page_Count"] = pages
+            writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+        if writer is None:
+            writer = pq.ParquetWriter(f, _parquet_schema(columns, pa.int64()))
+    finally:
+        if writer is not None:
+            writer.close()
+
+WRITERS = {"xlsx": write_xlsx, "csv": write_csv, "jsonl": write_jsonl, "parquet": write_parquet}
+
+def export_format(path):
+    fmt = os.path.splitext(path)[1].lstrip(".").lower()
+    return "xlsx" if fmt in ("", "xls") else fmt
+
+# ---------- Entry points ----------
+def write_records(records, f, fmt="xlsx", include_text=True):
+    if fmt not in WRITERS:
+        raise ValueError(f"Unsupported export format: {fmt}")
+    WRITERS[fmt](export_frames(records, include_text), export_columns(include_text), f)
+
+def export_records(records, output_path, fmt=None, include_text=True):
+    """Write records to output_path; the format defaults to the file extension."""
+    with open(output_path, "wb") as f:
+        write_records(records, f, fmt or export_format(output_path), include_text)
+
+def export_bytes(records, fmt="xlsx", include_text=True):
+    buf = io.BytesIO()
+    write_records(records, buf, fmt, include_text)
+    return buf.getvalue()
@@ -0,0 +1,195 @@
+# job_queue.py - SQLite-backed document job queue shared by the app and worker.py
+# - One row per file path; enqueueing is idempotent for an unchanged file signature, so every
+#   Streamlit rerun (and every app replica) can enqueue without duplicating work
+# - Workers claim jobs atomically (BEGIN IMMEDIATE), so any number of worker processes can
+#   share the queue; a running job whose lease expired (worker died) is handed out again, or
+#   failed once it has used JOB_MAX_ATTEMPTS. Worker heartbeats renew the leases of their jobs,
+#   but only for JOB_MAX_SECONDS per attempt, so a document that hangs a thread is reclaimed too
+# - The queue lives on disk, so processing continues across browser refreshes and app restarts
+# - Finished rows double as the app's shared result store: every session and replica reads
+#   results (and reviewer edits) from here, one document at a time, instead of holding them all
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", os.path.join("cache", "jobs.sqlite"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "900"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_MAX_SECONDS = float(os.getenv("JOB_MAX_SECONDS", "3600"))
+WORKER_STALE_SECONDS = float(os.getenv("WORKER_STALE_SECONDS", "30"))
+
+_local = threading.local()
+
+def _conn():
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        os.makedirs(os.path.dirname(JOB_QUEUE_PATH) or ".", exist_ok=True)
+        conn = sqlite3.connect(JOB_QUEUE_PATH, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " file_path TEXT PRIMARY KEY, sig TEXT, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,"
+            " error TEXT, result TEXT, worker TEXT, enqueued_at REAL, started_at REAL, finished_at REAL,"
+            " heartbeat_at REAL)"
+        )
+        if "heartbeat_at" not in {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}:
+            try:
+                conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat_at REAL")
+            except sqlite3.OperationalError:
+                pass  # added by another process meanwhile
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, enqueued_at)")
+        conn.execute("CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, last_seen REAL NOT NULL)")
+        _local.conn = conn
+    return conn
+
+def _sig(sig):
+    return json.dumps(list(sig)) if sig is not None else None
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def enqueue(file_path, sig, force=False):
+    """Queue file_path unless a job for the same signature is already queued, running or finished."""
+    now = time.time()
+    conn = _conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT sig, status FROM jobs WHERE file_path = ?", (file_path,)).fetchone()
+        if row is None:
+            conn.execute(
+                "INSERT INTO jobs (file_path, sig, status, enqueued_at) VALUES (?, ?, 'queued', ?)",
+                (file_path, _sig(sig), now),
+            )
+        elif force or row["sig"] != _sig(sig):
+            conn.execute(
+                "UPDATE jobs SET sig = ?, status = 'queued', attempts = 0, error = NULL, result = NULL,"
+                " worker = NULL, enqueued_at = ?, started_at = NULL, finished_at = NULL, heartbeat_at = NULL"
+                " WHERE file_path = ?",
+                (_sig(sig), now, file_path),
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def claim_job(worker):
+    """Oldest queued job (or a running one whose lease expired) as (file_path, sig), or None."""
+    now = time.time()
+    conn = _conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # A document that keeps killing or hanging its worker (crash, OOM) must not be retried for ever
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', finished_at = ?,"
+            " error = 'Worker stopped responding while processing this document.'"
+            " WHERE status = 'running' AND COALESCE(heartbeat_at, started_at) < ? AND attempts >= ?",
+            (now, now - JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS),
+        )
+        row = conn.execute(
+            "SELECT file_path, sig FROM jobs WHERE status = 'queued'"
+            " OR (status = 'running' AND COALESCE(heartbeat_at, started_at) < ?) ORDER BY enqueued_at LIMIT 1",
+            (now - JOB_LEASE_SECONDS,),
+        ).fetchone()
+        if row is not None:
+            conn.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, started_at = ?, heartbeat_at = ?,"
+                " attempts = attempts + 1 WHERE file_path = ?",
+                (worker, now, now, row["file_path"]),
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return (row["file_path"], row["sig"]) if row is not None else None
+
+def complete_job(file_path, sig, result):
+    # Matching on sig drops the result of a run that was superseded by a re-upload meanwhile
+    _conn().execute(
+        "UPDATE jobs SET status = 'done', result = ?, error = NULL, finished_at = ?"
+        " WHERE file_path = ? AND sig IS ? AND status = 'running'",
+        (json.dumps(result, ensure_ascii=False), time.time(), file_path, sig),
+    )
+
+def fail_job(file_path, sig, error):
+    """Requeue the job until it has used JOB_MAX_ATTEMPTS, then mark it failed."""
+    _conn().execute(
+        "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END,"
+        " error = ?, finished_at = ? WHERE file_path = ? AND sig IS ? AND status = 'running'",
+        (JOB_MAX_ATTEMPTS, error, time.time(), file_path, sig),
+    )
+
+def job_statuses(file_paths):
+    """file_path -> {"sig", "status", "attempts", "error", "finished_at"} for the queued paths (no results)."""
+    statuses = {}
+    paths = list(file_paths)
+    for start in range(0, len(paths), 500):
+        chunk = paths[start:start + 500]
+        rows = _conn().execute(
+            "SELECT file_path, sig, status, attempts, error, finished_at FROM jobs"
+            f" WHERE file_path IN ({','.join('?' * len(chunk))})",
+            chunk,
+        ).fetchall()
+        for row in rows:
+            status = dict(row)
+            status["sig"] = tuple(json.loads(row["sig"])) if row["sig"] else None
+            statuses[status.pop("file_path")] = status
+    return statuses
+
+def job_result(file_path):
+    row = _conn().execute("SELECT result FROM jobs WHERE file_path = ? AND status = 'done'", (file_path,)).fetchone()
+    return json.loads(row["result"]) if row and row["result"] else None
+
+def job_results(file_paths):
+    """(file_path, result) for every finished job among file_paths, read in chunks."""
+    paths = list(file_paths)
+    for start in range(0, len(paths), 500):
+        chunk = paths[start:start + 500]
+        rows = _conn().execute(
+            f"SELECT file_path, result FROM jobs WHERE status = 'done' AND file_path IN ({','.join('?' * len(chunk))})",
+            chunk,
+        ).fetchall()
+        for row in rows:
+            if row["result"]:
+                yield row["file_path"], json.loads(row["result"])
+
+def save_result(file_path, result):
+    """Store an edited result for a finished job; the job keeps its signature so it is not reprocessed."""
+    _conn().execute(
+        "UPDATE jobs SET result = ?, finished_at = ? WHERE file_path = ? AND status = 'done'",
+        (json.dumps(result, ensure_ascii=False), time.time(), file_path),
+    )
+
+def retry_jobs(file_paths):
+    """Queue the failed jobs among file_paths again with a fresh set of attempts."""
+    paths = list(file_paths)
+    for start in range(0, len(paths), 500):
+        chunk = paths[start:start + 500]
+        _conn().execute(
+            "UPDATE jobs SET status = 'queued', attempts = 0, error = NULL, worker = NULL, enqueued_at = ?,"
+            " started_at = NULL, finished_at = NULL, heartbeat_at = NULL"
+            f" WHERE status = 'failed' AND file_path IN ({','.join('?' * len(chunk))})",
+            [time.time()] + chunk,
+        )
+
+def heartbeat(worker):
+    """Record the worker as alive and renew the lease on the jobs it has been running for under JOB_MAX_SECONDS."""
+    now = time.time()
+    conn = _conn()
+    conn.execute("INSERT OR REPLACE INTO workers (worker, last_seen) VALUES (?, ?)", (worker, now))
+    # Past the deadline the lease runs out, so a hung attempt is reclaimed (and capped) like a dead worker's
+    conn.execute(
+        "UPDATE jobs SET heartbeat_at = ? WHERE worker = ? AND status = 'running' AND started_at >= ?",
+        (now, worker, now - JOB_MAX_SECONDS),
+    )
+
+def active_workers():
+    row = _conn().execute(
+        "SELECT COUNT(*) FROM workers WHERE last_seen >= ?", (time.time() - WORKER_STALE_SECONDS,)
+    ).fetchone()
+    return row[0]
@@ -0,0 +1,96 @@
+# json_repair.py - tolerant JSON parsing for LLM responses
+# - Finds the JSON object in a response (<initial_attempt> block, ```json fence or bare text)
+# - Single incremental pass that stops at the end of the first complete object, so trailing
+#   wrapper text (</initial_attempt>, <answer> ...) is ignored
+# - Local repairs instead of another round trip: trailing commas, raw newlines/tabs inside
+#   strings, and truncated output (open strings, dangling keys, unclosed brackets)
+
+import json
+import re
+
+_INITIAL_ATTEMPT = re.compile(r"<initial_attempt>(.*?)(?:</initial_attempt>|$)", re.DOTALL)
+_FENCE = re.compile(r"```(?:json)?(.*?)(?:```|$)", re.DOTALL)
+_STRING_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t"}
+
+def json_fragment(text):
+    """Text from the first "{" of the most specific JSON-bearing section, or None."""
+    for pattern in (_INITIAL_ATTEMPT, _FENCE):
+        m = pattern.search(text)
+        if m and "{" in m.group(1):
+            text = m.group(1)
+            break
+    start = text.find("{")
+    return text[start:] if start >= 0 else None
+
+def _strip_trailing_comma(out):
+    while out and (out[-1].isspace() or out[-1] == ","):
+        out.pop()
+
+def repair_json(fragment):
+    stack, out = [], []
+    in_string = escaped = string_is_key = expect_key = key_pending = False
+    for ch in fragment:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+                key_pending = string_is_key
+            elif ch in _STRING_ESCAPES:
+                ch = _STRING_ESCAPES[ch]
+            out.append(ch)
+            continue
+        if ch == '"':
+            in_string, string_is_key = True, bool(stack) and stack[-1] == "{" and expect_key
+        elif ch in "{[":
+            stack.append(ch)
+            expect_key = ch == "{"
+        elif ch in "}]":
+            _strip_trailing_comma(out)
+            if key_pending or (out and out[-1] == ":"):
+                out.append(": null" if key_pending else " null")
+                key_pending = False
+            if not stack:
+                break
+            out.append("}" if stack.pop() == "{" else "]")
+            expect_key = False
+            if not stack:
+                return "".join(out)
+            continue
+        elif ch == ":":
+            key_pending = expect_key = False
+        elif ch == ",":
+            expect_key = bool(stack) and stack[-1] == "{"
+        out.append(ch)
+
+    # Truncated: close whatever is still open
+    if in_string:
+        if escaped:
+            out.pop()
+        out.append('"')
+        key_pending = string_is_key
+    _strip_trailing_comma(out)
+    if key_pending:
+        out.append(": null")
+    elif out and out[-1] == ":":
+        out.append(" null")
+    while stack:
+        _strip_trailing_comma(out)
+        out.append("}" if stack.pop() == "{" else "]")
+    return "".join(out)
+
+def parse_json_tolerant(text):
+    """First JSON object in an LLM response, repaired if needed; None if there is none."""
+    fragment = json_fragment(text or "")
+    if fragment is None:
+        return None
+    for candidate in (fragment.strip(), repair_json(fragment)):
+        try:
+            parsed = json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(parsed, dict):
+            return parsed
+    return None
@@ -7,6 +7,8 @@
 # - Ensured Validity_Date is always "31-Dec-<year>" (never "[unclear]") using validity year if present, else Issue_Date year, else current year
 
 import concurrent.futures
+import functools
+import multiprocessing
 import base64
 import os
 import requests
@@ -14,19 +16,35 @@ import csv
 import json
 from mimetypes import guess_type
 from dotenv import load_dotenv
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
 from datetime import datetime
 import re
 import cv2
 import numpy as np
 from PIL import Image
 from io import BytesIO
-import pandas as pd
-import openpyxl
 import time
 from azure.ai.formrecognizer import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import RequestsTransport
+from requests.adapters import HTTPAdapter
 import io
+import hashlib
+import sqlite3
+import threading
+import math
+import random
+from exporters import export_records
+from json_repair import parse_json_tolerant
+from template_extractors import (
+    DEFAULT_LABELS,
+    SCHEMA_FIELDS,
+    TEMPLATES_VERSION,
+    extract_template_fields,
+    fields_from_key_values,
+    match_template,
+    missing_required_fields,
+)
 
 load_dotenv()
 
@@ -47,29 +65,466 @@ headers = {
     "api-key": api_key
 }
 
+# --------------------- Rate Limiting ---------------------
+# Shared token buckets for the OpenAI deployment (requests + tokens per minute) and ADI
+# (transactions per second). Every call reserves budget before it is sent, so the batch
+# drivers can run many workers and still stay under quota; 429/5xx responses are retried
+# honouring Retry-After, else with jittered exponential backoff.
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "60"))
+OPENAI_TPM = float(os.getenv("OPENAI_TPM", "80000"))
+ADI_TPS = float(os.getenv("ADI_TPS", "15"))
+MAX_RETRIES = int(os.getenv("MAX_RETRIES", "6"))
+BACKOFF_BASE_SECONDS = float(os.getenv("BACKOFF_BASE_SECONDS", "2"))
+BACKOFF_MAX_SECONDS = float(os.getenv("BACKOFF_MAX_SECONDS", "60"))
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+class TokenBucket:
+    """Thread-safe token bucket. reserve() debits immediately and returns how long to wait."""
+
+    def __init__(self, rate_per_second, capacity):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= min(amount, self.capacity)
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self, amount):
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+# Capacity is ten seconds' worth of budget, matching how Azure enforces per-minute quotas
+openai_request_bucket = TokenBucket(OPENAI_RPM / 60, max(1, OPENAI_RPM / 6))
+openai_token_bucket = TokenBucket(OPENAI_TPM / 60, max(1, OPENAI_TPM / 6))
+adi_request_bucket = TokenBucket(ADI_TPS, max(1, ADI_TPS))
+
+RATE_LIMIT_STATS = {"throttled_seconds": 0.0, "retries": 0, "rate_limited": 0, "gave_up": 0}
+_stats_lock = threading.Lock()
+
+def record_stat(stat, amount=1, stats=None):
+    stats = RATE_LIMIT_STATS if stats is None else stats
+    with _stats_lock:
+        stats[stat] = stats.get(stat, 0) + amount
+
+def estimate_tokens(text):
+    # ~4 characters per token for GPT-4-family tokenizers on mostly-English text
+    return math.ceil(len(text or "") / 4)
+
+def estimate_request_tokens(data):
+    # Azure counts prompt tokens plus max_tokens against TPM; images billed at a flat
+    # high-detail estimate
+    chars, images = 0, 0
+    for message in data.get("messages", []):
+        content = message.get("content")
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content or ""}]
+        for part in parts:
+            if part.get("type") == "image_url":
+                images += 1
+            else:
+                chars += len(part.get("text") or "")
+    return math.ceil(chars / 4) + images * 765 + data.get("max_tokens", 0)
+
+def prompt_tokens_estimate(data):
+    return estimate_request_tokens(data) - data.get("max_tokens", 0)
+
+def openai_wait_seconds(data):
+    """Reserve OpenAI budget for one request; returns (seconds to wait, reserved tokens)."""
+    tokens = estimate_request_tokens(data)
+    wait = max(openai_request_bucket.reserve(1), openai_token_bucket.reserve(tokens))
+    if wait:
+        record_stat("throttled_seconds", wait)
+    return wait, tokens
+
+def settle_openai_tokens(reserved, response_json):
+    # Give back whatever part of the max_tokens reservation the completion did not use; a request
+    # that produced no completion (throttled, rejected, failed in transit) gives back all of it
+    if response_json is None:
+        openai_token_bucket.refund(reserved)
+        return
+    used = ((response_json or {}).get("usage") or {}).get("total_tokens")
+    if used is not None and reserved > used:
+        openai_token_bucket.refund(reserved - used)
+
+# Provider-side prompt caching: usage.prompt_tokens_details.cached_tokens reports how much of
+# each prompt was served from the cache
+PROMPT_CACHE_STATS = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0}
+
+def record_prompt_cache(response_json):
+    usage = (response_json or {}).get("usage") or {}
+    record_stat("requests", stats=PROMPT_CACHE_STATS)
+    record_stat("prompt_tokens", usage.get("prompt_tokens") or 0, stats=PROMPT_CACHE_STATS)
+    record_stat("cached_tokens", cached_prompt_tokens(response_json), stats=PROMPT_CACHE_STATS)
+
+def cached_prompt_tokens(response_json):
+    usage = (response_json or {}).get("usage") or {}
+    return (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+
+def prompt_cache_report():
+    prompt_tokens, cached = PROMPT_CACHE_STATS["prompt_tokens"], PROMPT_CACHE_STATS["cached_tokens"]
+    share = cached / prompt_tokens if prompt_tokens else 0.0
+    return (f"{cached}/{prompt_tokens} prompt tokens cached ({share:.0%}), "
+            f"{prompt_tokens - cached} uncached over {PROMPT_CACHE_STATS['requests']} requests")
+
+def adi_wait_seconds():
+    wait = adi_request_bucket.reserve(1)
+    if wait:
+        record_stat("throttled_seconds", wait)
+    return wait
+
+def retry_delay(response_headers, attempt):
+    """Server-requested delay (Retry-After / retry-after-ms) if present, else jittered exponential backoff."""
+    response_headers = response_headers or {}
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = response_headers.get(name)
+        if value:
+            try:
+                return min(BACKOFF_MAX_SECONDS, float(value) * scale)
+            except ValueError:
+                pass
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+def sustainable_workers():
+    # Little's law: in-flight documents = document rate x document latency. Each document
+    # makes two OpenAI calls, so the RPM/TPM budgets bound the sustainable document rate.
+    docs_per_second = min(OPENAI_RPM / 2, OPENAI_TPM / 16000) / 60
+    latency = float(os.getenv("DOCUMENT_LATENCY_SECONDS", "30"))
+    return max(1, min(64, math.ceil(docs_per_second * latency)))
+
+# --------------------- Shared Clients ---------------------
+# Long-lived ADI client and pooled HTTP session, shared by all worker threads so calls reuse
+# keep-alive connections instead of paying a TLS handshake each time.
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS") or sustainable_workers())
+ADI_MAX_CONCURRENCY = int(os.getenv("ADI_MAX_CONCURRENCY", "8"))
+# Each document fans out up to OCR_PAGE_WORKERS page calls (OCR and per-page cleaning), so the
+# session can have PIPELINE_WORKERS x OCR_PAGE_WORKERS chat requests in flight at once
+OCR_PAGE_WORKERS = int(os.getenv("OCR_PAGE_WORKERS", "4"))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", str(PIPELINE_WORKERS * OCR_PAGE_WORKERS)))
+
+_clients_lock = threading.Lock()
+_adi_client = None
+_http_session = None
+
+def _pooled_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def get_adi_client():
+    global _adi_client
+    if _adi_client is None:
+        with _clients_lock:
+            if _adi_client is None:
+                transport = RequestsTransport(session=_pooled_session(ADI_MAX_CONCURRENCY), session_owner=False)
+                # The SDK's RetryPolicy already honours Retry-After on 429/5xx; align it with our limits
+                _adi_client = DocumentAnalysisClient(
+                    endpoint=adi_endpoint, credential=AzureKeyCredential(adi_api_key), transport=transport,
+                    retry_total=MAX_RETRIES, retry_backoff_factor=BACKOFF_BASE_SECONDS,
+                    retry_backoff_max=BACKOFF_MAX_SECONDS,
+                )
+    return _adi_client
+
+def get_http_session():
+    global _http_session
+    if _http_session is None:
+        with _clients_lock:
+            if _http_session is None:
+                session = _pooled_session(HTTP_POOL_SIZE)
+                session.headers.update(headers)
+                _http_session = session
+    return _http_session
+
+def post_chat_completion(data):
+    """POST to the OpenAI deployment within the shared budget, retrying throttling and transient errors."""
+    for attempt in range(MAX_RETRIES + 1):
+        wait, reserved = openai_wait_seconds(data)
+        response_json = None
+        try:
+            time.sleep(wait)
+            try:
+                response = get_http_session().post(endpoint, json=data)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt == MAX_RETRIES:
+                    record_stat("gave_up")
+                    raise
+                print(f"OpenAI request failed ({e}); retrying")
+                record_stat("retries")
+                time.sleep(retry_delay(None, attempt))
+                continue
+            if response.status_code == 429:
+                record_stat("rate_limited")
+            if response.status_code in RETRYABLE_STATUS and attempt < MAX_RETRIES:
+                record_stat("retries")
+                delay = retry_delay(response.headers, attempt)
+                print(f"OpenAI returned {response.status_code}; retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            if response.status_code in RETRYABLE_STATUS:
+                record_stat("gave_up")
+            response.raise_for_status()
+            response_json = response.json()
+        finally:
+            # Every attempt settles its own reservation, whichever way it ends
+            settle_openai_tokens(reserved, response_json)
+        record_prompt_cache(response_json)
+        return response_json
+
+# --------------------- Prompts ---------------------
+# Prompts live in versioned template files (prompts/<version>/) and are read once at import,
+# so every request in a batch sends a byte-identical static prefix (system prompt and fixed
+# instructions first, per-document text last) and hits the provider's prompt cache.
+# Add a new version directory instead of editing a released one.
+PROMPTS_DIR = os.getenv("PROMPTS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts"))
+PROMPT_VERSION = os.getenv("PROMPT_VERSION", "v1")
+
+def load_prompt(name):
+    with open(os.path.join(PROMPTS_DIR, PROMPT_VERSION, name), encoding="utf-8") as f:
+        return f.read().rstrip("\n")
+
+CLEANING_SYSTEM_PROMPT = load_prompt("cleaning_system.txt")
+STRUCTURING_SYSTEM_PROMPT = load_prompt("structuring_task.txt") + "\n\n" + load_prompt("structuring_steps_tags.txt")
+STRUCTURING_USER_INSTRUCTION = load_prompt("structuring_user.txt")
+
+# Used when some fields were already resolved from ADI key-value pairs: only the rules for the
+# unresolved fields are sent, instead of the full structuring prompt.
+PARTIAL_STRUCTURING_SYSTEM_PROMPT = load_prompt("partial_structuring_system.txt") + "\n\n" + load_prompt("partial_output_tags.txt")
+FIELD_RULES = json.loads(load_prompt("field_rules.json"))
+
+# Structured-output mode: same task, but the answer is constrained by a json_schema
+# response_format, so no <initial_attempt>/<answer> wrappers are requested or paid for
+STRUCTURING_JSON_SYSTEM_PROMPT = load_prompt("structuring_task.txt") + "\n\n" + load_prompt("structuring_steps_json.txt")
+STRUCTURING_JSON_USER_INSTRUCTION = load_prompt("structuring_user_json.txt")
+PARTIAL_STRUCTURING_JSON_SYSTEM_PROMPT = load_prompt("partial_structuring_system.txt") + "\n\n" + load_prompt("partial_output_json.txt")
+
+# Batched extraction: the same task applied to several delimited documents in one request
+STRUCTURING_BATCH_SYSTEM_PROMPT = load_prompt("structuring_task.txt") + "\n\n" + load_prompt("structuring_batch_steps_tags.txt")
+STRUCTURING_BATCH_JSON_SYSTEM_PROMPT = load_prompt("structuring_task.txt") + "\n\n" + load_prompt("structuring_batch_steps_json.txt")
+STRUCTURING_BATCH_USER_INSTRUCTION = load_prompt("structuring_batch_user.txt")
+
+# --------------------- Persistent Result Cache ---------------------
+# Results are keyed by SHA-256 of the file bytes plus a fingerprint of the pipeline
+# (version + prompts + endpoint + every setting that changes results), so renamed re-uploads,
+# restarts and other users all hit.
+# Bump PIPELINE_VERSION whenever processing logic changes in a way that alters results.
+PIPELINE_VERSION = "3"
+TEMPLATE_EXTRACTION = os.getenv("TEMPLATE_EXTRACTION", "1") != "0"
+KV_PREFILL = os.getenv("KV_PREFILL", "1") != "0"
+STRUCTURING_TRIM_BOILERPLATE = os.getenv("STRUCTURING_TRIM_BOILERPLATE", "0") == "1"
+STRUCTURED_OUTPUT = os.getenv("STRUCTURED_OUTPUT", "1") != "0"
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE", "1") != "0"
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "cache")
+RESULT_CACHE_PATH = os.path.join(RESULT_CACHE_DIR, "results.sqlite")
+RESULT_CACHE_MAX_BYTES = int(float(os.getenv("RESULT_CACHE_MAX_MB", "512")) * 1024 * 1024)
+
+_cache_local = threading.local()
+_cache_evict_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=None)
+def pipeline_fingerprint():
+    # Computed on first use: several of the settings it covers are defined further down
+    h = hashlib.sha256()
+    for part in (PIPELINE_VERSION, TEMPLATES_VERSION, str(TEMPLATE_EXTRACTION), endpoint,
+                 PREPROCESS_PROFILE, str(OCR_NATIVE_PDF), OCR_PDF_PAGES or "",
+                 str(OCR_SKIP_CLEANING_CONFIDENCE), str(OCR_TEXT_ONLY_CLEANING_CONFIDENCE),
+                 CLEANING_MODE, str(CLEANING_IMAGE_BUDGET_BYTES), str(CLEANING_THUMBNAIL_MAX_SIDE),
+                 CLEANING_SYSTEM_PROMPT, STRUCTURING_SYSTEM_PROMPT, STRUCTURING_USER_INSTRUCTION,
+                 str(KV_PREFILL), str(KV_MIN_CONFIDENCE), str(STRUCTURING_TRIM_BOILERPLATE),
+                 PARTIAL_STRUCTURING_SYSTEM_PROMPT, json.dumps(FIELD_RULES, sort_keys=True),
+                 str(STRUCTURED_OUTPUT), STRUCTURING_JSON_SYSTEM_PROMPT, STRUCTURING_JSON_USER_INSTRUCTION,
+                 PARTIAL_STRUCTURING_JSON_SYSTEM_PROMPT, str(STRUCTURING_BATCH), STRUCTURING_BATCH_SYSTEM_PROMPT,
+                 STRUCTURING_BATCH_JSON_SYSTEM_PROMPT, STRUCTURING_BATCH_USER_INSTRUCTION):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+def _cache_conn():
+    # One connection per thread; WAL lets readers and a writer work concurrently across processes
+    conn = getattr(_cache_local, "conn", None)
+    if conn is None:
+        os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+        conn = sqlite3.connect(RESULT_CACHE_PATH, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+            " size INTEGER NOT NULL, last_access REAL NOT NULL,"
+            " PRIMARY KEY (namespace, key))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+        conn.commit()
+        _cache_local.conn = conn
+    return conn
+
+def cache_get(namespace, key):
+    if not RESULT_CACHE_ENABLED:
+        return None
+    try:
+        conn = _cache_conn()
+        row = conn.execute("SELECT value FROM entries WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE entries SET last_access = ? WHERE namespace = ? AND key = ?", (time.time(), namespace, key))
+        conn.commit()
+        return json.loads(row[0])
+    except Exception as e:
+        print(f"Result cache read error: {e}")
+        return None
+
+def cache_put(namespace, key, value):
+    if not RESULT_CACHE_ENABLED:
+        return
+    try:
+        payload = json.dumps(value, ensure_ascii=False)
+        conn = _cache_conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO entries (namespace, key, value, size, last_access) VALUES (?, ?, ?, ?, ?)",
+            (namespace, key, payload, len(payload.encode("utf-8")), time.time()),
+        )
+        conn.commit()
+        _cache_evict(conn)
+    except Exception as e:
+        print(f"Result cache write error: {e}")
+
+def _cache_evict(conn):
+    # Size-bounded LRU: drop least recently used entries until the store fits the budget
+    with _cache_evict_lock:
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= RESULT_CACHE_MAX_BYTES:
+            return
+        rows = conn.execute("SELECT namespace, key, size FROM entries ORDER BY last_access ASC").fetchall()
+        stale = []
+        for namespace, key, size in rows:
+            if total <= RESULT_CACHE_MAX_BYTES:
+                break
+            stale.append((namespace, key))
+            total -= size
+        conn.executemany("DELETE FROM entries WHERE namespace = ? AND key = ?", stale)
+        conn.commit()
+
+def file_sha256(file_path):
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def result_cache_key(file_path):
+    return f"{file_sha256(file_path)}:{pipeline_fingerprint()}"
+
+def stage_key(*parts):
+    # Per-stage memo key: hash of the stage's inputs plus whatever prompt/model configures it
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode("utf-8") if isinstance(part, str) else part)
+        h.update(b"\0")
+    return h.hexdigest()
+
+def cached_process(file_path, process_fn):
+    """Return the cached result for file_path's content, else run process_fn(file_path) and store it."""
+    try:
+        key = result_cache_key(file_path)
+    except OSError as e:
+        print(f"Result cache key error: {e}")
+        return process_fn(file_path)
+    cached = cache_get("result", key)
+    if cached:
+        print(f"Result cache hit: {os.path.basename(file_path)}")
+        cached["Name_of_file"] = os.path.basename(file_path)
+        return cached
+    result = process_fn(file_path)
+    if result and result.get("Cleaning_Fallback"):
+        print(f"OCR cleaning failed for {os.path.basename(file_path)}; result not cached")
+    elif result:
+        cache_put("result", key, result)
+    return result
+
 # --------------------- Image Preprocessing Functions ---------------------
+# Pages are rasterized a small window at a time so peak memory per document stays roughly
+# constant regardless of page count (a 40-page scan no longer sits in RAM all at once).
+PDF_RASTER_WINDOW = max(1, int(os.getenv("PDF_RASTER_WINDOW", "1")))
+
+def pdf_page_count(pdf_path):
+    return int(pdfinfo_from_path(pdf_path)["Pages"])
+
+def iter_pdf_pages(pdf_path, window=PDF_RASTER_WINDOW):
+    """Yield (page_number, PIL image) one page at a time, rasterizing `window` pages per call."""
+    page_count = pdf_page_count(pdf_path)
+    for first_page in range(1, page_count + 1, window):
+        last_page = min(page_count, first_page + window - 1)
+        images = convert_from_path(pdf_path, first_page=first_page, last_page=last_page)
+        for offset, image in enumerate(images):
+            yield first_page + offset, image
+        del images
+
+def _pdf_page_path(pdf_path, output_folder, page_number):
+    return os.path.join(output_folder, f"{os.path.splitext(os.path.basename(pdf_path))[0]}_page_{page_number}.png")
+
+def _processed_image_path(image_path, output_folder):
+    return os.path.join(output_folder, f"{os.path.splitext(os.path.basename(image_path))[0]}_processed.png")
+
 def convert_pdf_to_images(pdf_path, output_folder):
-    images = convert_from_path(pdf_path)
+    # File-based API for callers outside the pipeline, which renders via render_pdf_pages instead
     image_paths = []
-    for i, image in enumerate(images):
-        image_path = os.path.join(output_folder, f"{os.path.splitext(os.path.basename(pdf_path))[0]}_page_{i + 1}.png")
+    for page_number, image in iter_pdf_pages(pdf_path):
+        image_path = _pdf_page_path(pdf_path, output_folder, page_number)
         image.save(image_path, "PNG")
+        image.close()
         image_paths.append(image_path)
-    return image_paths, len(images)
-
-def preprocess_image(image):
-    open_cv_image = np.array(image)
-    open_cv_image = cv2.cvtColor(open_cv_image, cv2.COLOR_RGB2BGR)
-    gray = cv2.cvtColor(open_cv_image, cv2.COLOR_BGR2GRAY)
-    contours, _ = cv2.findContours(gray, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    if contours:
-        cnts_sorted = sorted(contours, key=lambda x: cv2.contourArea(x), reverse=True)
-        cnt = cnts_sorted[0]
-        x, y, w, h = cv2.boundingRect(cnt)
+    return image_paths, len(image_paths)
+
+# Preprocessing profiles. ADI reads 200-DPI pages fine well below full scan resolution, so
+# "fast"/"balanced" cap the working size; "max_quality" keeps full resolution.
+PREPROCESS_PROFILES = {
+    "fast": {"max_side": 1600, "adaptive_method": cv2.ADAPTIVE_THRESH_MEAN_C},
+    "balanced": {"max_side": 2400, "adaptive_method": cv2.ADAPTIVE_THRESH_GAUSSIAN_C},
+    "max_quality": {"max_side": None, "adaptive_method": cv2.ADAPTIVE_THRESH_GAUSSIAN_C},
+}
+PREPROCESS_PROFILE = os.getenv("PREPROCESS_PROFILE", "balanced")
+CROP_DETECT_MAX_SIDE = 800
+
+def _largest_region(gray):
+    """Bounding box (x, y, w, h) of the largest external region, found on a small binarized copy."""
+    h, w = gray.shape[:2]
+    step = max(1, -(-max(h, w) // CROP_DETECT_MAX_SIDE))
+    # Strided subsampling is a near-free view; same foreground rule as before (any non-zero pixel)
+    _, mask = cv2.threshold(np.ascontiguousarray(gray[::step, ::step]), 0, 255, cv2.THRESH_BINARY)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+    x, y, bw, bh = cv2.boundingRect(max(contours, key=cv2.contourArea))
+    # Map back to full resolution, padding by one sample to avoid clipping the edge
+    x0, y0 = max(0, (x - 1) * step), max(0, (y - 1) * step)
+    x1, y1 = min(w, (x + bw + 1) * step), min(h, (y + bh + 1) * step)
+    return x0, y0, x1 - x0, y1 - y0
+
+def preprocess_image(image, profile=None):
+    settings = PREPROCESS_PROFILES.get(profile or PREPROCESS_PROFILE, PREPROCESS_PROFILES["balanced"])
+    # PIL's L conversion uses the same luma weights as cv2 and avoids copying three channels
+    gray = np.asarray(image if image.mode == "L" else image.convert("L"))
+
+    region = _largest_region(gray)
+    if region:
+        x, y, w, h = region
         gray = gray[y:y+h, x:x+w]
+
+    max_side = settings["max_side"]
+    if max_side and max(gray.shape[:2]) > max_side:
+        scale = max_side / max(gray.shape[:2])
+        interpolation = cv2.INTER_LINEAR if scale > 0.5 else cv2.INTER_AREA
+        gray = cv2.resize(gray, (int(gray.shape[1] * scale), int(gray.shape[0] * scale)), interpolation=interpolation)
+
     _, thresh = cv2.threshold(gray, 200, 235, cv2.THRESH_BINARY)
     adaptive_thresh = cv2.adaptiveThreshold(
-        thresh, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 21, 5
+        thresh, 255, settings["adaptive_method"], cv2.THRESH_BINARY, 21, 5
     )
     processed_image = Image.fromarray(adaptive_thresh)
     return processed_image
@@ -83,331 +538,624 @@ def convert_image_to_base64(image_path):
     return f"data:{mime_type};base64,{base64_encoded_data}"
 
 # Handle both PDF and image files
-def process_image_file(image_path, output_folder):
-    base_name = os.path.splitext(os.path.basename(image_path))[0]
-    processed_image_path = os.path.join(output_folder, f"{base_name}_processed.png")
-    image = Image.open(image_path)
-    processed_image = preprocess_image(image)
-    processed_image.save(processed_image_path)
-    return [processed_image_path], 1
+# Pages stay in memory: the preprocessed image is encoded once and the same buffer goes to
+# ADI and (base64 only when needed) to the vision call. PNG is the lossless format both
+# services accept; compress level trades CPU for payload size. Debug copies on disk are
+# optional (the app's "Processed Image" preview reads them).
+PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", "1"))
+SAVE_PAGE_IMAGES = os.getenv("SAVE_PAGE_IMAGES", "1") == "1"
+
+def encode_page_image(image):
+    buffer = BytesIO()
+    image.save(buffer, "PNG", compress_level=PNG_COMPRESS_LEVEL)
+    return buffer.getvalue()
+
+def page_bytes_to_data_url(page_bytes, mime_type="image/png"):
+    return f"data:{mime_type};base64,{base64.b64encode(page_bytes).decode('utf-8')}"
+
+def _save_page_bytes(page_bytes, path):
+    if SAVE_PAGE_IMAGES:
+        with open(path, "wb") as f:
+            f.write(page_bytes)
 
 # Azure OCR API call to extract raw text from the image
-def get_raw_text(image_data_url):
+ADI_MODEL_ID = "prebuilt-document"
+
+def is_page_image(image_source):
+    # Encoded page buffers and data URLs are single page images; anything else is a file path
+    return isinstance(image_source, bytes) or image_source.startswith('data:')
+
+def read_ocr_input(image_source):
+    if isinstance(image_source, bytes):
+        return image_source
+    if image_source.startswith('data:'):
+        header, base64_data = image_source.split(',', 1)
+        return base64.b64decode(base64_data)
+    with open(image_source, "rb") as image_file:
+        return image_file.read()
+
+# Bump when the cached page record layout changes
+OCR_RECORD_VERSION = "2"
+
+def ocr_cache_key(image_bytes):
+    # Raw OCR is memoized per page image, so prompt changes downstream never re-OCR
+    return stage_key(ADI_MODEL_ID, OCR_RECORD_VERSION, hashlib.sha256(image_bytes).hexdigest())
+
+# OCR results are kept as page records, not bare text, so later stages can use what ADI
+# returns beyond line content: word confidence drives the cleaning fast path and the
+# prebuilt-document key-value pairs pre-fill structured fields.
+def _mean_confidence(confidences):
+    confidences = [c for c in confidences if c is not None]
+    return sum(confidences) / len(confidences) if confidences else None
+
+def bounding_box(polygon):
+    """[x0, y0, x1, y1] from SDK Points or a flat REST [x, y, x, y, ...] polygon."""
+    if not polygon:
+        return None
+    if hasattr(polygon[0], "x"):
+        xs, ys = [p.x for p in polygon], [p.y for p in polygon]
+    else:
+        xs, ys = polygon[0::2], polygon[1::2]
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+def page_record(page_number, lines, word_confidences, line_boxes=None, key_value_pairs=None):
+    return {
+        "page_number": page_number,
+        "text": " ".join(lines),
+        "lines": lines,
+        "line_boxes": line_boxes or [None] * len(lines),
+        "confidence": _mean_confidence(word_confidences),
+        "key_value_pairs": key_value_pairs or [],
+    }
+
+def key_value_record(key, value, confidence, page_number, key_box=None, value_box=None):
+    return {"key": key, "value": value, "confidence": confidence, "page_number": page_number,
+            "key_box": key_box, "value_box": value_box}
+
+def _sdk_region(element):
+    region = (element.bounding_regions or [None])[0] if element else None
+    return (region.page_number, bounding_box(region.polygon)) if region else (None, None)
+
+def page_records_from_sdk(result):
+    """One page record per analyzed page, in page order, with its key-value pairs attached."""
+    pairs = {}
+    for kv in result.key_value_pairs or []:
+        page_number, key_box = _sdk_region(kv.key)
+        _, value_box = _sdk_region(kv.value)
+        pairs.setdefault(page_number or 1, []).append(key_value_record(
+            kv.key.content, kv.value.content if kv.value else None, kv.confidence, page_number, key_box, value_box
+        ))
+    return [
+        page_record(
+            page.page_number,
+            [line.content for line in page.lines or []],
+            [word.confidence for word in page.words or []],
+            [bounding_box(line.polygon) for line in page.lines or []],
+            pairs.get(page.page_number),
+        )
+        for page in sorted(result.pages, key=lambda p: p.page_number)
+    ]
+
+def merge_page_records(records, content=None):
+    """Combine the pages of one analyze call into a single record (a page image is one page)."""
+    return {
+        "page_number": records[0]["page_number"] if records else 1,
+        "text": content if content is not None else " ".join(r["text"] for r in records),
+        "lines": [line for r in records for line in r["lines"]],
+        "line_boxes": [box for r in records for box in r["line_boxes"]],
+        "confidence": min((r["confidence"] for r in records if r["confidence"] is not None), default=None),
+        "key_value_pairs": [kv for r in records for kv in r["key_value_pairs"]],
+    }
+
+def analyze_page(image_source):
+    """OCR one page image (bytes, data URL or file path) into a page record; None on failure."""
     try:
-        client = DocumentAnalysisClient(endpoint=adi_endpoint, credential=AzureKeyCredential(adi_api_key))
-        if image_data_url.startswith('data:'):
-            header, base64_data = image_data_url.split(',', 1)
-            image_bytes = base64.b64decode(base64_data)
-            image_stream = io.BytesIO(image_bytes)
-            poller = client.begin_analyze_document("prebuilt-document", image_stream)
-            result = poller.result()
-            extracted_text = " ".join([line.content for page in result.pages for line in page.lines])
-            return extracted_text
-        else:
-            with open(image_data_url, "rb") as image_file:
-                poller = client.begin_analyze_document("prebuilt-document", image_file)
-                result = poller.result()
-            extracted_text = result.content
-            return extracted_text
+        image_bytes = read_ocr_input(image_source)
+    except Exception as e:
+        print(f"Error reading document for OCR: {e}")
+        return None
+
+    key = ocr_cache_key(image_bytes)
+    cached = cache_get("ocr_page", key)
+    if cached is not None:
+        return cached
+
+    try:
+        client = get_adi_client()
+        image_stream = io.BytesIO(image_bytes)
+        time.sleep(adi_wait_seconds())
+        poller = client.begin_analyze_document(ADI_MODEL_ID, image_stream)
+        result = poller.result()
+        record = merge_page_records(page_records_from_sdk(result), None if is_page_image(image_source) else result.content)
+        if record["text"]:
+            cache_put("ocr_page", key, record)
+        return record
     except Exception as e:
         print(f"Error analyzing document: {e}")
         import traceback
         traceback.print_exc()
         return None
 
-#--------------------- Text Cleaning Functions ---------------------
-def clean_ocr_text(raw_text, image):
-    extracted_text = raw_text
-    system_prompt = """
-    You are an expert OCR text cleaner specializing in Philippine business permits. Your task is to clean and format the raw OCR text to make it more readable and easier to parse for name extraction and differentiation.
+def get_raw_text(image_source):
+    record = analyze_page(image_source)
+    return record["text"] if record else None
 
-    Fix spacing and line breaks, correct obvious OCR errors, preserve structure, and do not add information. Output plain text only.
-    """
+# Native PDF mode: send the original PDF in one analyze call instead of rasterizing every page
+OCR_NATIVE_PDF = os.getenv("OCR_NATIVE_PDF", "0") == "1"
+OCR_PDF_PAGES = os.getenv("OCR_PDF_PAGES") or None  # e.g. "1-3" or "1,3,5"; None = all pages
+
+def pdf_ocr_cache_key(pdf_bytes, pages=None):
+    return stage_key(ADI_MODEL_ID, OCR_RECORD_VERSION, pages or "", hashlib.sha256(pdf_bytes).hexdigest())
+
+def analyze_pdf_pages(pdf_path, pages=None):
+    """Analyze a whole PDF in a single ADI request; returns one page record per page in page order."""
+    try:
+        with open(pdf_path, "rb") as f:
+            pdf_bytes = f.read()
+    except Exception as e:
+        print(f"Error reading PDF for OCR: {e}")
+        return []
+
+    key = pdf_ocr_cache_key(pdf_bytes, pages)
+    cached = cache_get("ocr_pdf_pages", key)
+    if cached is not None:
+        return cached
+
+    try:
+        client = get_adi_client()
+        kwargs = {"pages": pages} if pages else {}
+        with _adi_semaphore:
+            time.sleep(adi_wait_seconds())
+            poller = client.begin_analyze_document(ADI_MODEL_ID, io.BytesIO(pdf_bytes), **kwargs)
+            result = poller.result()
+        records = page_records_from_sdk(result)
+        if any(r["text"] for r in records):
+            cache_put("ocr_pdf_pages", key, records)
+        return records
+    except Exception as e:
+        print(f"Error analyzing PDF: {e}")
+        import traceback
+        traceback.print_exc()
+        return []
+
+# Pages of one document are OCR'd concurrently; the global semaphore caps in-flight ADI
+# calls across all documents being processed by the batch drivers.
+_adi_semaphore = threading.BoundedSemaphore(ADI_MAX_CONCURRENCY)
+
+def _analyze_page_limited(image_source):
+    with _adi_semaphore:
+        return analyze_page(image_source)
+
+def analyze_pages(page_images):
+    """OCR several pages concurrently; page records are returned in page order."""
+    if len(page_images) <= 1:
+        return [_analyze_page_limited(p) for p in page_images]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(OCR_PAGE_WORKERS, len(page_images))) as executor:
+        return list(executor.map(_analyze_page_limited, page_images))
+
+#--------------------- Text Cleaning Functions ---------------------
+# Page-aware cleaning. "per_page" cleans every page with its own image concurrently and
+# concatenates; "thumbnails" sends one call with downscaled images of all pages. Either way the
+# base64 image payload of a request is kept under CLEANING_IMAGE_BUDGET_BYTES. Calls are keyed
+# on the page bytes, so images are only downscaled and encoded on a cache miss.
+CLEANING_MODE = os.getenv("CLEANING_MODE", "per_page")
+CLEANING_IMAGE_BUDGET_BYTES = int(os.getenv("CLEANING_IMAGE_BUDGET_BYTES", "1000000"))
+CLEANING_THUMBNAIL_MAX_SIDE = int(os.getenv("CLEANING_THUMBNAIL_MAX_SIDE", "1024"))
+MIN_VISION_IMAGE_SIDE = 512
+
+def data_url_size(byte_count, mime_type="image/png"):
+    # What a page actually costs in the request: base64 grows it by a third
+    return len(f"data:{mime_type};base64,") + 4 * -(-byte_count // 3)
+
+def _fit_page_image(page_bytes, max_bytes, max_side=None):
+    """Downscale a page until its data URL fits max_bytes (never below MIN_VISION_IMAGE_SIDE)."""
+    with Image.open(BytesIO(page_bytes)) as image:
+        side = min(max(image.size), max_side) if max_side else max(image.size)
+        if side == max(image.size) and data_url_size(len(page_bytes)) <= max_bytes:
+            return page_bytes
+        while True:
+            resized = image.copy()
+            resized.thumbnail((side, side))
+            buffer = BytesIO()
+            resized.save(buffer, "PNG", optimize=True)
+            if data_url_size(buffer.tell()) <= max_bytes or side <= MIN_VISION_IMAGE_SIDE:
+                return buffer.getvalue()
+            side = max(MIN_VISION_IMAGE_SIDE, int(side * 0.75))
+
+def vision_images(page_images, max_side=None):
+    """Data URLs for page_images, sharing the per-request image byte budget between them."""
+    if not page_images:
+        return []
+    per_image_budget = CLEANING_IMAGE_BUDGET_BYTES // len(page_images)
+    return [page_bytes_to_data_url(_fit_page_image(p, per_image_budget, max_side)) for p in page_images]
+
+def cleaning_cache_key(raw_text, pages=None, max_side=None):
+    # Keyed on the original page bytes plus the fitting settings, not on the fitted images
+    return stage_key(endpoint, CLEANING_SYSTEM_PROMPT, str(CLEANING_IMAGE_BUDGET_BYTES), str(max_side or ""),
+                     hashlib.sha256(raw_text.encode("utf-8")).hexdigest(),
+                     *(hashlib.sha256(p).hexdigest() for p in pages or []))
+
+def build_cleaning_request(raw_text, image):
+    images = image if isinstance(image, list) else ([image] if image else [])
+    return {
+        "messages": [
+            {"role": "system", "content": CLEANING_SYSTEM_PROMPT},
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": raw_text},
+                ] + [{"type": "image_url", "image_url": {"url": i}} for i in images],
+            }
+        ],
+        "max_tokens": 4000,
+        "temperature": 0
+    }
+
+def clean_ocr_text(raw_text, pages=None, max_side=None):
+    """(text, degraded): the cleaned text, or the raw OCR text with degraded=True if cleaning failed.
+    pages are encoded page images; they are fitted to the budget only when the call is not cached."""
+    key = cleaning_cache_key(raw_text, pages, max_side)
+    cached = cache_get("cleaned", key)
+    if cached is not None:
+        return cached, False
     try:
-        data = {
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": extracted_text},
-                        {"type": "image_url", "image_url": {"url": image}},
-                    ],
-                }
-            ],
-            "max_tokens": 4000,
-            "temperature": 0
-        }
-        response = requests.post(endpoint, headers=headers, json=data)
-        response.raise_for_status()
-        cleaned_text = response.json()["choices"][0]["message"]["content"]
-        return cleaned_text
+        data = build_cleaning_request(raw_text, vision_images(pages, max_side))
+        cleaned_text = post_chat_completion(data)["choices"][0]["message"]["content"]
+        cache_put("cleaned", key, cleaned_text)
+        return cleaned_text, False
     except Exception as e:
-        print(f"Error in OCR text cleaning: {str(e)}")
-        return raw_text
+        print(f"Error in OCR text cleaning: {str(e)} - falling back to raw OCR text")
+        return raw_text, True
+
+def cleaning_jobs(page_texts, page_images):
+    """(text, page images, max_side) cleaning calls for a document according to CLEANING_MODE."""
+    pages = [(t, p) for t, p in zip(page_texts, page_images or [None] * len(page_texts)) if t]
+    if not pages:
+        return []
+    if not page_images:
+        return [("\n".join(t for t, _ in pages), None, None)]
+    if CLEANING_MODE == "thumbnails" or len(pages) == 1:
+        max_side = CLEANING_THUMBNAIL_MAX_SIDE if CLEANING_MODE == "thumbnails" else None
+        return [("\n".join(t for t, _ in pages), [p for _, p in pages], max_side)]
+    return [(t, [p], None) for t, p in pages]
+
+def join_cleaned(cleaned):
+    """Combine per-call (text, degraded) results; the document is degraded if any call was."""
+    return "\n".join(text for text, _ in cleaned), any(degraded for _, degraded in cleaned)
+
+def clean_document_text(page_texts, page_images=None):
+    """Clean a document's OCR text with the matching page images; pages are cleaned concurrently.
+    Returns (text, degraded) like clean_ocr_text."""
+    jobs = cleaning_jobs(page_texts, page_images)
+    if not jobs:
+        return clean_ocr_text("")
+    if len(jobs) == 1:
+        return clean_ocr_text(*jobs[0])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(OCR_PAGE_WORKERS, len(jobs))) as executor:
+        return join_cleaned(list(executor.map(lambda job: clean_ocr_text(*job), jobs)))
+
+# Fast path: when ADI is confident about every page the vision cleaning call adds little, so
+# it is skipped (lines are kept as ADI returned them) or shortened to a text-only call.
+OCR_SKIP_CLEANING_CONFIDENCE = float(os.getenv("OCR_SKIP_CLEANING_CONFIDENCE", "0.98"))
+OCR_TEXT_ONLY_CLEANING_CONFIDENCE = float(os.getenv("OCR_TEXT_ONLY_CLEANING_CONFIDENCE", "0.95"))
+
+FAST_PATH_STATS = {"documents": 0, "cleaning_skipped": 0, "cleaning_text_only": 0, "cleaning_full": 0, "cleaning_failed": 0}
+
+def document_confidence(page_records):
+    # The weakest page decides; a page without words or a failed page counts as unknown (0)
+    if not page_records:
+        return 0.0
+    return min((r or {}).get("confidence") or 0.0 for r in page_records)
+
+def choose_cleaning_path(page_records):
+    confidence = document_confidence(page_records)
+    if confidence >= OCR_SKIP_CLEANING_CONFIDENCE:
+        path = "skipped"
+    elif confidence >= OCR_TEXT_ONLY_CLEANING_CONFIDENCE:
+        path = "text_only"
+    else:
+        path = "full"
+    record_stat("documents", stats=FAST_PATH_STATS)
+    record_stat(f"cleaning_{path}", stats=FAST_PATH_STATS)
+    return path
+
+def count_cleaning_failure(cleaned):
+    # Counted per document like the other fast-path stats, however many page calls failed
+    if cleaned[1]:
+        record_stat("cleaning_failed", stats=FAST_PATH_STATS)
+    return cleaned
+
+def fast_path_text(page_records):
+    return "\n".join("\n".join(r["lines"]) for r in page_records if r and r.get("lines"))
+
+def clean_document(page_records, page_images=None):
+    """Clean a document's OCR output, taking the confidence fast path when it applies.
+    Returns (text, degraded) like clean_ocr_text."""
+    page_texts = [r["text"] if r else None for r in page_records]
+    path = choose_cleaning_path(page_records)
+    if path == "skipped":
+        return fast_path_text(page_records), False
+    return count_cleaning_failure(clean_document_text(page_texts, page_images if path == "full" else None))
 
 # --------------------- Structured Data Functions ---------------------
 def parse_structured_response(response_content):
+    # Handles bare JSON (structured-output mode) as well as the tagged/fenced format, repairing
+    # malformed or truncated JSON locally (see json_repair)
     if isinstance(response_content, dict):
         return response_content
     if isinstance(response_content, str):
-        json_match = re.search(r'<initial_attempt>\s*```json(.*?)```\s*</initial_attempt>', response_content, re.DOTALL)
-        if json_match:
-            json_str = json_match.group(1).strip()
-            try:
-                structured_data = json.loads(json_str)
-                return structured_data
-            except json.JSONDecodeError as e:
-                print(f"JSON parsing error: {e}")
-                print("Extracted JSON was:", json_str)
-                return None
-        else:
-            print("No JSON found in <initial_attempt> tags.")
-            return None
+        structured_data = parse_json_tolerant(response_content)
+        if structured_data is None:
+            print("No JSON object found in response.")
+            print("Response was:", response_content[:500])
+        return structured_data
     print("Unexpected response content type:", type(response_content))
     return None
 
+# The json_schema response_format needs a recent deployment/API version; the first 400 that
+# rejects it switches this process back to the tagged prompt format.
+_structured_output_supported = True
+
+def structured_output_enabled():
+    return STRUCTURED_OUTPUT and _structured_output_supported
+
+def disable_structured_output(error_text):
+    global _structured_output_supported
+    if _structured_output_supported:
+        print(f"Structured output rejected ({error_text[:200]}); falling back to tagged JSON prompts")
+    _structured_output_supported = False
+
+def rejects_response_format(status_code, error_text):
+    return status_code == 400 and ("response_format" in error_text or "json_schema" in error_text)
+
+def response_format(fields):
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "permit_fields",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {field: {"type": "string"} for field in fields},
+                "required": list(fields),
+                "additionalProperties": False,
+            },
+        },
+    }
+
+# Token-budgeted structuring prompts: max_tokens is sized to the expected JSON instead of a flat
+# 8192, which also shrinks the TPM reservation per request. A response cut off by the smaller
+# limit is retried once at STRUCTURING_MAX_TOKENS. STRUCTURING_TRIM_BOILERPLATE=1 also drops
+# stand-alone fee-table rows and legal footer lines before the text is sent.
+STRUCTURING_MAX_TOKENS = int(os.getenv("STRUCTURING_MAX_TOKENS", "8192"))
+STRUCTURING_OUTPUT_BASE_TOKENS = int(os.getenv("STRUCTURING_OUTPUT_BASE_TOKENS", "1536"))
+STRUCTURING_JSON_OUTPUT_BASE_TOKENS = int(os.getenv("STRUCTURING_JSON_OUTPUT_BASE_TOKENS", "768"))
+BOILERPLATE_LINE_MAX_CHARS = 160
+
+FEE_WORDS = re.compile(
+    r"\b(?:fees?|surcharges?|penalt(?:y|ies)|interest|charges?|sub-?total|total|amount(?:\s+paid)?|taxe?s?|o\.?\s?r\.?\s+no)\b",
+    re.IGNORECASE,
+)
+AMOUNT = re.compile(r"(?:₱|\bphp)\s*\d|\b\d{1,3}(?:,\d{3})*\.\d{2}\b", re.IGNORECASE)
+AMOUNTS_ONLY = re.compile(r"^(?:\s*₱?\s*\d{1,3}(?:,\d{3})*\.\d{2})+\s*$")
+LEGAL_FOOTER = re.compile(
+    r"not\s+valid\s+without|must\s+be\s+(?:posted|displayed)|conspicuous\s+place|subject\s+to\s+revocation"
+    r"|non-?transferable|void\s+if|erasures?",
+    re.IGNORECASE,
+)
+# Never dropped: lines carrying a field label, the line after a bare label (its value), lines
+# naming the grantee and the line after "granted to"/"issued to", lines with an uppercase name
+# run (JUAN DELA CRUZ, ABC TRADING) and long lines (a raw-OCR page arrives as one line)
+_LABELS = "|".join(p for patterns in DEFAULT_LABELS.values() for p in patterns)
+KEEP_LINE = re.compile(_LABELS, re.IGNORECASE)
+BARE_LABEL = re.compile(rf"^\s*(?:{_LABELS})\s*[:.\-]?\s*$", re.IGNORECASE)
+GRANTEE = re.compile(r"\b(?:granted|issued)\s+to\b", re.IGNORECASE)
+_UPPER_WORD = r"[A-ZÑ](?:[A-ZÑ'&\-]*[A-ZÑ])?\.?(?!\w)"
+NAME_RUN = re.compile(rf"\b{_UPPER_WORD}(?:\s+{_UPPER_WORD})+")
+
+TOKEN_STATS = {"documents": 0, "prompt_tokens": 0, "completion_tokens": 0, "trimmed_tokens": 0, "truncated_retries": 0}
+
+def is_boilerplate(line):
+    """True only for a stand-alone fee-table row or legal footer line that names nobody."""
+    if len(line) > BOILERPLATE_LINE_MAX_CHARS or KEEP_LINE.search(line) or GRANTEE.search(line):
+        return False
+    if any(not FEE_WORDS.search(run.group(0)) for run in NAME_RUN.finditer(line)):
+        return False
+    return bool(LEGAL_FOOTER.search(line) or AMOUNTS_ONLY.match(line)
+                or (FEE_WORDS.search(line) and AMOUNT.search(line)))
+
+def trim_boilerplate(text):
+    if not STRUCTURING_TRIM_BOILERPLATE:
+        return text
+    kept, previous = [], ""
+    for line in (text or "").splitlines():
+        if BARE_LABEL.match(previous) or GRANTEE.search(previous) or not is_boilerplate(line):
+            kept.append(line)
+        previous = line
+    return "\n".join(kept)
+
+def structuring_max_tokens(text_tokens, base=STRUCTURING_OUTPUT_BASE_TOKENS):
+    # Longer documents list more officials; the output never needs to scale with fee tables
+    return min(STRUCTURING_MAX_TOKENS, base + text_tokens // 8)
+
+def response_content(response_json):
+    return response_json["choices"][0]["message"]["content"]
+
+def is_truncated(response_json):
+    return response_json["choices"][0].get("finish_reason") == "length"
+
+def token_usage(data, responses, raw_text, batch_size=1):
+    """Per-document token record for the structuring call(s); retries are summed and a batched
+    request is split evenly across its documents."""
+    usage = [r.get("usage") or {} for r in responses]
+    record = {
+        "estimated_prompt_tokens": prompt_tokens_estimate(data) // batch_size,
+        "prompt_tokens": sum(u.get("prompt_tokens", 0) for u in usage) // batch_size,
+        "completion_tokens": sum(u.get("completion_tokens", 0) for u in usage) // batch_size,
+        "cached_prompt_tokens": sum(cached_prompt_tokens(r) for r in responses) // batch_size,
+        "max_tokens": data.get("max_tokens"),
+        "trimmed_tokens": estimate_tokens(raw_text) - estimate_tokens(trim_boilerplate(raw_text)),
+    }
+    if batch_size > 1:
+        record["batch_size"] = batch_size
+    record_stat("documents", stats=TOKEN_STATS)
+    for stat in ("prompt_tokens", "completion_tokens", "trimmed_tokens"):
+        record_stat(stat, record[stat], stats=TOKEN_STATS)
+    if len(responses) > 1:
+        record_stat("truncated_retries", stats=TOKEN_STATS)
+    return record
+
+def post_structuring_request(build):
+    """Send build(json_mode) and parse it; returns (parsed JSON or None, responses, request sent).
+
+    Truncated output is retried once at STRUCTURING_MAX_TOKENS; if that is cut off too the
+    locally repaired partial object is kept.
+    """
+    data = build(structured_output_enabled())
+    try:
+        responses = [post_chat_completion(data)]
+    except requests.exceptions.HTTPError as e:
+        status, text = (e.response.status_code, e.response.text) if e.response is not None else (None, "")
+        if "response_format" not in data or not rejects_response_format(status, text):
+            raise
+        disable_structured_output(text)
+        data = build(False)
+        responses = [post_chat_completion(data)]
+    parsed = parse_structured_response(response_content(responses[-1]))
+    if is_truncated(responses[-1]):
+        responses.append(post_chat_completion(dict(data, max_tokens=STRUCTURING_MAX_TOKENS)))
+        parsed = parse_structured_response(response_content(responses[-1])) or parsed
+    return parsed, responses, data
+
+def structuring_cache_key(raw_text):
+    return stage_key(endpoint, STRUCTURING_SYSTEM_PROMPT, STRUCTURING_USER_INSTRUCTION, str(STRUCTURING_TRIM_BOILERPLATE),
+                     str(STRUCTURED_OUTPUT), STRUCTURING_JSON_SYSTEM_PROMPT, STRUCTURING_JSON_USER_INSTRUCTION,
+                     hashlib.sha256(raw_text.encode("utf-8")).hexdigest())
+
+def build_structuring_request(raw_text, json_mode=False):
+    text = trim_boilerplate(raw_text)
+    data = {
+        "messages": [
+            {"role": "system", "content": STRUCTURING_JSON_SYSTEM_PROMPT if json_mode else STRUCTURING_SYSTEM_PROMPT},
+            {"role": "user", "content": [
+                {"type": "text", "text": STRUCTURING_JSON_USER_INSTRUCTION if json_mode else STRUCTURING_USER_INSTRUCTION},
+                {"type": "text", "text": text}
+            ]}
+        ],
+        "max_tokens": structuring_max_tokens(
+            estimate_tokens(text), STRUCTURING_JSON_OUTPUT_BASE_TOKENS if json_mode else STRUCTURING_OUTPUT_BASE_TOKENS
+        ),
+        "temperature": 0.0
+    }
+    if json_mode:
+        data["response_format"] = response_format(SCHEMA_FIELDS)
+    return data
+
 def get_structured_data_from_text(raw_text):
-    system_prompt = """
-        You are an AI assistant specialized in extracting and differentiating names from Philippine business permits. Your primary goal is to demonstrate advanced AI capabilities in distinguishing between different types of names and entities mentioned in the document.
-
-        <user_task>
-        ═══════════════════════════════════════════════════════════════
-        1. PURPOSE AND OUTPUT REQUIREMENTS
-        ═══════════════════════════════════════════════════════════════
-        1.1 Goal: Extract and differentiate names from Philippine business permits with absolute accuracy, focusing on the AI's ability to categorize different types of names and identify municipal/city templates.
-
-        Key Objectives:
-        • Demonstrate AI's capability to differentiate between individual names vs business names vs official names
-        • Parse business permit documents and identify different name categories with context understanding
-        • Identify municipal/city template variations
-        • Extract supporting information like permit numbers, dates, and addresses
-        • Showcase contextual understanding of Filipino naming conventions and business permit formats
-        • Include professional titles (e.g., Atty., Engr., Dr.) with names when present
-
-        1.2 Critical Requirements:
-        • Extract ONLY the specified fields
-        • Strict JSON format – no deviations
-        • Missing fields must be explicitly labeled as "None"
-        • Multi-page documents must be combined into a single structured JSON object
-        • No assumptions or inferences: Only extract what is explicitly visible
-        • PRIMARY FOCUS: Demonstrate NAME DIFFERENTIATION capabilities
-        • Preserve exact spelling of Filipino names and business names
-        • Identify municipal/city template types
-        • Include titles (Atty., Engr., Dr., etc.) with names
-        • ALL dates must be in dd-mmm-yyyy format (e.g., 15-Mar-2024, 01-Jan-2025)
-        • NEVER infer or calculate dates from partial information
-
-        ═══════════════════════════════════════════════════════════════
-        2. TEMPLATE IDENTIFICATION
-        ═══════════════════════════════════════════════════════════════
-        Identify the municipal/city template from the following common types:
-        • Manila City
-        • Quezon City
-        • Makati City
-        • Cebu City
-        • Davao City
-        • Pasig City
-        • Taguig City
-        • Antipolo City
-        • Dasmariñas City
-        • Biñan City
-        • Imus City
-        • Cainta
-        • Las Piñas City
-        • Parañaque City
-        • Muntinlupa City
-        • Caloocan City
-        • Marikina City
-        • Pasay City
-        • Valenzuela City
-        • Malabon City
-        • Navotas City
-        • San Juan City
-        • Mandaluyong City
-        • Other Municipal Template
-        • Unknown Template
-
-        ═══════════════════════════════════════════════════════════════
-        3. NAME DIFFERENTIATION AND EXTRACTION RULES (PRIMARY FOCUS)
-        ═══════════════════════════════════════════════════════════════
-        
-        3.1 Business Owner Name (Individual or Business Entity):
-        • Can be either:
-        - Full name of the individual person who owns/operates the business (e.g., "Atty. Juan dela Cruz", "Maria Santos-Garcia")
-        - OR the business/company name if the owner is a corporate entity (e.g., "ABC Corporation", "XYZ Enterprises, Inc.")
-        • Usually found in "Applicant Name", "Owner", "Proprietor", "Pangalan ng May-ari" sections
-        • Include professional titles when present (Atty., Engr., Dr., etc.)
-        • May include middle names, maiden names, or compound surnames for individuals
-        • Context: This demonstrates AI's ability to identify either individual human names OR business entity names as owners
-
-        3.2 Mayor Name (Government Official):
-        • Full name of the municipal mayor including title if present (e.g., "Atty. Juan dela Cruz")
-        • Often found with official signatures, seals, or "Punong Lungsod/Bayan" designation
-        • Extract the person's name with title
-        • May appear in signature blocks or approval sections
-        • Context: Shows AI can identify specific government official names with titles
-
-        3.3 Business Name/Establishment:
-        • Official registered name of the business establishment
-        • Trade names, company names, store names (e.g., "Sari-sari Store ni Maria", "ABC General Merchandise")
-        • May include business type descriptors (Store, Shop, Restaurant, etc.)
-        • May be in English, Filipino, or mixed languages
-        • Context: Demonstrates AI's ability to distinguish business entities from personal names
-
-        3.4 Business Address:
-        • Complete business address including street, barangay, city/municipality, and province if visible
-        • Extract full address as stated in the permit
-        • Include all address components visible in the document
-        • Format: Street/Building, Barangay, City/Municipality, Province
-
-        3.5 Other Official Names (Government/Municipal Officials):
-        • Names of city/municipal officials mentioned in the document
-        • Department heads, treasurers, assessors, clerks, witnesses
-        • Business permit officers, licensing officers
-        • Anyone with an official government title or position
-        • Include professional titles (Atty., Engr., etc.) with names
-        • List multiple names separated by semicolons if multiple officials are present
-        • Context: Shows AI's contextual understanding of various official roles
-        • Format: "Atty. Roberto Martinez (City Treasurer); Engr. Ana Reyes (Business Permit Officer)"
-
-        3.6 Supporting Information:
-        • Municipality/City Template: Specific template format used
-        • Permit Number: Official permit/license number
-        • Issue Date: Date when permit was issued (format: dd-mmm-yyyy)
-        CRITICAL: Only extract if the COMPLETE date (day, month, year) is explicitly visible
-        If incomplete, use "[unclear]"
-        • Business Permit Validity: Validity/expiration date of permit (format: dd-mmm-yyyy)
-        CRITICAL: Only extract if the COMPLETE date (day, month, year) is explicitly visible
-        If incomplete (e.g., only year shown, or "quarter" without specific date), use "[unclear]"
-        NEVER calculate or infer dates from partial information
-        NEVER assume quarter end dates
-        • Business Type: Type of business operation if clearly stated
-        • Municipality/City: Full name of the issuing municipality/city
-
-        ═══════════════════════════════════════════════════════════════
-        4. OUTPUT FORMAT
-        ═══════════════════════════════════════════════════════════════
-        Produce a single JSON object containing exactly the following fields:
-
-        {
-            "Municipality_Template": "[Manila City|Quezon City|Makati City|Cebu City|Davao City|Pasig City|Taguig City|Antipolo City|Dasmariñas City|Biñan City|Imus City|Cainta|Las Piñas City|Parañaque City|Muntinlupa City|Caloocan City|Marikina City|Pasay City|Valenzuela City|Malabon City|Navotas City|San Juan City|Mandaluyong City|Other Municipal Template|Unknown Template]",
-            "Document_Type": "Philippine Business Permit",
-            "Page_Count": "integer",
-            "Municipality_City": "string",
-            "Business_Owner_Name": "string (individual name with title OR business entity name)",
-            "Mayor_Name": "string (include title if present)", 
-            "Business_Name": "string",
-            "Business_Address": "string",
-            "Other_Official_Names": "string (include titles)",
-            "Permit_Number": "string",
-            "Issue_Date": "string (dd-mmm-yyyy format, or [unclear] if incomplete)",
-            "Business_Permit_Validity": "string (dd-mmm-yyyy format, or [unclear] if incomplete)",
-            "Business_Type": "string"
-        }
-
-        Notes:  
-        • Mark any field explicitly absent as "None"
-        • If data is visible but unclear, use "[unclear]"
-        • Ensure no extraneous keys are added
-        • PRIMARY FOCUS: Accurate name differentiation to showcase AI capability
-        • Use underscore format for field names to ensure Excel compatibility
-        • Always include professional titles (Atty., Engr., Dr., etc.) with names when visible
-        • Format ALL dates as dd-mmm-yyyy (e.g., 15-Mar-2024, 01-Jan-2025, 31-Dec-2024)
-
-        ═══════════════════════════════════════════════════════════════
-        5. DATE EXTRACTION RULES - STRICT COMPLIANCE REQUIRED
-        ═══════════════════════════════════════════════════════════════
-
-        For Issue_Date and Business_Permit_Validity fields:
-
-        ONLY extract dates that are COMPLETELY and EXPLICITLY visible with ALL three components:
-        • Full day number (01-31)
-        • Full month name or abbreviation
-        • Full year (4 digits)
-
-        If ANY component is missing, unclear, or requires inference:
-        • Return "[unclear]" 
-        • DO NOT calculate quarter end dates
-        • DO NOT infer missing day/month values
-        • DO NOT assume dates from partial information
-        • DO NOT convert "end of quarter" to specific dates
-
-        Valid Examples:
-        ✓ "December 31, 2018" → "31-Dec-2018"
-        ✓ "15 March 2024" → "15-Mar-2024"
-        ✓ "May 24, 2018" → "24-May-2018"
-        
-        Invalid Examples (use "[unclear]"):
-        ✗ "End of 2018" → "[unclear]" (day/month missing)
-        ✗ "Q3 2018" → "[unclear]" (specific date not visible)
-        ✗ "___ QUARTER, 2018" → "[unclear]" (incomplete information)
-        ✗ "VALID UNTIL THE END OF ___ QUARTER, 2018" → "[unclear]" (quarter not specified, date incomplete)
-        ✗ "2018" → "[unclear]" (only year visible)
-        ✗ "December 2018" → "[unclear]" (day missing)
-
-        REMEMBER: When in doubt, use "[unclear]". Never guess or calculate dates.
-
-        ═══════════════════════════════════════════════════════════════
-        6. OUTPUT EXAMPLE (Demonstrating Name Differentiation)
-        ═══════════════════════════════════════════════════════════════
-        {
-            "Municipality_Template": "Dasmariñas City",
-            "Document_Type": "Philippine Business Permit",
-            "Page_Count": "1",
-            "Municipality_City": "Dasmariñas City, Cavite",
-            "Business_Owner_Name": "Maria Santos-Cruz",
-            "Mayor_Name": "Atty. Jennifer Austria Barzaga",
-            "Business_Name": "Santos General Merchandise and Sari-sari Store",
-            "Business_Address": "123 Main Street, Barangay Salitran, Dasmariñas City, Cavite",
-            "Other_Official_Names": "Engr. Roberto Martinez (City Treasurer); Atty. Ana Reyes (Business Permit Officer); Jose Garcia (Department Head)",
-            "Permit_Number": "BP-2024-001234",
-            "Issue_Date": "15-Mar-2024",
-            "Business_Permit_Validity": "31-Dec-2024",
-            "Business_Type": "General Merchandise"
-        }
-
-        ═══════════════════════════════════════════════════════════════
-        7. CRITICAL NOTES FOR NAME DIFFERENTIATION DEMONSTRATION
-        ═══════════════════════════════════════════════════════════════
-        • Individual vs Entity Recognition: The AI must clearly distinguish between personal names (individuals) and business entity names
-        • Business Owner can be EITHER an individual person OR a business/corporate entity
-        • Contextual Understanding: Use document structure, Filipino naming conventions, and official titles to aid proper categorization
-        • Multiple Name Handling: When multiple officials are mentioned, demonstrate the ability to list and categorize them appropriately
-        • Cultural Sensitivity: Preserve Filipino naming conventions including compound surnames, maiden names, and traditional naming patterns
-        • Template Recognition: Identify different municipal templates to show document format understanding
-        • Title Inclusion: Always include professional titles (Atty., Engr., Dr., etc.) when present in the document
-        • Date Extraction: ONLY extract complete dates. Use "[unclear]" for any incomplete date information
-        • Address Extraction: Extract complete business address with all visible components
-        • The PRIMARY SUCCESS METRIC is the AI's demonstrated ability to correctly differentiate between different types of names based on context
-
-        </user_task>
-
-        Please follow these steps:
-
-        1. Initial Attempt:
-        Make an initial attempt at completing the task focusing on name differentiation. Present this attempt in <initial_attempt> tags with JSON format.
-
-        2. Final Answer:
-        Present your final JSON answer in <answer> tags after analysis.
+    key = structuring_cache_key(raw_text)
+    cached = cache_get("structured", key)
+    if cached is not None:
+        return cached
+    try:
+        structured_data, responses, data = post_structuring_request(lambda json_mode: build_structuring_request(raw_text, json_mode))
+        if structured_data:
+            structured_data["Token_Usage"] = token_usage(data, responses, raw_text)
+            cache_put("structured", key, structured_data)
+        return structured_data
+    except requests.exceptions.RequestException as e:
+        print(f"API request error: {e}")
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+    return None
 
-    """
+# Known municipal templates are extracted locally with template_extractors; the LLM only
+# sees documents with no matching template or with a required field the rules could not find.
+EXTRACTION_STATS = {"template": 0, "llm_no_template": 0, "llm_incomplete_template": 0, "kv_prefilled": 0, "kv_fields": 0}
+
+def extract_with_templates(cleaned_text):
+    """Template-based structured data, or None when the LLM has to handle the document."""
+    if not TEMPLATE_EXTRACTION:
+        return None
+    template = match_template(cleaned_text or "")
+    if template is None:
+        record_stat("llm_no_template", stats=EXTRACTION_STATS)
+        return None
+    structured_data = extract_template_fields(template, cleaned_text)
+    missing = missing_required_fields(structured_data)
+    if missing:
+        print(f"{template['name']} template missing {', '.join(missing)}; using the LLM")
+        record_stat("llm_incomplete_template", stats=EXTRACTION_STATS)
+        return None
+    record_stat("template", stats=EXTRACTION_STATS)
+    return structured_data
+
+# prebuilt-document key-value pairs whose key matches a known label pre-fill those fields;
+# the LLM then only receives the rules for what is still unresolved (or is skipped entirely).
+KV_MIN_CONFIDENCE = float(os.getenv("KV_MIN_CONFIDENCE", "0.8"))
+
+def prefill_from_key_values(page_records):
+    if not KV_PREFILL:
+        return {}
+    pairs = [kv for r in page_records or [] if r for kv in r.get("key_value_pairs") or []]
+    return fields_from_key_values(pairs, KV_MIN_CONFIDENCE)
+
+def unresolved_fields(prefilled):
+    return [f for f in FIELD_RULES if f not in prefilled]
+
+def build_partial_structuring_request(raw_text, prefilled, json_mode=False):
+    unresolved = unresolved_fields(prefilled)
+    requested = "\n".join(f"- {f}: {FIELD_RULES[f]}" for f in unresolved)
+    text = trim_boilerplate(raw_text)
+    data = {
+        "messages": [
+            {"role": "system", "content": PARTIAL_STRUCTURING_JSON_SYSTEM_PROMPT if json_mode else PARTIAL_STRUCTURING_SYSTEM_PROMPT},
+            {"role": "user", "content": [
+                {"type": "text", "text": f"Requested fields:\n{requested}"},
+                {"type": "text", "text": f"Already extracted:\n{json.dumps(prefilled, ensure_ascii=False)}"},
+                {"type": "text", "text": text}
+            ]}
+        ],
+        "max_tokens": structuring_max_tokens(estimate_tokens(text), (64 if json_mode else 256) + 96 * len(unresolved)),
+        "temperature": 0.0
+    }
+    if json_mode:
+        data["response_format"] = response_format(unresolved)
+    return data
+
+def partial_structuring_cache_key(raw_text, prefilled):
+    return stage_key(endpoint, PARTIAL_STRUCTURING_SYSTEM_PROMPT, json.dumps(FIELD_RULES, sort_keys=True), str(STRUCTURING_TRIM_BOILERPLATE),
+                     str(STRUCTURED_OUTPUT), PARTIAL_STRUCTURING_JSON_SYSTEM_PROMPT,
+                     json.dumps(prefilled, sort_keys=True), hashlib.sha256(raw_text.encode("utf-8")).hexdigest())
+
+def merge_prefilled(prefilled, extracted):
+    structured_data = {f: "None" for f in SCHEMA_FIELDS}
+    structured_data["Document_Type"] = "Philippine Business Permit"
+    structured_data.update({f: v for f, v in (extracted or {}).items() if f in FIELD_RULES and f not in prefilled})
+    structured_data.update(prefilled)
+    return structured_data
+
+def overlay_prefilled(structured_data, prefilled):
+    # Key-value pairs ADI read with confidence win over the model's answer for the same field
+    if not structured_data or not prefilled:
+        return structured_data
+    return dict(structured_data, **prefilled)
+
+def get_remaining_fields_from_text(raw_text, prefilled):
+    if not unresolved_fields(prefilled):
+        return merge_prefilled(prefilled, {})
+    key = partial_structuring_cache_key(raw_text, prefilled)
+    cached = cache_get("structured_partial", key)
+    if cached is not None:
+        return cached
     try:
-        data = {
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": [
-                    {"type": "text", "text": "Extract and structure the information from the following Philippine business permit text. Provide your response in JSON format wrapped within ```json and ``` inside <initial_attempt> tags."},
-                    {"type": "text", "text": raw_text}
-                ]}
-            ],
-            "max_tokens": 8192,
-            "temperature": 0.0
-        }
-        response = requests.post(endpoint, headers=headers, json=data)
-        response.raise_for_status()
-        response_content = response.json()["choices"][0]["message"]["content"]
-        structured_data = parse_structured_response(response_content)
+        extracted, responses, data = post_structuring_request(
+            lambda json_mode: build_partial_structuring_request(raw_text, prefilled, json_mode)
+        )
+        if not extracted:
+            return None
+        structured_data = merge_prefilled(prefilled, extracted)
+        structured_data["Token_Usage"] = token_usage(data, responses, raw_text)
+        cache_put("structured_partial", key, structured_data)
         return structured_data
     except requests.exceptions.RequestException as e:
         print(f"API request error: {e}")
@@ -415,6 +1163,162 @@ def get_structured_data_from_text(raw_text):
         print(f"Unexpected error: {e}")
     return None
 
+def extract_structured_data(cleaned_text, page_records=None):
+    structured_data = extract_with_templates(cleaned_text)
+    if structured_data:
+        return structured_data
+    prefilled = prefill_from_key_values(page_records)
+    if prefilled:
+        record_stat("kv_prefilled", stats=EXTRACTION_STATS)
+        record_stat("kv_fields", len(prefilled), stats=EXTRACTION_STATS)
+    if batchable(cleaned_text) and unresolved_fields(prefilled):
+        return overlay_prefilled(get_structured_data_batched(cleaned_text), prefilled)
+    if prefilled:
+        return get_remaining_fields_from_text(cleaned_text, prefilled)
+    return get_structured_data_from_text(cleaned_text)
+
+# Batched extraction for bulk backfills: short documents from concurrent workers are packed
+# into one request (one system prompt for several permits) bounded by a text token budget.
+# Each worker blocks on its own future; a batch is sent when it is full or after
+# STRUCTURING_BATCH_WAIT_SECONDS. Documents missing from the answer fall back to a single call.
+# Batching wins over the partial (KV pre-filled) prompt: a short document with pre-filled fields
+# is batched for every field and the pre-filled values are laid over the batched answer.
+STRUCTURING_BATCH = os.getenv("STRUCTURING_BATCH", "0") == "1"
+STRUCTURING_BATCH_MAX_DOCUMENTS = int(os.getenv("STRUCTURING_BATCH_MAX_DOCUMENTS", "8"))
+STRUCTURING_BATCH_TOKEN_BUDGET = int(os.getenv("STRUCTURING_BATCH_TOKEN_BUDGET", "6000"))
+STRUCTURING_BATCH_DOCUMENT_MAX_TOKENS = int(os.getenv("STRUCTURING_BATCH_DOCUMENT_MAX_TOKENS", "1500"))
+STRUCTURING_BATCH_WAIT_SECONDS = float(os.getenv("STRUCTURING_BATCH_WAIT_SECONDS", "2.0"))
+
+BATCH_STATS = {"batches": 0, "documents": 0, "fallbacks": 0}
+
+def batchable(raw_text):
+    return STRUCTURING_BATCH and estimate_tokens(trim_boilerplate(raw_text)) <= STRUCTURING_BATCH_DOCUMENT_MAX_TOKENS
+
+def batch_structuring_cache_key(raw_text):
+    return stage_key("batch", STRUCTURING_BATCH_SYSTEM_PROMPT, STRUCTURING_BATCH_JSON_SYSTEM_PROMPT,
+                     STRUCTURING_BATCH_USER_INSTRUCTION, structuring_cache_key(raw_text))
+
+def batch_response_format():
+    document_schema = response_format(["id"] + SCHEMA_FIELDS)["json_schema"]["schema"]
+    document_schema["properties"]["id"] = {"type": "integer"}
+    schema = {
+        "type": "object",
+        "properties": {"documents": {"type": "array", "items": document_schema}},
+        "required": ["documents"],
+        "additionalProperties": False,
+    }
+    return {"type": "json_schema", "json_schema": {"name": "permit_batch", "strict": True, "schema": schema}}
+
+def build_batch_structuring_request(raw_texts, json_mode=False):
+    texts = [trim_boilerplate(t) for t in raw_texts]
+    documents = "\n".join(f'<document id="{i}">\n{t}\n</document>' for i, t in enumerate(texts, 1))
+    text_tokens = sum(estimate_tokens(t) for t in texts)
+    output_tokens = len(texts) * STRUCTURING_JSON_OUTPUT_BASE_TOKENS + text_tokens // 8
+    data = {
+        "messages": [
+            {"role": "system", "content": STRUCTURING_BATCH_JSON_SYSTEM_PROMPT if json_mode else STRUCTURING_BATCH_SYSTEM_PROMPT},
+            {"role": "user", "content": [
+                {"type": "text", "text": STRUCTURING_BATCH_USER_INSTRUCTION},
+                {"type": "text", "text": documents}
+            ]}
+        ],
+        "max_tokens": min(STRUCTURING_MAX_TOKENS, output_tokens + (0 if json_mode else STRUCTURING_OUTPUT_BASE_TOKENS)),
+        "temperature": 0.0
+    }
+    if json_mode:
+        data["response_format"] = batch_response_format()
+    return data
+
+def structure_batch(raw_texts):
+    """Structured data for several documents from one request; a list aligned with raw_texts."""
+    record_stat("batches", stats=BATCH_STATS)
+    record_stat("documents", len(raw_texts), stats=BATCH_STATS)
+    try:
+        parsed, responses, data = post_structuring_request(
+            lambda json_mode: build_batch_structuring_request(raw_texts, json_mode)
+        )
+    except Exception as e:
+        print(f"Batched extraction failed ({e}); extracting documents one by one")
+        parsed, responses, data = None, [], None
+    # A truncated answer can end in a partial document; only complete ones are used (and cached)
+    by_id = {}
+    for document in (parsed or {}).get("documents") or []:
+        if (isinstance(document, dict) and isinstance(document.get("id"), int)
+                and all(field in document for field in SCHEMA_FIELDS)):
+            by_id[document.pop("id")] = document
+
+    results = []
+    for i, raw_text in enumerate(raw_texts, 1):
+        structured_data = by_id.get(i)
+        if structured_data:
+            structured_data["Token_Usage"] = token_usage(data, responses, raw_text, len(raw_texts))
+            cache_put("structured_batch", batch_structuring_cache_key(raw_text), structured_data)
+        else:
+            record_stat("fallbacks", stats=BATCH_STATS)
+            structured_data = get_structured_data_from_text(raw_text)
+        results.append(structured_data)
+    return results
+
+class StructuringBatcher:
+    """Collects batchable documents from concurrent workers and sends them as batched requests."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = []
+        self._tokens = 0
+        self._timer = None
+
+    def submit(self, raw_text):
+        future = concurrent.futures.Future()
+        tokens = estimate_tokens(trim_boilerplate(raw_text))
+        ready = []
+        with self._lock:
+            if self._pending and self._tokens + tokens > STRUCTURING_BATCH_TOKEN_BUDGET:
+                ready.append(self._take())
+            self._pending.append((raw_text, future))
+            self._tokens += tokens
+            if len(self._pending) >= STRUCTURING_BATCH_MAX_DOCUMENTS:
+                ready.append(self._take())
+            elif self._timer is None:
+                self._timer = threading.Timer(STRUCTURING_BATCH_WAIT_SECONDS, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+        # Full batches are sent from the submitting worker, partial ones from the timer thread
+        for batch in ready:
+            self._send(batch)
+        return future
+
+    def _take(self):
+        batch, self._pending, self._tokens = self._pending, [], 0
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def _flush(self):
+        with self._lock:
+            self._timer = None
+            batch = self._take() if self._pending else []
+        if batch:
+            self._send(batch)
+
+    def _send(self, batch):
+        try:
+            results = structure_batch([raw_text for raw_text, _ in batch])
+        except Exception as e:
+            print(f"Batched extraction error: {e}")
+            results = [None] * len(batch)
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+structuring_batcher = StructuringBatcher()
+
+def get_structured_data_batched(raw_text):
+    cached = cache_get("structured_batch", batch_structuring_cache_key(raw_text))
+    if cached is not None:
+        return cached
+    return structuring_batcher.submit(raw_text).result()
+
 def standardize_date(date_str):
     """(unchanged) Convert date to dd-mmm-yyyy format"""
     if not date_str or date_str in ["missing", "[unclear]"]:
@@ -452,87 +1356,20 @@ def merge_json_objects(json_objects, page_count):
                         merged_data[key] = f"{merged_data[key]} / {value}"
     return merged_data
 
-def flatten_json(nested_json):
-    flat = {}
-    for key, value in nested_json.items():
-        if isinstance(value, dict):
-            for subkey, subvalue in value.items():
-                flat[subkey] = subvalue
-        else:
-            flat[key] = value
-    return flat
+# Export mapping and writers live in exporters.py, shared with the Streamlit app
+EXPORT_FORMAT = os.getenv("EXPORT_FORMAT", "xlsx")  # xlsx, csv, jsonl or parquet
+EXPORT_TEXT_COLUMNS = os.getenv("EXPORT_TEXT_COLUMNS", "1") != "0"
 
-# NEW: helpers for export mapping
-def _extract_year(s: str | None) -> int | None:
-    if not s:
-        return None
-    m = re.search(r"(19|20)\d{2}", s)
-    return int(m.group(0)) if m else None
-
-def _validity_31_dec(issue_date: str | None, validity_raw: str | None) -> str:
-    y = _extract_year(validity_raw) or _extract_year(issue_date) or datetime.now().year
-    return f"31-Dec-{y}"
+def save_export(structured_data_list, output_path, fmt=None):
+    """Write the records in EXPORT_FORMAT; output_path's extension is replaced to match the format."""
+    fmt = fmt or EXPORT_FORMAT
+    output_path = f"{os.path.splitext(output_path)[0]}.{fmt}"
+    export_records(structured_data_list, output_path, fmt, include_text=EXPORT_TEXT_COLUMNS)
+    print(f"{fmt.upper()} file saved to: {output_path}")
 
 def save_to_excel(structured_data_list, excel_output_path):
-    # Column names mirror UI labels with spaces -> underscores, in the exact order requested
-    csv_headers = [
-        "Document_Type",
-        "Page_Count",
-        "Name_of_file",
-        "Business_Name_Establishment",
-        "Business_Owner",
-        "Business_Address",
-        "Mayor_Name",
-        "Other_Official_Names",
-        "Other_Official_Titles",
-        "Municipality_City_Template",
-        "Permit_Number",
-        "Issue_Date",
-        "Validity_Date",
-        "Nature_of_Business",
-        "raw_text",
-        "cleaned_text",
-    ]
-
-    flat_data_list = []
-    for item in structured_data_list:
-        flat = flatten_json(item)
-
-        # Map UI-aligned columns
-        flat["Business_Name_Establishment"] = flat.get("Business_Name")
-        flat["Business_Owner"] = flat.get("Business_Owner_Name")
-        flat["Other_Official_Names"] = flat.get("Other_Official_Names", "")
-        # Titles (derive from structured list if present)
-        other_off = flat.get("Other_Officials")
-        if isinstance(other_off, (list, dict)):
-            try:
-                # ensure JSON string for persistence, but "Titles" column expects readable list (semicolon-separated)
-                titles_list = []
-                if isinstance(other_off, list):
-                    titles_list = [ (o.get("title") or "").strip() for o in other_off if (o.get("title") or "").strip() ]
-                flat["Other_Official_Titles"] = "; ".join(titles_list)
-                flat["Other_Officials"] = json.dumps(other_off, ensure_ascii=False)
-            except Exception:
-                flat["Other_Official_Titles"] = ""
-        else:
-            flat["Other_Official_Titles"] = flat.get("Other_Official_Titles", "")
-
-        # Municipality/City Template
-        flat["Municipality_City_Template"] = flat.get("Municipality_Template") or flat.get("Municipality_City") or ""
-
-        # Nature of Business & Validity Date (computed)
-        flat["Nature_of_Business"] = flat.get("Business_Type")
-        flat["Validity_Date"] = _validity_31_dec(flat.get("Issue_Date"), flat.get("Business_Permit_Validity"))
-
-        flat_data_list.append(flat)
-
-    df = pd.DataFrame(flat_data_list)
-    for col in csv_headers:
-        if col not in df.columns:
-            df[col] = None
-    df = df[csv_headers]
-    df.to_excel(excel_output_path, index=False)
-    print(f"Excel file saved to: {excel_output_path}")
+    # Kept for scripts written against the xlsx-only API
+    save_export(structured_data_list, excel_output_path, fmt="xlsx")
 
 
 # --------- Helper: derive structured officials list from cleaned text or legacy string ----------
@@ -566,76 +1403,151 @@ def derive_official_pairs(structured_data, cleaned_text):
     return pairs
 
 # --------------------- PDF/Image processing ---------------------
-def process_pdf(pdf_file, pdf_folder, image_folder):
-    pdf_path = os.path.join(pdf_folder, pdf_file)
-    print(f"Processing PDF: {pdf_file}...")
-    image_paths, page_count = convert_pdf_to_images(pdf_path, image_folder)
-
-    ocr_responses = []
-    base64_data = None
-    for image_path in image_paths:
-        image = Image.open(image_path)
+# Rendering (rasterize + preprocess + encode) is CPU-bound and runs in a dedicated process
+# pool so pdf2image/PIL/OpenCV work scales across cores instead of contending on the GIL in
+# the batch drivers' threads (or the Streamlit server). Workers return picklable encoded page
+# bytes that feed the I/O-bound OCR/LLM stage. CPU_WORKERS=0 renders inline.
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", str(os.cpu_count() or 2)))
+CPU_POOL_START_METHOD = os.getenv("CPU_POOL_START_METHOD", "spawn")
+
+_cpu_pool = None
+
+def get_cpu_pool():
+    global _cpu_pool
+    if _cpu_pool is None and CPU_WORKERS > 0:
+        with _clients_lock:
+            if _cpu_pool is None:
+                # spawn: forking a threaded server process (Streamlit, the batch drivers) is unsafe
+                _cpu_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=CPU_WORKERS, mp_context=multiprocessing.get_context(CPU_POOL_START_METHOD)
+                )
+    return _cpu_pool
+
+def render_pdf_page(pdf_path, image_folder, page_number):
+    image = convert_from_path(pdf_path, first_page=page_number, last_page=page_number)[0]
+    processed_image = preprocess_image(image)
+    image.close()
+    page_bytes = encode_page_image(processed_image)
+    processed_image.close()
+    _save_page_bytes(page_bytes, _pdf_page_path(pdf_path, image_folder, page_number))
+    return page_bytes
+
+def render_pdf_pages(pdf_path, image_folder):
+    # Each page goes straight from rasterization to preprocessing and is released before the next
+    page_images = []
+    for page_number, image in iter_pdf_pages(pdf_path):
         processed_image = preprocess_image(image)
-        processed_image.save(image_path)
-
-        base64_data = convert_image_to_base64(image_path)
-        raw_text_image = get_raw_text(base64_data)
-        if raw_text_image:
-            ocr_responses.append(raw_text_image)
-
-    raw_text = "\n".join(ocr_responses)
-    cleaned_text = clean_ocr_text(raw_text, base64_data)
+        image.close()
+        page_bytes = encode_page_image(processed_image)
+        processed_image.close()
+        _save_page_bytes(page_bytes, _pdf_page_path(pdf_path, image_folder, page_number))
+        page_images.append(page_bytes)
+    return page_images, len(page_images)
+
+def render_image_pages(image_path, output_folder):
+    with Image.open(image_path) as image:
+        processed_image = preprocess_image(image)
+    page_bytes = encode_page_image(processed_image)
+    _save_page_bytes(page_bytes, _processed_image_path(image_path, output_folder))
+    return [page_bytes], 1
+
+def render_and_ocr_pdf(pdf_path, image_folder):
+    """Render pages in the CPU pool and OCR each one as soon as it is ready; both lists keep page order."""
+    pool = get_cpu_pool()
+    if pool is None:
+        page_images, _ = render_pdf_pages(pdf_path, image_folder)
+        return page_images, analyze_pages(page_images)
+
+    page_count = pdf_page_count(pdf_path)
+    render_futures = {pool.submit(render_pdf_page, pdf_path, image_folder, n): n - 1 for n in range(1, page_count + 1)}
+    page_images, page_records = [None] * page_count, [None] * page_count
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(OCR_PAGE_WORKERS, page_count))) as io_pool:
+        ocr_futures = {}
+        for future in concurrent.futures.as_completed(render_futures):
+            index = render_futures[future]
+            page_images[index] = future.result()
+            ocr_futures[io_pool.submit(_analyze_page_limited, page_images[index])] = index
+        for future, index in ocr_futures.items():
+            page_records[index] = future.result()
+    return page_images, page_records
+
+def render_image_in_pool(image_path, output_folder):
+    pool = get_cpu_pool()
+    if pool is None:
+        return render_image_pages(image_path, output_folder)
+    return pool.submit(render_image_pages, image_path, output_folder).result()
 
+def process_image_file(image_path, output_folder):
+    # File-based API for callers outside the pipeline: always writes the processed page and returns its path
+    page_images, page_count = render_image_in_pool(image_path, output_folder)
+    processed_image_path = _processed_image_path(image_path, output_folder)
+    if not SAVE_PAGE_IMAGES:
+        with open(processed_image_path, "wb") as f:
+            f.write(page_images[0])
+    return [processed_image_path], page_count
+
+def save_cleaned_text(file_name, cleaned_text):
     os.makedirs('cleaned_text', exist_ok=True)
-    with open(f'cleaned_text/{pdf_file.replace(".pdf", "")}.txt', 'w', encoding='utf-8') as file:
+    base_name = os.path.splitext(file_name)[0]
+    with open(f'cleaned_text/{base_name}.txt', 'w', encoding='utf-8') as file:
         file.write(cleaned_text)
 
-    structured_api_response = get_structured_data_from_text(cleaned_text)
-    structured_data = structured_api_response or {}
-
+def attach_document_fields(structured_data, file_name, page_count, raw_text, cleaned_text, degraded=False):
     if structured_data:
-        structured_data["Name_of_file"] = pdf_file
+        structured_data["Name_of_file"] = file_name
         structured_data["Page_Count"] = page_count
         structured_data["raw_text"] = raw_text
         structured_data["cleaned_text"] = cleaned_text
         structured_data["Other_Officials"] = derive_official_pairs(structured_data, cleaned_text)
-
+        # Extracted from raw OCR text because cleaning failed: shown to reviewers, never cached
+        if degraded:
+            structured_data["Cleaning_Fallback"] = True
     return structured_data
 
-def process_image(image_file, image_input_folder, image_output_folder):
-    image_path = os.path.join(image_input_folder, image_file)
-    print(f"Processing Image: {image_file}...")
-    image_paths, page_count = process_image_file(image_path, image_output_folder)
-
-    ocr_responses = []
-    base64_data = None
-    for processed_image_path in image_paths:
-        base64_data = convert_image_to_base64(processed_image_path)
-        raw_text_image = get_raw_text(base64_data)
-        if raw_text_image:
-            ocr_responses.append(raw_text_image)
+def ocr_and_clean_pdf(pdf_file, pdf_folder, image_folder):
+    """Everything before extraction: returns (page_records, page_count, raw_text, cleaned_text, degraded)."""
+    pdf_path = os.path.join(pdf_folder, pdf_file)
+    print(f"Processing PDF: {pdf_file}...")
+    if OCR_NATIVE_PDF:
+        # No page images in this mode, so cleaning runs on the OCR text alone
+        page_records = analyze_pdf_pages(pdf_path, OCR_PDF_PAGES)
+        page_count = len(page_records)
+        page_images = []
+    else:
+        page_images, page_records = render_and_ocr_pdf(pdf_path, image_folder)
+        page_count = len(page_images)
 
-    raw_text = "\n".join(ocr_responses)
-    cleaned_text = clean_ocr_text(raw_text, base64_data)
+    raw_text = "\n".join(r["text"] for r in page_records if r and r["text"])
+    cleaned_text, degraded = clean_document(page_records, page_images)
+    save_cleaned_text(pdf_file, cleaned_text)
+    return page_records, page_count, raw_text, cleaned_text, degraded
 
-    os.makedirs('cleaned_text', exist_ok=True)
-    base_name = os.path.splitext(image_file)[0]
-    with open(f'cleaned_text/{base_name}.txt', 'w', encoding='utf-8') as file:
-        file.write(cleaned_text)
+def process_pdf(pdf_file, pdf_folder, image_folder):
+    page_records, page_count, raw_text, cleaned_text, degraded = ocr_and_clean_pdf(pdf_file, pdf_folder, image_folder)
+    structured_data = extract_structured_data(cleaned_text, page_records) or {}
+    return attach_document_fields(structured_data, pdf_file, page_count, raw_text, cleaned_text, degraded)
 
-    structured_api_response = get_structured_data_from_text(cleaned_text)
-    structured_data = structured_api_response or {}
+def ocr_and_clean_image(image_file, image_input_folder, image_output_folder):
+    image_path = os.path.join(image_input_folder, image_file)
+    print(f"Processing Image: {image_file}...")
+    page_images, page_count = render_image_in_pool(image_path, image_output_folder)
+    page_records = analyze_pages(page_images)
 
-    if structured_data:
-        structured_data["Name_of_file"] = image_file
-        structured_data["Page_Count"] = page_count
-        structured_data["raw_text"] = raw_text
-        structured_data["cleaned_text"] = cleaned_text
-        structured_data["Other_Officials"] = derive_official_pairs(structured_data, cleaned_text)
+    raw_text = "\n".join(r["text"] for r in page_records if r and r["text"])
+    cleaned_text, degraded = clean_document(page_records, page_images)
+    save_cleaned_text(image_file, cleaned_text)
+    return page_records, page_count, raw_text, cleaned_text, degraded
 
-    return structured_data
+def process_image(image_file, image_input_folder, image_output_folder):
+    page_records, page_count, raw_text, cleaned_text, degraded = ocr_and_clean_image(image_file, image_input_folder, image_output_folder)
+    structured_data = extract_structured_data(cleaned_text, page_records) or {}
+    return attach_document_fields(structured_data, image_file, page_count, raw_text, cleaned_text, degraded)
 
 # --------- CLI entry (optional local run) ---------
+# OFFLINE_BATCH=1 sends extraction through the provider's batch API instead (batch_jobs.py)
+OFFLINE_BATCH = os.getenv("OFFLINE_BATCH", "0") == "1"
+OFFLINE_BATCH_JOB_DIR = os.getenv("OFFLINE_BATCH_JOB_DIR", os.path.join("output", "batch_job"))
+
 def main():
     pdf_folder = r"C:\path\to\input\pdfs"
     image_input_folder = r"C:\path\to\input\images"
@@ -652,9 +1564,19 @@ def main():
     pdf_files = [f for f in os.listdir(pdf_folder)] if os.path.exists(pdf_folder) else []
     image_files = [f for f in os.listdir(image_input_folder)] if os.path.exists(image_input_folder) else []
 
+    if OFFLINE_BATCH:
+        from batch_jobs import run_offline
+        paths = [os.path.join(pdf_folder, f) for f in pdf_files] + [os.path.join(image_input_folder, f) for f in image_files]
+        run_offline(paths, OFFLINE_BATCH_JOB_DIR, excel_output)
+        return
+
     if pdf_files:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
-            futures = {executor.submit(process_pdf, pdf_file, pdf_folder, pdf_image_output_folder): pdf_file for pdf_file in pdf_files}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=PIPELINE_WORKERS) as executor:
+            futures = {
+                executor.submit(cached_process, os.path.join(pdf_folder, pdf_file),
+                                lambda p: process_pdf(os.path.basename(p), pdf_folder, pdf_image_output_folder)): pdf_file
+                for pdf_file in pdf_files
+            }
             for future in concurrent.futures.as_completed(futures):
                 pdf_file = futures[future]
                 try:
@@ -665,8 +1587,12 @@ def main():
                     print(f"{pdf_file} generated an exception: {exc}")
 
     if image_files:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
-            futures = {executor.submit(process_image, image_file, image_input_folder, image_output_folder): image_file for image_file in image_files}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=PIPELINE_WORKERS) as executor:
+            futures = {
+                executor.submit(cached_process, os.path.join(image_input_folder, image_file),
+                                lambda p: process_image(os.path.basename(p), image_input_folder, image_output_folder)): image_file
+                for image_file in image_files
+            }
             for future in concurrent.futures.as_completed(futures):
                 image_file = futures[future]
                 try:
@@ -677,25 +1603,42 @@ def main():
                     print(f"{image_file} generated an exception: {exc}")
 
     if structured_data_list:
-        save_to_excel(structured_data_list, excel_output)
+        save_export(structured_data_list, excel_output)
     else:
         print("No structured data extracted.")
+    print(f"OCR fast path: {FAST_PATH_STATS}")
+    print(f"Extraction: {EXTRACTION_STATS}")
+    print(f"Structuring tokens: {TOKEN_STATS}")
+    print(f"Prompt cache: {prompt_cache_report()}")
+    print(f"Rate limiting: {RATE_LIMIT_STATS}")
+    if STRUCTURING_BATCH:
+        print(f"Batched extraction: {BATCH_STATS}")
 
 def process_permit(file_path):
+    return cached_process(file_path, _process_permit_uncached)
+
+PDF_IMAGE_OUTPUT_FOLDER = os.path.join("output", "pdf_images")
+PROCESSED_IMAGE_OUTPUT_FOLDER = os.path.join("output", "processed_images")
+IMAGE_EXTENSIONS = [".jpg", ".jpeg", ".png"]
+
+def _process_permit_uncached(file_path, pdf_fn=process_pdf, image_fn=process_image):
     ext = os.path.splitext(file_path)[1].lower()
     if ext == ".pdf":
         pdf_folder = os.path.dirname(file_path)
-        image_output_folder = os.path.join("output", "pdf_images")
+        image_output_folder = PDF_IMAGE_OUTPUT_FOLDER
         os.makedirs(image_output_folder, exist_ok=True)
-        return process_pdf(os.path.basename(file_path), pdf_folder, image_output_folder)
-    elif ext in [".jpg", ".jpeg", ".png"]:
+        return pdf_fn(os.path.basename(file_path), pdf_folder, image_output_folder)
+    elif ext in IMAGE_EXTENSIONS:
         image_folder = os.path.dirname(file_path)
-        image_output_folder = os.path.join("output", "processed_images")
+        image_output_folder = PROCESSED_IMAGE_OUTPUT_FOLDER
         os.makedirs(image_output_folder, exist_ok=True)
-        return process_image(os.path.basename(file_path), image_folder, image_output_folder)
+        return image_fn(os.path.basename(file_path), image_folder, image_output_folder)
     else:
         raise ValueError(f"Unsupported file type: {ext}")
 
+def ocr_and_clean_file(file_path):
+    return _process_permit_uncached(file_path, ocr_and_clean_pdf, ocr_and_clean_image)
+
 if __name__ == "__main__":
     try:
         main()
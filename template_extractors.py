@@ -0,0 +1,208 @@
+# template_extractors.py - deterministic extraction for known municipal permit templates
+# - A template is recognised by anchor phrases in the header (first HEADER_LINES lines; all
+#   anchors must match) plus at least one of its layout markers anywhere in the text, so a city
+#   that only appears in an address further down never selects that city's template
+# - Fields are read from "LABEL: value" or "LABEL" + next-line layouts, the mayor and other
+#   officials from signature blocks (name line directly above the title line)
+# - Results follow the structuring prompt's JSON schema, so main.py can use them in place
+#   of the LLM call and fall back to it when no template matches or a required field is missing
+#
+# New templates: register_template("Pasay City", [r"pasay"], "Pasay City", markers=[...], labels={...})
+# or pass extractor=fn(text, lines) -> dict to override individual fields.
+
+import re
+from datetime import datetime
+
+TEMPLATES_VERSION = "2"
+HEADER_LINES = 10
+
+SCHEMA_FIELDS = [
+    "Municipality_Template",
+    "Document_Type",
+    "Page_Count",
+    "Municipality_City",
+    "Business_Owner_Name",
+    "Mayor_Name",
+    "Business_Name",
+    "Business_Address",
+    "Other_Official_Names",
+    "Permit_Number",
+    "Issue_Date",
+    "Business_Permit_Validity",
+    "Business_Type",
+]
+REQUIRED_FIELDS = ["Business_Name", "Business_Owner_Name", "Permit_Number", "Issue_Date", "Mayor_Name"]
+
+DEFAULT_LABELS = {
+    "Business_Name": [r"business\s+name", r"trade\s+name", r"name\s+of\s+business", r"name\s+of\s+establishment"],
+    "Business_Owner_Name": [r"owner'?s?\s+name", r"name\s+of\s+owner", r"proprietor", r"applicant'?s?\s+name",
+                            r"taxpayer'?s?\s+name", r"pangalan\s+ng\s+may-?ari"],
+    "Business_Address": [r"business\s+address", r"address\s+of\s+business", r"business\s+location"],
+    "Permit_Number": [r"(?:mayor'?s\s+|business\s+)?permit\s+(?:no|number)\.?", r"plate\s+no\.?"],
+    "Issue_Date": [r"date\s+issued", r"issued\s+on", r"date\s+of\s+issuance", r"issue\s+date"],
+    "Business_Permit_Validity": [r"valid\s+until", r"validity", r"expiry\s+date", r"expiration\s+date", r"expires\s+on"],
+    "Business_Type": [r"line\s+of\s+business", r"nature\s+of\s+business", r"kind\s+of\s+business", r"business\s+type"],
+}
+
+MAYOR_TITLE = re.compile(r"^(?:city\s+|municipal\s+)?mayor$|^punong\s+(?:lungsod|bayan)$", re.IGNORECASE)
+OFFICIAL_TITLE = re.compile(
+    r"treasurer|assessor|licensing|bplo|administrator|secretary|clerk|inspector|engineer|officer|chief|head",
+    re.IGNORECASE,
+)
+NAME_LINE = re.compile(r"^(?:(?:Atty|Engr|Dr|Hon|Arch)\.?\s+)?[A-ZÑ][A-Za-zÑñ.,\-' ]+[A-Za-zñ.]$")
+NOT_A_NAME = re.compile(
+    r"\b(?:city|republic|philippines|province|municipality|office|department|permit|business|approved|certified)\b",
+    re.IGNORECASE,
+)
+PERMIT_NUMBER = re.compile(r"[A-Za-z0-9][A-Za-z0-9\-/.]*\d[A-Za-z0-9\-/]*")
+
+_MONTHS = r"(Jan(?:uary)?|Feb(?:ruary)?|Mar(?:ch)?|Apr(?:il)?|May|June?|July?|Aug(?:ust)?|Sep(?:t(?:ember)?)?|Oct(?:ober)?|Nov(?:ember)?|Dec(?:ember)?)"
+FULL_DATE = re.compile(
+    rf"\b{_MONTHS}\.?\s+(\d{{1,2}}),?\s+(\d{{4}})\b"
+    rf"|\b(\d{{1,2}})(?:st|nd|rd|th)?\s+(?:day\s+of\s+)?{_MONTHS}\.?,?\s+(\d{{4}})\b",
+    re.IGNORECASE,
+)
+
+KEY_LABELS = {
+    field: [re.compile(rf"^\s*{p}\s*[:.\-]?\s*$", re.IGNORECASE) for p in patterns]
+    for field, patterns in DEFAULT_LABELS.items()
+}
+
+TEMPLATES = []
+
+def register_template(name, anchors, municipality_city, labels=None, extractor=None, markers=None):
+    """Add a template; labels extend DEFAULT_LABELS per field, extractor(text, lines) overrides fields."""
+    merged_labels = {field: patterns + (labels or {}).get(field, []) for field, patterns in DEFAULT_LABELS.items()}
+    TEMPLATES.append({
+        "name": name,
+        "anchors": [re.compile(a, re.IGNORECASE) for a in anchors],
+        "markers": [re.compile(m, re.IGNORECASE) for m in markers or []],
+        "municipality_city": municipality_city,
+        # (?!\w): a label must end at a word boundary, so "Permit Notice" is not "Permit No"
+        "labels": {field: [re.compile(rf"^\s*(?:{p})(?!\w)\s*[:.\-]?\s*(.*)$", re.IGNORECASE) for p in patterns]
+                   for field, patterns in merged_labels.items()},
+        "extractor": extractor,
+    })
+
+def parse_full_date(value):
+    """dd-mmm-yyyy for a date with day, month name and year; None otherwise (numeric dates are ambiguous)."""
+    m = FULL_DATE.search(value or "")
+    if not m:
+        return None
+    month, day, year = (m.group(1), m.group(2), m.group(3)) if m.group(1) else (m.group(5), m.group(4), m.group(6))
+    try:
+        return datetime.strptime(f"{int(day)} {month[:3].title()} {year}", "%d %b %Y").strftime("%d-%b-%Y")
+    except ValueError:
+        return None
+
+def match_template(text):
+    """Template whose anchors all appear in the header lines and whose layout markers appear in the
+    text; if several qualify, the one whose first anchor comes earliest (the issuing city) wins."""
+    header = "\n".join([ln for ln in text.splitlines() if ln.strip()][:HEADER_LINES])
+    best, best_pos = None, None
+    for template in TEMPLATES:
+        matches = [anchor.search(header) for anchor in template["anchors"]]
+        if not all(matches) or (template["markers"] and not any(m.search(text) for m in template["markers"])):
+            continue
+        if best_pos is None or matches[0].start() < best_pos:
+            best, best_pos = template, matches[0].start()
+    return best
+
+def _is_label(template, line):
+    return any(p.match(line) for patterns in template["labels"].values() for p in patterns)
+
+def _label_value(template, lines, field):
+    for i, line in enumerate(lines):
+        for pattern in template["labels"][field]:
+            m = pattern.match(line)
+            if not m:
+                continue
+            value = m.group(1).strip(" :")
+            if not value and i + 1 < len(lines) and not _is_label(template, lines[i + 1]):
+                value = lines[i + 1]
+            if value:
+                return value
+    return None
+
+def _signatories(lines):
+    """(name, title) pairs where a name-like line sits directly above a title line."""
+    return [
+        (lines[i - 1], line) for i, line in enumerate(lines)
+        if i and NAME_LINE.match(lines[i - 1]) and not NOT_A_NAME.search(lines[i - 1]) and len(line.split()) <= 8
+    ]
+
+def extract_template_fields(template, text):
+    lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
+    data = {field: "None" for field in SCHEMA_FIELDS}
+    data["Municipality_Template"] = template["name"]
+    data["Document_Type"] = "Philippine Business Permit"
+    data["Municipality_City"] = template["municipality_city"]
+
+    for field in ("Business_Name", "Business_Owner_Name", "Business_Address", "Business_Type"):
+        data[field] = _label_value(template, lines, field) or "None"
+
+    for field in ("Permit_Number", "Issue_Date", "Business_Permit_Validity"):
+        value = normalize_field(field, _label_value(template, lines, field))
+        if value:
+            data[field] = value
+
+    officials = []
+    for name, title in _signatories(lines):
+        if MAYOR_TITLE.match(title):
+            data["Mayor_Name"] = name
+        elif OFFICIAL_TITLE.search(title) and not _is_label(template, name):
+            officials.append(f"{name} ({title})")
+    if officials:
+        data["Other_Official_Names"] = "; ".join(officials)
+
+    if template["extractor"]:
+        data.update(template["extractor"](text, lines) or {})
+    return data
+
+def normalize_field(field, value):
+    """Field value in schema form, or None when it cannot be resolved without the LLM."""
+    value = (value or "").strip()
+    if not value:
+        return None
+    if field == "Permit_Number":
+        permit = PERMIT_NUMBER.search(value)
+        return permit.group(0) if permit else None
+    # A missing or unparsable issue date is left unresolved so the LLM decides; validity follows
+    # the prompt's rule that a visible but incomplete date is "[unclear]"
+    if field == "Issue_Date":
+        return parse_full_date(value)
+    if field == "Business_Permit_Validity":
+        return parse_full_date(value) or "[unclear]"
+    return value
+
+def fields_from_key_values(pairs, min_confidence=0.0):
+    """Schema fields read from OCR key-value pairs whose key matches a known label."""
+    fields = {}
+    for pair in pairs:
+        if (pair.get("confidence") or 0.0) < min_confidence:
+            continue
+        for field, patterns in KEY_LABELS.items():
+            if field not in fields and any(p.match(pair.get("key") or "") for p in patterns):
+                value = normalize_field(field, pair.get("value"))
+                if value:
+                    fields[field] = value
+                break
+    return fields
+
+def missing_required_fields(data):
+    return [f for f in REQUIRED_FIELDS if data.get(f) in (None, "", "None", "[unclear]")]
+
+# ---------- Built-in templates ----------
+# Markers are the issuing office (or province) each city prints on its permit
+BPLO = [r"business\s+permits?\s+(?:and|&)\s+licensing\s+office", r"\bbplo\b"]
+
+register_template("Quezon City", [r"quezon\s+city", r"business\s+permit"], "Quezon City",
+                  markers=[r"business\s+permits?\s+(?:and|&)\s+licensing\s+department", r"\bbpld\b"])
+register_template("Manila City", [r"city\s+of\s+manila|manila\s+city", r"(?:mayor'?s|business)\s+permit"], "Manila City",
+                  markers=[r"bureau\s+of\s+permits"])
+register_template("Makati City", [r"makati", r"business\s+permit"], "Makati City",
+                  markers=[r"business\s+permits?\s+office"])
+register_template("Pasig City", [r"pasig", r"business\s+permit"], "Pasig City", markers=BPLO)
+register_template("Taguig City", [r"taguig", r"business\s+permit"], "Taguig City", markers=BPLO)
+register_template("Dasmariñas City", [r"dasmari[nñ]as", r"business\s+permit"], "Dasmariñas City, Cavite",
+                  markers=[r"province\s+of\s+cavite"], labels={"Business_Permit_Validity": [r"valid\s+up\s+to"]})
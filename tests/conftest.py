@@ -0,0 +1,15 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# main.py refuses to import without credentials; the tests never reach the real services
+for name, value in (
+    ("AZURE_OPENAI_ENDPOINT", "http://localhost/openai/deployments/test/chat/completions?api-version=2024-10-21"),
+    ("AZURE_OPENAI_API_KEY", "test"),
+    ("ADI_ENDPOINT", "http://localhost"),
+    ("ADI_API_KEY", "test"),
+    ("RESULT_CACHE", "0"),
+):
+    os.environ.setdefault(name, value)
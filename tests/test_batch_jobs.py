@@ -0,0 +1,83 @@
+import os
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import batch_jobs
+import batch_standin_server
+
+
+@pytest.fixture
+def standin(monkeypatch):
+    server = ThreadingHTTPServer(("localhost", 0), batch_standin_server.Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(batch_jobs, "BATCH_API_BASE_URL", f"http://localhost:{server.server_port}")
+    yield
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def pipeline(monkeypatch, tmp_path):
+    """OCR/cleaning and interactive extraction replaced by canned results; returns the captured calls."""
+    calls = {"fallbacks": [], "exported": []}
+
+    def ocr_and_clean_file(file_path):
+        text = f"Business permit for {os.path.basename(file_path)}"
+        if "fail" in os.path.basename(file_path):
+            text += " FAIL_REQUEST"
+        return [], 1, text, text, False
+
+    def get_structured_data_from_text(text):
+        calls["fallbacks"].append(text)
+        return {"Business_Name": "interactive"}
+
+    monkeypatch.setattr(batch_jobs, "ocr_and_clean_file", ocr_and_clean_file)
+    monkeypatch.setattr(batch_jobs, "get_structured_data_from_text", get_structured_data_from_text)
+    monkeypatch.setattr(batch_jobs, "save_export", lambda records, path: calls["exported"].append(records))
+    monkeypatch.setattr(batch_jobs, "BATCH_POLL_SECONDS", 0)
+    return calls
+
+
+def make_inputs(tmp_path, *names):
+    paths = []
+    for name in names:
+        path = tmp_path / "input" / name
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(name.encode("utf-8"))
+        paths.append(str(path))
+    return paths
+
+
+def names_by_file(records):
+    return {r["Name_of_file"]: r["Business_Name"] for r in records}
+
+
+def test_run_offline_with_failed_line_fallback(standin, pipeline, tmp_path):
+    paths = make_inputs(tmp_path, "a.pdf", "fail.pdf")
+    batch_jobs.run_offline(paths, str(tmp_path / "job"), str(tmp_path / "out.xlsx"))
+
+    job = batch_jobs.load_job(str(tmp_path / "job"))
+    assert [b["status"] for b in job["batches"]] == ["completed"]
+    assert job["batches"][0]["request_counts"] == {"total": 2, "completed": 1, "failed": 1}
+    records = pipeline["exported"][-1]
+    by_file = names_by_file(records)
+    assert by_file["a.pdf"].startswith("standin-")
+    assert by_file["fail.pdf"] == "interactive"
+    assert pipeline["fallbacks"] == ["Business permit for fail.pdf FAIL_REQUEST"]
+
+
+def test_resumed_run_batches_newly_prepared_documents(standin, pipeline, tmp_path):
+    job_dir = str(tmp_path / "job")
+    first, second = make_inputs(tmp_path, "a.pdf", "b.pdf")
+    batch_jobs.run_offline([first], job_dir, str(tmp_path / "out.xlsx"))
+    batch_jobs.run_offline([first, second], job_dir, str(tmp_path / "out.xlsx"))
+
+    job = batch_jobs.load_job(job_dir)
+    assert [b["input_file"] for b in job["batches"]] == ["requests-000.jsonl", "requests-001.jsonl"]
+    assert [line["custom_id"] for line in batch_jobs.read_jsonl(os.path.join(job_dir, "requests-001.jsonl"))] == ["1"]
+    by_file = names_by_file(pipeline["exported"][-1])
+    assert by_file == {"a.pdf": "standin-0", "b.pdf": "standin-1"}
+    assert pipeline["fallbacks"] == []
@@ -0,0 +1,281 @@
+import io
+import json
+import random
+import re
+from datetime import datetime
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import exporters
+from exporters import EXPORT_COLUMNS, export_bytes, export_columns, export_frame, export_frames
+
+
+# ---------- Reference row mapping ----------
+# The per-row rules export_frame replaced, kept here so the column-at-a-time version is pinned to them.
+# Municipality_City_Template follows main.save_to_excel (an empty template falls back to the city); the
+# app's exports used to keep an empty or None template as it was
+def reference_row(data, include_text=True):
+    flat = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            flat.update(value)
+        else:
+            flat[key] = value
+    data = flat
+
+    def year(s):
+        m = re.search(r"(19|20)\d{2}", str(s)) if s else None
+        return int(m.group(0)) if m else None
+
+    titles = [(o.get("title") or "").strip() for o in data.get("Other_Officials") or []]
+    titles = [t for t in titles if t]
+    if not titles:
+        for p in (p.strip() for p in (data.get("Other_Official_Names") or "").split(";")):
+            if "(" in p and ")" in p and p.find("(") < p.find(")"):
+                t = p[p.find("(")+1:p.find(")")].strip()
+            elif " - " in p:
+                t = p.split(" - ", 1)[1].strip()
+            else:
+                t = ""
+            if t:
+                titles.append(t)
+
+    row = {
+        "Document_Type": data.get("Document_Type", ""),
+        "Page_Count": data.get("Page_Count", ""),
+        "Name_of_file": data.get("Name_of_file", ""),
+        "Business_Name_Establishment": data.get("Business_Name", ""),
+        "Business_Owner": data.get("Business_Owner_Name", ""),
+        "Business_Address": data.get("Business_Address", ""),
+        "Mayor_Name": data.get("Mayor_Name", ""),
+        "Other_Official_Names": data.get("Other_Official_Names", ""),
+        "Municipality_City_Template": data.get("Municipality_Template") or data.get("Municipality_City", ""),
+        "Permit_Number": data.get("Permit_Number", ""),
+        "Issue_Date": data.get("Issue_Date", ""),
+        "Nature_of_Business": data.get("Business_Type", ""),
+        "raw_text": data.get("raw_text", ""),
+        "cleaned_text": data.get("cleaned_text", ""),
+    }
+    if str(row["Other_Official_Names"]).strip().lower() in ["none", "null", ""]:
+        row["Other_Official_Titles"] = "None"
+    else:
+        row["Other_Official_Titles"] = "; ".join(dict.fromkeys(titles)) or "None"
+    validity_year = year(data.get("Business_Permit_Validity", "")) or year(row["Issue_Date"]) or datetime.now().year
+    row["Validity_Date"] = f"31-Dec-{validity_year}"
+    return {c: row[c] for c in export_columns(include_text)}
+
+
+def _normalize(value):
+    # Missing values export as "" either way; everything else compares by its text
+    return "" if value is None else str(value)
+
+
+def assert_matches_reference(records, include_text=True):
+    frame = export_frame(records, include_text)
+    expected = [reference_row(r, include_text) for r in records if r]
+    assert list(frame.columns) == export_columns(include_text)
+    got = [{c: _normalize(v) for c, v in row.items()} for row in frame.to_dict(orient="records")]
+    assert got == [{c: _normalize(v) for c, v in row.items()} for row in expected]
+    return frame
+
+
+# ---------- export_frame ----------
+def test_column_mapping():
+    frame = assert_matches_reference([{
+        "Document_Type": "Business Permit",
+        "Page_Count": 2,
+        "Name_of_file": "permit.pdf",
+        "Business_Name": "ABC Store",
+        "Business_Owner_Name": "Juan Dela Cruz",
+        "Business_Address": "12 Main St.",
+        "Mayor_Name": "Maria Santos",
+        "Other_Official_Names": "Pedro Reyes (City Treasurer)",
+        "Municipality_City": "Quezon City",
+        "Permit_Number": "2024-0001",
+        "Issue_Date": "15-Jan-2024",
+        "Business_Permit_Validity": "Valid until December 31, 2024",
+        "Business_Type": "Retail",
+        "raw_text": "raw",
+        "cleaned_text": "clean",
+    }])
+    row = frame.iloc[0]
+    assert row["Business_Name_Establishment"] == "ABC Store"
+    assert row["Other_Official_Titles"] == "City Treasurer"
+    assert row["Municipality_City_Template"] == "Quezon City"
+    assert row["Validity_Date"] == "31-Dec-2024"
+
+
+@pytest.mark.parametrize("names", [None, "", "  ", "None", "null", " NULL "])
+def test_no_other_officials_gives_literal_none(names):
+    frame = assert_matches_reference([{"Other_Official_Names": names,
+                                       "Other_Officials": [{"name": "A", "title": "Clerk"}]}])
+    assert frame.iloc[0]["Other_Official_Titles"] == "None"
+
+
+def test_titles_from_parsed_list_are_deduplicated():
+    frame = assert_matches_reference([{
+        "Other_Official_Names": "A; B; C",
+        "Other_Officials": [{"name": "A", "title": " Treasurer "}, {"name": "B", "title": ""},
+                            {"name": "C", "title": "Treasurer"}, {"name": "D", "title": "Clerk"}],
+    }])
+    assert frame.iloc[0]["Other_Official_Titles"] == "Treasurer; Clerk"
+
+
+@pytest.mark.parametrize("names,titles", [
+    ("A (Treasurer); B - Clerk; C", "Treasurer; Clerk"),
+    ("X (T); Y (T)", "T"),
+    ("a) b (c)", "None"),
+    ("D (); E - ", "None"),
+    ("Just A Name", "None"),
+])
+def test_titles_from_legacy_string(names, titles):
+    frame = assert_matches_reference([{"Other_Official_Names": names, "Other_Officials": []}])
+    assert frame.iloc[0]["Other_Official_Titles"] == titles
+
+
+def test_nested_sections_are_flattened():
+    assert_matches_reference([
+        {"Business_Details": {"Business_Name": "Nested", "Business_Type": "Retail"}},
+        {"Business_Name": "Top", "Business_Details": {"Business_Name": "Nested"}},
+        {"Business_Details": {"Business_Name": "Nested"}, "Business_Name": "Top"},
+    ])
+
+
+def test_sections_without_export_fields_are_ignored():
+    usage = {"prompt_tokens": 950, "completion_tokens": 300, "max_tokens": 1200}
+    assert_matches_reference([
+        {"Business_Name": "Plain", "Page_Count": 1, "Token_Usage": usage},
+        {"Token_Usage": usage, "Business_Details": {"Business_Name": "Nested"}, "Business_Name": "Top"},
+        {"Business_Name": "Top", "Business_Details": {"Business_Name": "Nested"}, "Token_Usage": usage},
+    ])
+
+
+@pytest.mark.parametrize("issue,validity,year", [
+    ("01-Jan-2023", "Valid until 2025", 2025),
+    ("01-Jan-2023", "until revoked", 2023),
+    ("", None, datetime.now().year),
+])
+def test_validity_date(issue, validity, year):
+    frame = assert_matches_reference([{"Issue_Date": issue, "Business_Permit_Validity": validity}])
+    assert frame.iloc[0]["Validity_Date"] == f"31-Dec-{year}"
+
+
+def test_municipality_template_wins_over_city():
+    frame = assert_matches_reference([
+        {"Municipality_Template": "Makati", "Municipality_City": "Makati City"},
+        {"Municipality_Template": "", "Municipality_City": "Pasig City"},
+        {"Municipality_Template": None, "Municipality_City": "Taguig City"},
+        {"Municipality_City": "Quezon City"},
+        {"Municipality_Template": None},
+    ])
+    # Unlike the app's old exports, an empty or None template never leaves the column blank when there is a city
+    assert frame["Municipality_City_Template"].tolist() == ["Makati", "Pasig City", "Taguig City", "Quezon City", ""]
+
+
+def test_missing_fields_and_empty_records():
+    frame = assert_matches_reference([{}, None, {"Business_Name": "Only"}, {}])
+    assert len(frame) == 1
+
+
+def test_without_text_columns():
+    frame = assert_matches_reference([{"raw_text": "raw", "cleaned_text": "clean"}], include_text=False)
+    assert "raw_text" not in frame.columns and "cleaned_text" not in frame.columns
+
+
+def test_page_count_keeps_integers():
+    frame = export_frame([{"Page_Count": 3}, {"Page_Count": None}, {"Name_of_file": "a.pdf"}])
+    assert [_normalize(v) for v in frame["Page_Count"]] == ["3", "", ""]
+
+
+def test_random_records_match_reference():
+    rng = random.Random(1)
+    values = ["", None, "None", "null", "2023", "01-Jan-2024", "Valid until 2025", "x",
+              "A (Treasurer); B - Clerk; C", "a) b (c)", "D (); E - ", "X (T); Y (T)"]
+    fields = ["Document_Type", "Name_of_file", "Business_Name", "Business_Owner_Name", "Business_Address",
+              "Mayor_Name", "Other_Official_Names", "Municipality_Template", "Municipality_City", "Permit_Number",
+              "Issue_Date", "Business_Permit_Validity", "Business_Type", "raw_text", "cleaned_text"]
+    records = []
+    for _ in range(500):
+        record = {k: rng.choice(values) for k in fields if rng.random() < 0.8}
+        if rng.random() < 0.8:
+            record["Page_Count"] = rng.choice([1, 2, "", None])
+        if rng.random() < 0.4:
+            record["Other_Officials"] = [{"name": "n", "title": rng.choice(["", "T1", "T2", " T1 "])}
+                                         for _ in range(rng.randint(0, 3))]
+        records.append(record)
+    assert_matches_reference(records)
+
+
+def test_chunks_match_single_frame():
+    records = [{"Business_Name": f"B{i}", "Page_Count": i} for i in range(25)]
+    chunks = list(export_frames(records, chunk_rows=10))
+    assert [len(c) for c in chunks] == [10, 10, 5]
+    assert pd.concat(chunks, ignore_index=True).equals(export_frame(records).reset_index(drop=True))
+
+
+# ---------- Writers ----------
+RECORDS = [
+    {"Business_Name": "ABC Store", "Page_Count": 1, "Other_Official_Names": "A (Treasurer)", "Issue_Date": "2024"},
+    {"Business_Name": "Ñiño's", "Page_Count": None, "Other_Official_Names": None},
+]
+
+
+def test_csv_round_trip():
+    frame = pd.read_csv(io.BytesIO(export_bytes(RECORDS, "csv")), dtype=str, keep_default_na=False)
+    assert list(frame.columns) == EXPORT_COLUMNS
+    assert frame["Business_Name_Establishment"].tolist() == ["ABC Store", "Ñiño's"]
+    assert frame["Other_Official_Titles"].tolist() == ["Treasurer", "None"]
+
+
+def test_jsonl_round_trip():
+    rows = [json.loads(line) for line in export_bytes(RECORDS, "jsonl", include_text=False).decode("utf-8").splitlines()]
+    assert [list(r) for r in rows] == [export_columns(False)] * 2
+    assert rows[0]["Validity_Date"] == "31-Dec-2024"
+    assert rows[1]["Business_Name_Establishment"] == "Ñiño's"
+
+
+@pytest.mark.parametrize("write_only", [False, True])
+def test_xlsx_round_trip(monkeypatch, write_only):
+    monkeypatch.setattr(exporters, "EXCEL_WRITE_ONLY", write_only)
+    frame = pd.read_excel(io.BytesIO(export_bytes(RECORDS + [{"Business_Name": "Half", "Page_Count": 2.5}], "xlsx")),
+                          sheet_name="extracted", dtype=object, keep_default_na=False)
+    assert list(frame.columns) == EXPORT_COLUMNS
+    assert frame["Business_Name_Establishment"].tolist() == ["ABC Store", "Ñiño's", "Half"]
+    assert frame["Page_Count"].tolist() == [1, "", 2.5]
+    assert frame["Other_Official_Titles"].tolist() == ["Treasurer", "None", "None"]
+
+
+def test_parquet_round_trip():
+    table = pq.read_table(io.BytesIO(export_bytes(RECORDS, "parquet", include_text=False)))
+    assert table.column_names == export_columns(False)
+    assert table.schema.field("Page_Count").type == pa.int64()
+    assert table.column("Page_Count").to_pylist() == [1, None]
+    assert table.column("Business_Name_Establishment").to_pylist() == ["ABC Store", "Ñiño's"]
+    assert table.column("Validity_Date").to_pylist()[0] == "31-Dec-2024"
+
+
+def test_parquet_fractional_page_count():
+    records = [{"Business_Name": "Half", "Page_Count": 2.5}, {"Business_Name": "Two", "Page_Count": 2}]
+    table = pq.read_table(io.BytesIO(export_bytes(records, "parquet")))
+    assert table.schema.field("Page_Count").type == pa.float64()
+    assert table.column("Page_Count").to_pylist() == [2.5, 2.0]
+
+
+def test_parquet_fractional_page_count_after_the_first_chunk(monkeypatch):
+    monkeypatch.setattr(exporters, "EXPORT_CHUNK_ROWS", 1)
+    records = [{"Business_Name": "Two", "Page_Count": 2}, {"Business_Name": "Half", "Page_Count": 2.5}]
+    table = pq.read_table(io.BytesIO(export_bytes(records, "parquet")))
+    assert table.schema.field("Page_Count").type == pa.int64()
+    assert table.column("Page_Count").to_pylist() == [2, None]
+    assert table.column("Business_Name_Establishment").to_pylist() == ["Two", "Half"]
+
+
+def test_empty_export():
+    assert export_bytes([], "csv").decode("utf-8").strip() == ",".join(EXPORT_COLUMNS)
+    assert export_bytes([], "jsonl") == b""
+    table = pq.read_table(io.BytesIO(export_bytes([], "parquet")))
+    assert table.column_names == EXPORT_COLUMNS and table.num_rows == 0
+    assert list(pd.read_excel(io.BytesIO(export_bytes([], "xlsx"))).columns) == EXPORT_COLUMNS
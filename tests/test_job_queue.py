@@ -0,0 +1,67 @@
+import pytest
+
+import job_queue
+
+
+@pytest.fixture(autouse=True)
+def queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_queue, "JOB_QUEUE_PATH", str(tmp_path / "jobs.sqlite"))
+    monkeypatch.setattr(job_queue._local, "conn", None, raising=False)
+    yield
+    job_queue._local.conn.close()
+
+
+def _age(file_path, started, heartbeat):
+    job_queue._conn().execute("UPDATE jobs SET started_at = ?, heartbeat_at = ? WHERE file_path = ?",
+                              (started, heartbeat, file_path))
+
+
+def test_heartbeat_renews_only_until_the_deadline(monkeypatch):
+    monkeypatch.setattr(job_queue, "JOB_LEASE_SECONDS", 10)
+    monkeypatch.setattr(job_queue, "JOB_MAX_SECONDS", 100)
+    job_queue.enqueue("slow.pdf", ("a",))
+    job_queue.enqueue("hung.pdf", ("b",))
+    assert job_queue.claim_job("w1") is not None and job_queue.claim_job("w1") is not None
+    now = job_queue.time.time()
+    _age("slow.pdf", now - 50, now - 20)
+    _age("hung.pdf", now - 500, now - 20)
+
+    job_queue.heartbeat("w1")
+
+    # The slow document keeps its lease; the hung one is handed to another worker
+    assert job_queue.claim_job("w2") == ("hung.pdf", '["b"]')
+    assert job_queue.claim_job("w2") is None
+
+
+def test_hung_job_fails_after_max_attempts(monkeypatch):
+    monkeypatch.setattr(job_queue, "JOB_LEASE_SECONDS", 10)
+    monkeypatch.setattr(job_queue, "JOB_MAX_SECONDS", 100)
+    monkeypatch.setattr(job_queue, "JOB_MAX_ATTEMPTS", 2)
+    job_queue.enqueue("hung.pdf", ("a",))
+    for _ in range(2):
+        assert job_queue.claim_job("w1") is not None
+        now = job_queue.time.time()
+        _age("hung.pdf", now - 500, now - 20)
+        job_queue.heartbeat("w1")
+
+    assert job_queue.claim_job("w1") is None
+    status = job_queue.job_statuses(["hung.pdf"])["hung.pdf"]
+    assert status["status"] == "failed" and status["attempts"] == 2
+
+
+def test_retry_requeues_failed_jobs_only(monkeypatch):
+    monkeypatch.setattr(job_queue, "JOB_MAX_ATTEMPTS", 1)
+    job_queue.enqueue("bad.pdf", ("a",))
+    job_queue.enqueue("good.pdf", ("b",))
+    job_queue.claim_job("w1")
+    job_queue.fail_job("bad.pdf", '["a"]', "boom")
+    job_queue.claim_job("w1")
+    job_queue.complete_job("good.pdf", '["b"]', {"Business_Name": "ABC"})
+
+    job_queue.retry_jobs(["bad.pdf", "good.pdf"])
+
+    statuses = job_queue.job_statuses(["bad.pdf", "good.pdf"])
+    assert statuses["bad.pdf"]["status"] == "queued" and statuses["bad.pdf"]["attempts"] == 0
+    assert statuses["bad.pdf"]["error"] is None
+    assert statuses["good.pdf"]["status"] == "done"
+    assert job_queue.claim_job("w1") == ("bad.pdf", '["a"]')
@@ -0,0 +1,64 @@
+from json_repair import json_fragment, parse_json_tolerant, repair_json
+
+
+def test_plain_json():
+    assert parse_json_tolerant('{"a": "1", "b": ["x", "y"]}') == {"a": "1", "b": ["x", "y"]}
+
+
+def test_wrapper_text_is_ignored():
+    text = ('Some reasoning first.\n<initial_attempt>\n```json\n{"Business_Name": "ABC {Store}"}\n```\n'
+            '</initial_attempt>\n<answer>{"Business_Name": "other"}</answer>')
+    assert parse_json_tolerant(text) == {"Business_Name": "ABC {Store}"}
+
+
+def test_fenced_json_with_trailing_text():
+    assert parse_json_tolerant('```json\n{"a": "1"}\n```\nDone.') == {"a": "1"}
+
+
+def test_text_after_object_is_ignored():
+    assert parse_json_tolerant('{"a": "1"} and then {"b": "2"}') == {"a": "1"}
+
+
+def test_trailing_commas():
+    assert parse_json_tolerant('{"a": "1", "b": ["x", "y",],}') == {"a": "1", "b": ["x", "y"]}
+
+
+def test_raw_newlines_and_tabs_in_strings():
+    assert parse_json_tolerant('{"address": "12 Main St.\n\tQuezon City"}') == {"address": "12 Main St.\n\tQuezon City"}
+
+
+def test_truncated_string():
+    assert parse_json_tolerant('{"a": "1", "b": "Santos Gen') == {"a": "1", "b": "Santos Gen"}
+
+
+def test_truncated_after_escape():
+    assert parse_json_tolerant('{"a": "say \\') == {"a": "say "}
+
+
+def test_dangling_key():
+    assert parse_json_tolerant('{"a": "1", "Mayor_Name"') == {"a": "1", "Mayor_Name": None}
+    assert parse_json_tolerant('{"a": "1", "Mayor_Name":') == {"a": "1", "Mayor_Name": None}
+    assert parse_json_tolerant('{"a": "1", "Mayor_Na') == {"a": "1", "Mayor_Na": None}
+
+
+def test_dangling_key_before_close():
+    assert repair_json('{"a": "1", "b"}') == '{"a": "1", "b": null}'
+
+
+def test_truncated_nested_containers():
+    text = '{"documents": [{"id": 1, "Business_Name": "A"}, {"id": 2, "Business_Name": "B'
+    assert parse_json_tolerant(text) == {"documents": [{"id": 1, "Business_Name": "A"}, {"id": 2, "Business_Name": "B"}]}
+
+
+def test_no_object():
+    assert parse_json_tolerant("I could not read this permit.") is None
+    assert parse_json_tolerant("") is None
+    assert parse_json_tolerant(None) is None
+
+
+def test_top_level_array_is_not_an_object():
+    assert parse_json_tolerant('["a", "b"]') is None
+
+
+def test_json_fragment_prefers_initial_attempt():
+    assert json_fragment('{"x": 1} <initial_attempt>{"y": 2}</initial_attempt>') == '{"y": 2}'
@@ -0,0 +1,48 @@
+import json
+
+import main
+from template_extractors import SCHEMA_FIELDS
+
+
+def completion(content, finish_reason="stop"):
+    return {"choices": [{"message": {"content": content}, "finish_reason": finish_reason}], "usage": {}}
+
+
+def test_truncated_batch_entries_fall_back_to_single_calls(monkeypatch):
+    complete = dict({field: "None" for field in SCHEMA_FIELDS}, id=1, Business_Name="ABC Trading")
+    truncated = json.dumps({"documents": [complete]})[:-2] + ', {"id": 2, "Business_Na'
+    monkeypatch.setattr(main, "post_chat_completion", lambda data: completion(truncated, "length"))
+    fallbacks, cached = [], []
+    monkeypatch.setattr(main, "get_structured_data_from_text", lambda text: fallbacks.append(text) or {"single": text})
+    monkeypatch.setattr(main, "cache_put", lambda namespace, key, value: cached.append(namespace))
+
+    results = main.structure_batch(["first permit", "second permit"])
+
+    assert results[0]["Business_Name"] == "ABC Trading"
+    assert results[1] == {"single": "second permit"}
+    assert fallbacks == ["second permit"]
+    assert cached == ["structured_batch"]
+
+
+def test_prefilled_documents_are_batched(monkeypatch):
+    answer = dict({field: "None" for field in SCHEMA_FIELDS}, id=1, Business_Name="ABC Trading",
+                  Business_Owner_Name="Model Guess")
+    requests = []
+    monkeypatch.setattr(main, "STRUCTURING_BATCH", True)
+    monkeypatch.setattr(main, "KV_PREFILL", True)
+    monkeypatch.setattr(main, "STRUCTURING_BATCH_WAIT_SECONDS", 0.01)
+    monkeypatch.setattr(main, "post_chat_completion",
+                        lambda data: requests.append(data) or completion(json.dumps({"documents": [answer]})))
+    monkeypatch.setattr(main, "get_remaining_fields_from_text", lambda text, prefilled: {"partial": text})
+    monkeypatch.setattr(main, "cache_put", lambda namespace, key, value: None)
+    page_records = [{"text": "short permit", "key_value_pairs": [
+        {"key": "Owner's Name", "value": "JUAN DELA CRUZ", "confidence": 0.99},
+    ]}]
+
+    structured_data = main.extract_structured_data("short permit", page_records)
+
+    assert len(requests) == 1
+    assert requests[0]["messages"][0]["content"] in (main.STRUCTURING_BATCH_SYSTEM_PROMPT,
+                                                     main.STRUCTURING_BATCH_JSON_SYSTEM_PROMPT)
+    assert structured_data["Business_Name"] == "ABC Trading"
+    assert structured_data["Business_Owner_Name"] == "JUAN DELA CRUZ"
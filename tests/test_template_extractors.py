@@ -0,0 +1,98 @@
+import template_extractors as te
+
+QUEZON_CITY_PERMIT = """Republic of the Philippines
+Quezon City
+Business Permit and Licensing Department
+MAYOR'S PERMIT
+Permit No.: 2024-QC-001234
+Business Name: Santos General Merchandise
+Owner's Name
+Maria Santos-Cruz
+Business Address: 12 Main St., Brgy. Bagumbayan, Quezon City, Metro Manila
+Line of Business: Retail
+Date Issued: January 15, 2024
+Valid until the end of ___ quarter, 2024
+Engr. Roberto Martinez
+City Treasurer
+Ma. Josefina G. Belmonte
+City Mayor
+"""
+
+CEBU_PERMIT = """Republic of the Philippines
+City of Cebu
+Office of the City Mayor
+Business Permit and Licensing Office
+BUSINESS PERMIT
+Permit No.: 2024-CEB-0042
+Business Name: Reyes Hardware
+Owner's Name: Jose Reyes
+Line of Business: Hardware
+Date Issued: March 3, 2024
+Michael L. Rama
+City Mayor
+Business Address: 45 Kamuning Road, Quezon City
+"""
+
+
+def test_match_template_uses_header_and_marker():
+    assert te.match_template(QUEZON_CITY_PERMIT)["name"] == "Quezon City"
+
+
+def test_city_in_address_does_not_select_template():
+    assert te.match_template(CEBU_PERMIT) is None
+
+
+def test_anchor_below_header_does_not_match():
+    text = "\n".join(["Republic of the Philippines"] + ["filler"] * te.HEADER_LINES) + "\n" + QUEZON_CITY_PERMIT
+    assert te.match_template(text) is None
+
+
+def test_missing_layout_marker_does_not_match():
+    text = QUEZON_CITY_PERMIT.replace("Business Permit and Licensing Department", "Office of the City Mayor")
+    assert te.match_template(text) is None
+
+
+def test_issuing_city_wins_over_later_anchor():
+    text = "City of Pasig\nBusiness Permit and Licensing Office\nBusiness Permit\nBranch office: Taguig\n"
+    assert te.match_template(text)["name"] == "Pasig City"
+
+
+def test_extract_template_fields():
+    data = te.extract_template_fields(te.match_template(QUEZON_CITY_PERMIT), QUEZON_CITY_PERMIT)
+    assert data["Municipality_City"] == "Quezon City"
+    assert data["Permit_Number"] == "2024-QC-001234"
+    assert data["Business_Name"] == "Santos General Merchandise"
+    assert data["Business_Owner_Name"] == "Maria Santos-Cruz"
+    assert data["Issue_Date"] == "15-Jan-2024"
+    assert data["Business_Permit_Validity"] == "[unclear]"
+    assert data["Mayor_Name"] == "Ma. Josefina G. Belmonte"
+    assert data["Other_Official_Names"] == "Engr. Roberto Martinez (City Treasurer)"
+    assert te.missing_required_fields(data) == []
+
+
+def test_label_needs_word_boundary():
+    template = te.TEMPLATES[0]
+    lines = ["Permit Notice 2024 below", "Proprietorship: Single"]
+    assert te._label_value(template, lines, "Permit_Number") is None
+    assert te._label_value(template, lines, "Business_Owner_Name") is None
+
+
+def test_label_with_delimiter_or_next_line_value():
+    template = te.TEMPLATES[0]
+    assert te._label_value(template, ["Permit No.123-A"], "Permit_Number") == "123-A"
+    assert te._label_value(template, ["Proprietor", "Juan Dela Cruz"], "Business_Owner_Name") == "Juan Dela Cruz"
+
+
+def test_parse_full_date():
+    assert te.parse_full_date("15th day of March, 2024") == "15-Mar-2024"
+    assert te.parse_full_date("Sept. 1, 2023") == "01-Sep-2023"
+    assert te.parse_full_date("03/04/2024") is None
+
+
+def test_fields_from_key_values():
+    pairs = [
+        {"key": "Permit No.", "value": "No. 2024-0001", "confidence": 0.95},
+        {"key": "Business Name", "value": "ABC Trading", "confidence": 0.5},
+        {"key": "Date Issued", "value": "01/02/2024", "confidence": 0.99},
+    ]
+    assert te.fields_from_key_values(pairs, 0.8) == {"Permit_Number": "2024-0001"}
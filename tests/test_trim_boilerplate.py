@@ -0,0 +1,46 @@
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def trim_enabled(monkeypatch):
+    monkeypatch.setattr(main, "STRUCTURING_TRIM_BOILERPLATE", True)
+
+
+@pytest.mark.parametrize("line", [
+    "This permit is hereby granted to JUAN DELA CRUZ",
+    "Pursuant to Ordinance No. 123, ABC TRADING is authorized",
+    "Sanitary Permit Fee paid by PEDRO PENDUKO 100.00",
+    "Interest on the loan of Juan",
+    "Total",
+    "Business Name: Santos Trading",
+])
+def test_lines_with_fields_are_kept(line):
+    assert main.trim_boilerplate(line) == line
+
+
+@pytest.mark.parametrize("line", [
+    "MAYOR'S PERMIT FEE ₱ 1,500.00",
+    "Garbage Fee 200.00",
+    "Total 2,700.00",
+    "1,200.00 300.00",
+    "This permit is not valid without the official seal",
+    "Must be posted in a conspicuous place",
+])
+def test_fee_rows_and_footers_are_dropped(line):
+    assert main.trim_boilerplate(line) == ""
+
+
+def test_line_after_grantee_phrase_is_kept():
+    assert main.trim_boilerplate("Issued to:\nNot valid without seal") == "Issued to:\nNot valid without seal"
+
+
+def test_raw_ocr_page_is_never_dropped():
+    page = "REPUBLIC OF THE PHILIPPINES Business Permit " + "Total 1,000.00 " * 20
+    assert main.trim_boilerplate(page) == page
+
+
+def test_trim_is_off_by_default(monkeypatch):
+    monkeypatch.setattr(main, "STRUCTURING_TRIM_BOILERPLATE", False)
+    assert main.trim_boilerplate("Total 2,700.00") == "Total 2,700.00"
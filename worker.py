@@ -0,0 +1,55 @@
+# worker.py - background processing service for the Streamlit app
+# - Claims documents from the shared job queue (job_queue.py) and runs the normal pipeline
+#   (content-addressed result cache included), storing each result or error back on the job
+# - Run one or more of these next to any number of app replicas; they all share cache/jobs.sqlite
+#
+# Usage: python worker.py [threads]
+
+import sys
+import threading
+import time
+import traceback
+
+from job_queue import claim_job, complete_job, fail_job, heartbeat, worker_id
+from main import PIPELINE_WORKERS, process_permit
+
+JOB_POLL_SECONDS = 1.0
+HEARTBEAT_SECONDS = 5.0
+
+def run_jobs(worker, stop):
+    while not stop.is_set():
+        job = claim_job(worker)
+        if job is None:
+            stop.wait(JOB_POLL_SECONDS)
+            continue
+        file_path, sig = job
+        print(f"Processing {file_path}")
+        try:
+            result = process_permit(file_path)
+        except Exception as exc:
+            print(f"{file_path} generated an exception: {exc}")
+            fail_job(file_path, sig, traceback.format_exc())
+            continue
+        if result:
+            complete_job(file_path, sig, result)
+        else:
+            fail_job(file_path, sig, "No structured data extracted.")
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else PIPELINE_WORKERS
+    worker, stop = worker_id(), threading.Event()
+    pool = [threading.Thread(target=run_jobs, args=(worker, stop), daemon=True) for _ in range(threads)]
+    for t in pool:
+        t.start()
+    print(f"Worker {worker} running {threads} thread(s)")
+    try:
+        while True:
+            heartbeat(worker)
+            time.sleep(HEARTBEAT_SECONDS)
+    except KeyboardInterrupt:
+        stop.set()
+        for t in pool:
+            t.join()
+
+if __name__ == "__main__":
+    main()